@@ -1,7 +1,10 @@
 from __future__ import annotations
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file, jsonify, g
 from datetime import datetime
+import itertools
 import os
+import sqlite3
+import uuid
 
 # Reuse existing backend modules
 import database
@@ -9,9 +12,15 @@ import transactions
 import stock
 import reports
 import auth
+import importer
+import writer
 
+# Columns the report exports need; skips decoding sale lines
+EXPORT_COLUMNS = ["id", "type", "date", "total", "payment_method", "customer_name", "description",
+                  "paid", "date_cleared", "payment_method_cleared"]
 
-def create_app() -> Flask:
+
+def create_app(db_path: str | None = None) -> Flask:
     app = Flask(__name__)
     app.secret_key = os.environ.get("POS_SECRET_KEY", "dev-secret-key")
     # Optional: accept SQLAlchemy-style URI to point to shared SQLite file
@@ -19,9 +28,37 @@ def create_app() -> Flask:
     uri = os.environ.get("SQLALCHEMY_DATABASE_URI")
     if uri:
         app.config["SQLALCHEMY_DATABASE_URI"] = uri
-        # Bridge to our sqlite3 layer which uses POS_DB_PATH
-        if uri.startswith("sqlite:///"):
-            os.environ["POS_DB_PATH"] = uri.replace("sqlite:///", "", 1)
+        if uri.startswith("sqlite:///") and not db_path:
+            db_path = uri.replace("sqlite:///", "", 1)
+    # An app given its own file serves it on every request, whatever other
+    # apps in the process use; without one it uses the process-wide database
+    # (POS_DB_PATH or the default file)
+    app_db = database.Database(db_path) if db_path else None
+    app.extensions["pos_database"] = app_db
+    app.config["POS_DB_PATH"] = db_path or os.environ.get("POS_DB_PATH", database.DATABASE_FILE)
+
+    if app_db is not None:
+        @app.before_request
+        def bind_database():
+            g.pos_db_token = database.bind(app_db)
+
+        @app.teardown_request
+        def unbind_database(_exc):
+            token = g.pop("pos_db_token", None)
+            if token is not None:
+                database.unbind(token)
+
+    # POS_WRITE_QUEUE=1 funnels this process's writes through one writer
+    # thread that group-commits them, instead of every request thread
+    # competing for SQLite's write lock
+    writes = writer.WriteQueue(db=app_db).start() if os.environ.get("POS_WRITE_QUEUE") == "1" else None
+    app.extensions["pos_write_queue"] = writes
+
+    def write(fn, *args, priority=writer.CASHIER, **kwargs):
+        """Run a database write, on the writer thread when the queue is on."""
+        if writes is None:
+            return fn(*args, **kwargs)
+        return writes.call(fn, *args, priority=priority, **kwargs)
 
     @app.context_processor
     def inject_globals():
@@ -61,7 +98,7 @@ def create_app() -> Flask:
         new_theme = request.form.get("theme", "light")
         session["theme"] = new_theme
         # Persist preference
-        database.db.set_setting("theme", new_theme)
+        write(database.db.set_setting, "theme", new_theme)
         return redirect(request.referrer or url_for("dashboard"))
 
     def require_login():
@@ -75,27 +112,28 @@ def create_app() -> Flask:
         if guard:
             return guard
         summary = database.db.get_sales_summary()
+        today_str = datetime.now().strftime('%Y-%m-%d')
+        today = database.db.get_period_summary(today_str, today_str)
         # Optional search
         q = request.args.get("q", "").strip()
         search_results = None
         if q:
             # Naive search across items, transactions, credits
             items = stock.list_items()
-            txns = transactions.list_transactions()
+            txns = transactions.query_transactions(text=q, limit=20)["rows"]
             creds = transactions.list_credits()
             results = []
             for it in items:
                 if q.lower() in (it.get("code","")+" "+it.get("name","")) .lower():
                     results.append(f"Item {it['code']} - {it['name']} (KES {it.get('selling_price') or it.get('price')})")
             for t in txns:
-                blob = f"{t.get('id')} {t.get('type')} {t.get('customer_name') or t.get('description','')} {t.get('payment_method')}"
-                if q.lower() in blob.lower():
-                    results.append(f"Txn {t['id']} - {t['type']} KES {t['total']:.2f} {t['payment_method']}")
+                results.append(f"Txn {t['id']} - {t['type']} KES {t['total']:.2f} {t['payment_method']}")
             for cust in creds.keys():
                 if q.lower() in cust.lower():
                     results.append(f"Credit - {cust}")
             search_results = results[:20]
-        return render_template("dashboard.html", summary=summary, search_results=search_results)
+        low_stock = stock.low_stock_items(limit=10)
+        return render_template("dashboard.html", summary=summary, today=today, search_results=search_results, low_stock=low_stock)
 
     @app.route("/transactions", methods=["GET", "POST"])
     def view_transactions():
@@ -109,31 +147,29 @@ def create_app() -> Flask:
                 # Split into sales (TXN...) and expenses (EXP...)
                 sale_ids = [i for i in ids if not str(i).startswith("EXP")]
                 exp_ids = [int(str(i)[3:]) for i in ids if str(i).startswith("EXP")]
-                deleted_sales = database.db.delete_transactions(sale_ids) if sale_ids else 0
-                deleted_exp = database.db.delete_expenses(exp_ids) if exp_ids else 0
-                flash(f"Deleted {deleted_sales} sale(s), {deleted_exp} expense(s)", "success")
+
+                def delete_both():
+                    # Both deletes commit together or not at all
+                    with database.db.transaction():
+                        return (database.db.delete_transactions(sale_ids) if sale_ids else 0,
+                                database.db.delete_expenses(exp_ids) if exp_ids else 0)
+                try:
+                    deleted_sales, deleted_exp = write(delete_both, priority=writer.ADMIN)
+                    flash(f"Deleted {deleted_sales} sale(s), {deleted_exp} expense(s)", "success")
+                except ValueError as e:
+                    flash(str(e), "error")
                 return redirect(url_for("view_transactions"))
         f_type = request.args.get("type", "all")
         f_pay = request.args.get("payment", "all")
         f_from = request.args.get("from", "")
         f_to = request.args.get("to", "")
-        rows = transactions.list_transactions()
-
-        def in_range(d: str) -> bool:
-            if not d:
-                return True
-            return (not f_from or d >= f_from) and (not f_to or d <= f_to)
-
-        filtered = []
-        for r in rows:
-            if f_type != "all" and r.get("type", "sale") != f_type:
-                continue
-            if f_pay != "all" and r.get("payment_method", "-") != f_pay:
-                continue
-            if not in_range(r.get("date", "")):
-                continue
-            filtered.append(r)
-        return render_template("transactions.html", rows=filtered, f_type=f_type, f_pay=f_pay, f_from=f_from, f_to=f_to)
+        after = request.args.get("after", "")
+        try:
+            page = transactions.query_transactions(f_type, f_pay, f_from, f_to, limit=100, cursor=after)
+        except ValueError:
+            return redirect(url_for("view_transactions", type=f_type, payment=f_pay, **{"from": f_from, "to": f_to}))
+        return render_template("transactions.html", rows=page["rows"], next_cursor=page["next_cursor"], after=after,
+                               f_type=f_type, f_pay=f_pay, f_from=f_from, f_to=f_to)
 
     @app.route("/sales", methods=["GET", "POST"])
     def record_sale():
@@ -147,6 +183,7 @@ def create_app() -> Flask:
             payment = request.form.get("payment_method", "Cash")
             customer = request.form.get("customer_name", "").strip()
             date_val = request.form.get("date", "") or None
+            key = request.form.get("idempotency_key") or None
             try:
                 if sale_type == "service":
                     service_raw = request.form.get("service_id")
@@ -154,18 +191,26 @@ def create_app() -> Flask:
                         raise ValueError("Service is required")
                     service_id = int(service_raw)
                     qty = int(request.form.get("quantity", "1") or 1)
-                    txn = transactions.create_transaction([{"service_id": service_id, "quantity": qty}], payment, customer, date_val)
+                    txn = write(transactions.create_transaction, [{"service_id": service_id, "quantity": qty}], payment, customer, date_val, key)
                 else:
                     code = request.form.get("item_code")
                     qty = int(request.form.get("quantity", "0") or 0)
-                    txn = transactions.create_transaction([{"code": code, "quantity": qty}], payment, customer, date_val)
+                    txn = write(transactions.create_transaction, [{"code": code, "quantity": qty}], payment, customer, date_val, key)
                 flash(f"Sale recorded: {txn['id']}", "success")
                 if payment == "Credit":
                     return redirect(url_for("manage_credits"))
                 return redirect(url_for("view_transactions"))
             except Exception as e:
                 flash(str(e), "error")
-        return render_template("sales.html", items=items, services=svc)
+        # A fresh key per rendered form; a resubmitted form reuses it
+        return render_template("sales.html", items=items, services=svc, idempotency_key=uuid.uuid4().hex)
+
+    @app.route("/customers/search")
+    def search_customers():
+        guard = require_login()
+        if guard:
+            return guard
+        return jsonify(transactions.search_customers(request.args.get("q", "")))
 
     @app.route("/services", methods=["GET", "POST"]) 
     def manage_services():
@@ -181,22 +226,26 @@ def create_app() -> Flask:
             if action == "add":
                 name = request.form.get("service_name", "").strip()
                 price = float(request.form.get("price", "0") or 0)
-                database.db.add_service(name, price)
+                write(database.db.add_service, name, price, priority=writer.ADMIN)
             elif action == "delete_selected":
                 ids = request.form.getlist("selected_service")
-                for sid in ids:
-                    try:
-                        database.db.delete_service(int(sid))
-                    except Exception:
-                        continue
+
+                def delete_services():
+                    with database.db.transaction():
+                        for sid in ids:
+                            try:
+                                database.db.delete_service(int(sid))
+                            except Exception:
+                                continue
+                write(delete_services, priority=writer.ADMIN)
             elif action == "update":
                 sid = int(request.form.get("id"))
                 name = request.form.get("service_name", "").strip()
                 price = float(request.form.get("price", "0") or 0)
-                database.db.update_service(sid, name, price)
+                write(database.db.update_service, sid, name, price, priority=writer.ADMIN)
             elif action == "delete":
                 sid = int(request.form.get("id"))
-                database.db.delete_service(sid)
+                write(database.db.delete_service, sid, priority=writer.ADMIN)
             return redirect(url_for("manage_services"))
         services = database.db.list_services()
         return render_template("services.html", services=services)
@@ -211,12 +260,12 @@ def create_app() -> Flask:
             amount = float(request.form.get("amount", "0") or 0)
             date_val = request.form.get("date", "") or None
             try:
-                transactions.add_expense(desc, amount, date_val)
+                write(transactions.add_expense, desc, amount, date_val, request.form.get("idempotency_key") or None)
                 flash("Expense recorded", "success")
                 return redirect(url_for("view_transactions"))
             except Exception as e:
                 flash(str(e), "error")
-        return render_template("expenses.html")
+        return render_template("expenses.html", idempotency_key=uuid.uuid4().hex)
 
     @app.route("/credits", methods=["GET", "POST"]) 
     def manage_credits():
@@ -234,7 +283,7 @@ def create_app() -> Flask:
                 customers = request.form.getlist("selected_credit") if action == "delete_selected" else [request.form.get("customer")]
                 try:
                     customers = [c for c in customers if c]
-                    deleted = database.db.delete_credits(customers)
+                    deleted = write(database.db.delete_credits, customers, priority=writer.ADMIN)
                     flash(f"Deleted {deleted} credit record(s)", "success")
                 except Exception as e:
                     flash(f"Delete failed: {e}", "error")
@@ -246,7 +295,7 @@ def create_app() -> Flask:
                 flash("Only administrators can clear credits", "error")
             else:
                 try:
-                    transactions.clear_credit(customer, method, date_val)
+                    write(transactions.clear_credit, customer, method, date_val, request.form.get("idempotency_key") or None)
                     flash("Credit cleared", "success")
                     return redirect(url_for("manage_credits"))
                 except Exception as e:
@@ -263,7 +312,7 @@ def create_app() -> Flask:
                 "status": info.get("status", "Pending"),
                 "transactions": len(info.get("transaction_ids", [])),
             })
-        return render_template("credits.html", credits=credits, credit_rows=rows)
+        return render_template("credits.html", credits=credits, credit_rows=rows, idempotency_key=uuid.uuid4().hex)
 
     @app.route("/stock", methods=["GET", "POST"]) 
     def add_stock():
@@ -285,7 +334,8 @@ def create_app() -> Flask:
                         buying = float(request.form.get("buying_price", "0") or 0)
                         selling = request.form.get("selling_price")
                         selling_val = float(selling) if selling not in (None, "",) else None
-                        stock.add_item(name, type_, price, qty, buying, selling_val)
+                        reorder = int(request.form.get("reorder_level", "0") or 0)
+                        write(stock.add_item, name, type_, price, qty, buying, selling_val, reorder, priority=writer.ADMIN)
                         flash("Item added", "success")
                     elif action == "update":
                         code = request.form.get("code", "").strip()
@@ -293,11 +343,13 @@ def create_app() -> Flask:
                         qty = int(request.form.get("quantity", "0") or 0)
                         buying = float(request.form.get("buying_price", "0") or 0)
                         selling = float(request.form.get("selling_price", "0") or 0)
-                        stock.update_item(code, name, qty, buying, selling)
+                        reorder = request.form.get("reorder_level")
+                        write(stock.update_item, code, name, qty, buying, selling, int(reorder) if reorder not in (None, "") else None,
+                              priority=writer.ADMIN)
                         flash("Item updated", "success")
                     elif action == "delete_selected":
                         codes = request.form.getlist("selected")
-                        deleted = stock.delete_items(codes)
+                        deleted = write(stock.delete_items, codes, priority=writer.ADMIN)
                         flash(f"Deleted {deleted} item(s)", "success")
                     return redirect(url_for("add_stock"))
                 except Exception as e:
@@ -305,17 +357,103 @@ def create_app() -> Flask:
         items = stock.list_items()
         return render_template("stock.html", items=items)
 
+    @app.route("/stock/adjust", methods=["GET", "POST"])
+    def bulk_adjust_stock():
+        guard = require_login()
+        if guard:
+            return guard
+        if not auth.is_admin(session.get("user")):
+            flash("Only administrators can adjust stock", "error")
+            return redirect(url_for("add_stock"))
+        mode = request.form.get("mode", "delta")
+        lines = request.form.get("lines", "")
+        report = None
+        if request.method == "POST":
+            upload = request.files.get("file")
+            text = upload.read().decode("utf-8-sig") if upload and upload.filename else lines
+            try:
+                report = write(stock.adjust_stock_bulk, stock.parse_adjustments(text), counted=(mode == "counted"), priority=writer.ADMIN)
+                if report:
+                    flash(f"Adjusted {sum(1 for r in report if r['variance'])} of {len(report)} item(s)", "success")
+                else:
+                    flash("No adjustment lines given", "error")
+                lines = ""
+            except ValueError as e:
+                flash(str(e), "error")
+        return render_template("stock_adjust.html", mode=mode, lines=lines, report=report)
+
+    @app.route("/stock/import", methods=["GET", "POST"])
+    def import_catalogue():
+        guard = require_login()
+        if guard:
+            return guard
+        if not auth.is_admin(session.get("user")):
+            flash("Only administrators can import items", "error")
+            return redirect(url_for("add_stock"))
+        result = None
+        if request.method == "POST":
+            upload = request.files.get("file")
+            if not upload or not upload.filename:
+                flash("Choose a CSV or Excel file", "error")
+            else:
+                try:
+                    result = importer.import_items(upload.stream, upload.filename)
+                    flash(f"Imported {result['inserted'] + result['updated']} item(s)", "success")
+                except ValueError as e:
+                    flash(str(e), "error")
+                except sqlite3.IntegrityError as e:
+                    # Chunks before the failing one are already committed
+                    flash(f"Import stopped: {e}", "error")
+        return render_template("stock_import.html", result=result)
+
     @app.route("/reports")
     def reports_page():
         guard = require_login()
         if guard:
             return guard
-        summary = database.db.get_sales_summary()
         # Date range filters for transactions (affect exports later) - stock report remains overall
         from_d = request.args.get("from", "")
         to_d = request.args.get("to", "")
+        if from_d or to_d:
+            summary = database.db.get_period_summary(from_d or None, to_d or None)
+        else:
+            summary = database.db.get_sales_summary()
         stock_rows = database.db.get_stock_report_data()
-        return render_template("reports.html", summary=summary, stock_rows=stock_rows)
+        inventory_value = database.db.get_inventory_value()
+        item_rows = database.db.get_item_sales(from_d or None, to_d or None)
+        closed_days = database.db.list_closed_days()
+        as_of = request.args.get("as_of", "")
+        as_of_rows = None
+        if as_of:
+            try:
+                as_of_rows = stock.stock_as_of(as_of)
+            except ValueError as e:
+                flash(str(e), "error")
+        return render_template("reports.html", summary=summary, stock_rows=stock_rows, item_rows=item_rows, closed_days=closed_days,
+                               inventory_value=inventory_value, as_of=as_of, as_of_rows=as_of_rows)
+
+    @app.route("/reports/close-day", methods=["POST"])
+    def close_day():
+        guard = require_login()
+        if guard:
+            return guard
+        user = session.get("user")
+        if not auth.is_admin(user):
+            flash("Only administrators can close or re-open days", "error")
+            return redirect(url_for("reports_page"))
+        day = request.form.get("day", "") or datetime.now().strftime('%Y-%m-%d')
+        try:
+            if request.form.get("action") == "reopen":
+                if write(database.db.reopen_day, day, priority=writer.ADMIN):
+                    flash(f"Day {day} re-opened", "success")
+                else:
+                    flash(f"Day {day} was not closed", "error")
+            else:
+                closed = write(database.db.close_day, day, user.get("username", ""), priority=writer.ADMIN)
+                flash(f"Day {day} closed: sales KES {closed['total_sales']:.2f}, expenses KES {closed['total_expenses']:.2f}", "success")
+        except ValueError as e:
+            flash(str(e), "error")
+        return redirect(url_for("reports_page"))
 
     @app.route("/reports/export/excel")
     def export_reports_excel():
@@ -324,25 +462,21 @@ def create_app() -> Flask:
             return guard
         from_d = request.args.get("from", "")
         to_d = request.args.get("to", "")
-        rows = transactions.list_transactions()
-        def in_range(d: str) -> bool:
-            if not d:
-                return True
-            return (not from_d or d >= from_d) and (not to_d or d <= to_d)
-        filtered = [r for r in rows if in_range(r.get("date", ""))]
-        if not filtered:
+        rows = transactions.iter_transactions(from_d, to_d, columns=EXPORT_COLUMNS)
+        first = next(rows, None)
+        if first is None:
             flash("No records found for selected range", "error")
             return redirect(url_for("reports_page", **{"from": from_d, "to": to_d}))
+        rows = itertools.chain([first], rows)
         # Build Excel
         try:
             from io import BytesIO
             from openpyxl import Workbook
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Transactions"
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet("Transactions")
             headers = ["ID", "Type", "Date", "Amount", "Payment", "Customer/Description", "Paid", "Cleared Date", "Cleared By"]
             ws.append(headers)
-            for r in filtered:
+            for r in rows:
                 ws.append([
                     r.get("id"), r.get("type"), r.get("date"), r.get("total"), r.get("payment_method"),
                     r.get("customer_name") or r.get("description") or "-",
@@ -366,15 +500,12 @@ def create_app() -> Flask:
             return guard
         from_d = request.args.get("from", "")
         to_d = request.args.get("to", "")
-        rows = transactions.list_transactions()
-        def in_range(d: str) -> bool:
-            if not d:
-                return True
-            return (not from_d or d >= from_d) and (not to_d or d <= to_d)
-        filtered = [r for r in rows if in_range(r.get("date", ""))]
-        if not filtered:
+        rows = transactions.iter_transactions(from_d, to_d, columns=EXPORT_COLUMNS)
+        first = next(rows, None)
+        if first is None:
             flash("No records found for selected range", "error")
             return redirect(url_for("reports_page", **{"from": from_d, "to": to_d}))
+        rows = itertools.chain([first], rows)
         try:
             from io import BytesIO
             from reportlab.lib.pagesizes import A4
@@ -396,7 +527,7 @@ def create_app() -> Flask:
                 c.drawString(x_positions[i], y, h)
             y -= 12
             c.setFont("Helvetica", 9)
-            for r in filtered:
+            for r in rows:
                 if y < 60:
                     c.showPage()
                     y = height - 50
@@ -3,268 +3,1670 @@ Database operations for the POS system using SQLite.
 Handles all data persistence for users, items, transactions, and reports.
 """
 import sqlite3
+import contextvars
+import heapq
+import itertools
 import json
+import threading
+import time
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional, Any
+from pathlib import Path
+from typing import List, Dict, Optional, Any, Iterator
 import os
 
-# Allow overriding DB path via environment variable for LAN/shared usage
-DATABASE_FILE = os.environ.get("POS_DB_PATH", "pos_database.db")
+# Used when neither init(path) nor POS_DB_PATH (for LAN/shared usage) names a file
+DATABASE_FILE = "pos_database.db"
+
+# Applied to every pooled connection, read-only or not
+CONNECTION_PRAGMAS = (
+    "PRAGMA busy_timeout=15000",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+
+def _create_base_schema(cursor: sqlite3.Cursor) -> None:
+    """Original tables plus the ALTER TABLE upgrades from before MIGRATIONS (version 0)."""
+    # Users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL DEFAULT 'cashier',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Items table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE NOT NULL,
+            name TEXT NOT NULL,
+            type TEXT NOT NULL,
+            price REAL NOT NULL,
+            buying_price REAL DEFAULT 0,
+            selling_price REAL,
+            quantity INTEGER DEFAULT 0,
+            unit_type TEXT DEFAULT 'unit',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Transactions table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transaction_id TEXT UNIQUE NOT NULL,
+            items TEXT NOT NULL,
+            total REAL NOT NULL,
+            payment_method TEXT NOT NULL,
+            customer_name TEXT DEFAULT '',
+            paid BOOLEAN DEFAULT 1,
+            credit_status BOOLEAN DEFAULT 0,
+            date TEXT,
+            date_cleared TEXT,
+            payment_method_cleared TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Expenses table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            description TEXT NOT NULL,
+            amount REAL NOT NULL,
+            date TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Stock logs table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_code TEXT NOT NULL,
+            action TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Credits table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS credits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            customer_name TEXT UNIQUE NOT NULL,
+            amount REAL NOT NULL,
+            transaction_ids TEXT NOT NULL,
+            date_created TEXT,
+            date_cleared TEXT,
+            payment_method_cleared TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # System settings table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE NOT NULL,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Services table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS services (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            service_name TEXT UNIQUE NOT NULL,
+            price REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Columns added before versioned migrations existed; files at version 0
+    # may predate any of them
+    def try_alter(sql: str):
+        try:
+            cursor.execute(sql)
+        except sqlite3.OperationalError:
+            pass
+
+    try_alter("ALTER TABLE items ADD COLUMN unit_type TEXT DEFAULT 'unit'")
+    # New price fields (safe if already exist)
+    try_alter("ALTER TABLE items ADD COLUMN buying_price REAL DEFAULT 0")
+    try_alter("ALTER TABLE items ADD COLUMN selling_price REAL")
+    try_alter("ALTER TABLE transactions ADD COLUMN date TEXT")
+    try_alter("ALTER TABLE transactions ADD COLUMN date_cleared TEXT")
+    try_alter("ALTER TABLE transactions ADD COLUMN payment_method_cleared TEXT")
+    try_alter("ALTER TABLE expenses ADD COLUMN date TEXT")
+    try_alter("ALTER TABLE credits ADD COLUMN date_created TEXT")
+    try_alter("ALTER TABLE credits ADD COLUMN date_cleared TEXT")
+    try_alter("ALTER TABLE credits ADD COLUMN payment_method_cleared TEXT")
+
+
+def _migrate_hot_query_indexes(cursor: sqlite3.Cursor) -> None:
+    """Secondary/covering indexes for the date, paid, customer and stock-log lookups."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions(date, payment_method, paid, total)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_paid ON transactions(paid, total)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_customer ON transactions(customer_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses(date, amount)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_logs_item ON stock_logs(item_code, action, quantity)")
+    cursor.execute("ANALYZE")
+
+
+def _migrate_sequences(cursor: sqlite3.Cursor) -> None:
+    """Code allocator table, seeded past the highest code already issued."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO sequences (name, value)
+        SELECT 'transaction', COALESCE(MAX(CAST(SUBSTR(transaction_id, 4) AS INTEGER)), 0)
+        FROM transactions WHERE transaction_id LIKE 'TXN%'
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO sequences (name, value)
+        SELECT 'item', COALESCE(MAX(CAST(SUBSTR(code, 5) AS INTEGER)), 0)
+        FROM items WHERE code LIKE 'ITEM%'
+    """)
+
+
+def _migrate_transaction_lines(cursor: sqlite3.Cursor) -> None:
+    """Normalized sale lines, backfilled from the legacy transactions.items JSON."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS transaction_lines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transaction_id TEXT NOT NULL,
+            line_no INTEGER NOT NULL,
+            item_code TEXT,
+            service_id INTEGER,
+            name TEXT NOT NULL DEFAULT '',
+            quantity INTEGER NOT NULL,
+            unit_price REAL NOT NULL,
+            unit_cost REAL NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transaction_lines_txn ON transaction_lines(transaction_id, line_no)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transaction_lines_item ON transaction_lines(item_code, quantity, unit_price, unit_cost)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transaction_lines_service ON transaction_lines(service_id) WHERE service_id IS NOT NULL")
+
+    cursor.execute("SELECT code, name, COALESCE(selling_price, price), COALESCE(buying_price, 0) FROM items")
+    catalog = {row[0]: row[1:] for row in cursor.fetchall()}
+    cursor.execute("SELECT id, service_name, price FROM services")
+    services = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    # Old sales only stored code + quantity, so prices come from the current
+    # catalogue; a single-line sale takes its exact unit price from the total.
+    reader = cursor.connection.cursor()
+    reader.execute("""
+        SELECT t.transaction_id, t.items, t.total FROM transactions t
+        WHERE NOT EXISTS (SELECT 1 FROM transaction_lines l WHERE l.transaction_id = t.transaction_id)
+    """)
+    while True:
+        batch = reader.fetchmany(500)
+        if not batch:
+            break
+        lines = []
+        for transaction_id, items_json, total in batch:
+            try:
+                items = json.loads(items_json or "[]")
+            except ValueError:
+                continue
+            for line_no, item in enumerate(items, start=1):
+                qty = int(item.get("quantity", 1) or 0)
+                if "service_id" in item:
+                    name, price = services.get(int(item["service_id"]), ("", 0.0))
+                    code, service_id, cost = None, int(item["service_id"]), 0.0
+                else:
+                    code, service_id = item.get("code"), None
+                    name, price, cost = catalog.get(code, ("", 0.0, 0.0))
+                if len(items) == 1 and qty:
+                    price = float(total) / qty
+                lines.append((transaction_id, line_no, code, service_id, name, qty, float(price), float(cost)))
+        cursor.executemany(
+            "INSERT INTO transaction_lines (transaction_id, line_no, item_code, service_id, name, quantity, unit_price, unit_cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            lines
+        )
+    reader.close()
+
+
+def _migrate_credit_links(cursor: sqlite3.Cursor) -> None:
+    """Credit-to-transaction link table, moved out of credits.transaction_ids JSON."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS credit_links (
+            customer_name TEXT NOT NULL,
+            transaction_id TEXT NOT NULL,
+            PRIMARY KEY (customer_name, transaction_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_credit_links_txn ON credit_links(transaction_id)")
+    cursor.execute("SELECT customer_name, transaction_ids FROM credits")
+    links = []
+    for customer_name, ids_json in cursor.fetchall():
+        try:
+            ids = json.loads(ids_json or "[]")
+        except ValueError:
+            ids = []
+        links.extend((customer_name, str(txn_id)) for txn_id in ids)
+    cursor.executemany("INSERT OR IGNORE INTO credit_links (customer_name, transaction_id) VALUES (?, ?)", links)
+    # The link table is now the source of truth; the legacy column stays empty
+    cursor.execute("UPDATE credits SET transaction_ids = '[]'")
+
+
+LEDGER_FIELDS = ("total_sales", "total_credits", "total_expenses", "total_transactions")
+
+
+def _compute_ledger(cursor: sqlite3.Cursor) -> Dict[str, float]:
+    """Recompute the ledger totals from the base tables (full scan)."""
+    cursor.execute("SELECT COALESCE(SUM(total), 0) FROM transactions WHERE paid = 1")
+    total_sales = cursor.fetchone()[0]
+    cursor.execute("SELECT COALESCE(SUM(amount), 0) FROM credits")
+    total_credits = cursor.fetchone()[0]
+    cursor.execute("SELECT COALESCE(SUM(amount), 0) FROM expenses")
+    total_expenses = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM transactions")
+    total_transactions = cursor.fetchone()[0]
+    return {
+        "total_sales": total_sales,
+        "total_credits": total_credits,
+        "total_expenses": total_expenses,
+        "total_transactions": total_transactions,
+    }
+
+
+def _write_ledger(cursor: sqlite3.Cursor, totals: Dict[str, float]) -> None:
+    cursor.execute(
+        "INSERT OR REPLACE INTO ledger_totals (id, total_sales, total_credits, total_expenses, total_transactions) VALUES (1, ?, ?, ?, ?)",
+        tuple(totals[f] for f in LEDGER_FIELDS)
+    )
+
+
+def _migrate_ledger_totals(cursor: sqlite3.Cursor) -> None:
+    """Single-row running totals behind the balance and dashboard summary."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ledger_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_sales REAL NOT NULL DEFAULT 0,
+            total_credits REAL NOT NULL DEFAULT 0,
+            total_expenses REAL NOT NULL DEFAULT 0,
+            total_transactions INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    _write_ledger(cursor, _compute_ledger(cursor))
+
+
+DAILY_FIELDS = ("sales_total", "credit_total", "cleared_total", "expense_total", "sale_count", "expense_count", "cogs")
+
+# Rows (day, payment_method, *DAILY_FIELDS) contributed by each base table.
+# Credit sales count as credit on the sale day and as sales under the
+# clearance method on the clearance day. Expenses use payment_method '-'.
+# Cost of goods sold is booked on the sale day from the lines' FIFO cost.
+_DAILY_SOURCE_SQL = """
+    SELECT date AS day, payment_method AS method,
+           CASE WHEN payment_method = 'Credit' THEN 0 ELSE total END AS sales_total,
+           CASE WHEN payment_method = 'Credit' THEN total ELSE 0 END AS credit_total,
+           0 AS cleared_total, 0 AS expense_total, 1 AS sale_count, 0 AS expense_count,
+           (SELECT COALESCE(SUM(l.quantity * l.unit_cost), 0) FROM transaction_lines l
+            WHERE l.transaction_id = transactions.transaction_id) AS cogs
+    FROM transactions WHERE {sale_cond}
+    UNION ALL
+    SELECT date_cleared, payment_method_cleared, 0, 0, total, 0, 0, 0, 0
+    FROM transactions WHERE payment_method = 'Credit' AND paid = 1 AND {cleared_cond}
+    UNION ALL
+    SELECT date, '-', 0, 0, 0, amount, 0, 1, 0
+    FROM expenses WHERE {expense_cond}
+"""
+
+
+def _rebuild_daily_totals(cursor: sqlite3.Cursor, day: Optional[str] = None, open_only: bool = False,
+                          fields: tuple = DAILY_FIELDS) -> None:
+    """Recompute daily_totals from the base tables, for one day or all of them.
+
+    ``open_only`` leaves the frozen rollups of closed days untouched.
+    ``fields`` limits the columns written, for migrations that run before
+    later columns exist.
+    """
+    if day is None:
+        conds = {"sale_cond": "date IS NOT NULL", "cleared_cond": "date_cleared IS NOT NULL", "expense_cond": "date IS NOT NULL"}
+        params: tuple = ()
+        if open_only:
+            closed = " NOT IN (SELECT day FROM day_closures)"
+            conds = {"sale_cond": "date" + closed, "cleared_cond": "date_cleared" + closed, "expense_cond": "date" + closed}
+            cursor.execute("DELETE FROM daily_totals WHERE day" + closed)
+        else:
+            cursor.execute("DELETE FROM daily_totals")
+    else:
+        conds = {"sale_cond": "date = ?", "cleared_cond": "date_cleared = ?", "expense_cond": "date = ?"}
+        params = (day, day, day)
+        cursor.execute("DELETE FROM daily_totals WHERE day = ?", (day,))
+    cursor.execute(f"""
+        INSERT INTO daily_totals (day, payment_method, {", ".join(fields)})
+        SELECT day, method, {", ".join(f"SUM({f})" for f in fields)}
+        FROM ({_DAILY_SOURCE_SQL.format(**conds)})
+        GROUP BY day, method
+    """, params)
+
+
+def _migrate_daily_totals(cursor: sqlite3.Cursor) -> None:
+    """Per-day, per-payment-method rollup plus the day-close register."""
+    # Rollups are keyed by business date, so give legacy undated rows one
+    cursor.execute("UPDATE transactions SET date = SUBSTR(created_at, 1, 10) WHERE date IS NULL")
+    cursor.execute("UPDATE expenses SET date = SUBSTR(created_at, 1, 10) WHERE date IS NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_cleared ON transactions(date_cleared) WHERE date_cleared IS NOT NULL")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            day TEXT NOT NULL,
+            payment_method TEXT NOT NULL,
+            sales_total REAL NOT NULL DEFAULT 0,
+            credit_total REAL NOT NULL DEFAULT 0,
+            cleared_total REAL NOT NULL DEFAULT 0,
+            expense_total REAL NOT NULL DEFAULT 0,
+            sale_count INTEGER NOT NULL DEFAULT 0,
+            expense_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, payment_method)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS day_closures (
+            day TEXT PRIMARY KEY,
+            closed_by TEXT,
+            closed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # cogs is added by migration 14
+    _rebuild_daily_totals(cursor, fields=tuple(f for f in DAILY_FIELDS if f != "cogs"))
+
+
+def _rebuild_stock_counters(cursor: sqlite3.Cursor) -> None:
+    """Recompute items.received_qty/used_qty from stock_logs."""
+    cursor.execute("""
+        UPDATE items SET
+            received_qty = COALESCE((SELECT SUM(quantity) FROM stock_logs WHERE item_code = items.code AND action = 'added'), 0),
+            used_qty = COALESCE((SELECT SUM(quantity) FROM stock_logs WHERE item_code = items.code AND action = 'used'), 0)
+    """)
+
+
+def _migrate_stock_counters(cursor: sqlite3.Cursor) -> None:
+    """Per-item received/used counters so the stock report skips stock_logs."""
+    for column in ("received_qty", "used_qty"):
+        try:
+            cursor.execute(f"ALTER TABLE items ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_items_type ON items(type, code)")
+    _rebuild_stock_counters(cursor)
+
+
+def _migrate_listing_indexes(cursor: sqlite3.Cursor) -> None:
+    """Plain date indexes: (date, rowid) order serves keyset pagination."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_day ON transactions(date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_day ON expenses(date)")
+
+
+def _migrate_idempotency_keys(cursor: sqlite3.Cursor) -> None:
+    """Client-supplied keys so a retried submission returns the first result."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            operation TEXT NOT NULL,
+            result TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def normalize_customer_name(name: Optional[str]) -> str:
+    """Account key for a credit customer: case and spacing do not matter."""
+    return " ".join((name or "").split()).casefold()
+
+
+def _migrate_customers(cursor: sqlite3.Cursor) -> None:
+    """Customers keyed by normalized name, merging credit accounts that differ only in case/spacing."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS customers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            normalized_name TEXT NOT NULL UNIQUE,
+            outstanding REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT id, customer_name, amount, date_created FROM credits ORDER BY id")
+    accounts: Dict[str, list] = {}
+    for credit_id, name, amount, date_created in cursor.fetchall():
+        key = normalize_customer_name(name)
+        if not key:
+            continue
+        if key not in accounts:
+            # The first spelling entered becomes the account name
+            accounts[key] = [name, amount or 0.0]
+            continue
+        canonical = accounts[key][0]
+        accounts[key][1] += amount or 0.0
+        cursor.execute(
+            "UPDATE credits SET amount = amount + ?, date_created = COALESCE(MIN(date_created, ?), date_created, ?) WHERE customer_name = ?",
+            (amount or 0.0, date_created, date_created, canonical)
+        )
+        # Merging money still owed into a cleared account re-opens it
+        cursor.execute(
+            "UPDATE credits SET date_cleared = NULL, payment_method_cleared = NULL WHERE customer_name = ? AND amount > 0",
+            (canonical,)
+        )
+        cursor.execute("UPDATE credit_links SET customer_name = ? WHERE customer_name = ?", (canonical, name))
+        cursor.execute("UPDATE transactions SET customer_name = ? WHERE customer_name = ?", (canonical, name))
+        cursor.execute("DELETE FROM credits WHERE id = ?", (credit_id,))
+    cursor.executemany(
+        "INSERT OR IGNORE INTO customers (name, normalized_name, outstanding) VALUES (?, ?, ?)",
+        [(name, key, outstanding) for key, (name, outstanding) in accounts.items()]
+    )
+
+
+def _migrate_supplier_codes(cursor: sqlite3.Cursor) -> None:
+    """Supplier codes and a case-insensitive name index so catalogue imports can upsert."""
+    try:
+        cursor.execute("ALTER TABLE items ADD COLUMN supplier_code TEXT")
+    except sqlite3.OperationalError:
+        pass
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_items_supplier_code ON items(supplier_code) WHERE supplier_code IS NOT NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_items_name ON items(name COLLATE NOCASE)")
+
+
+def _migrate_history_loads(cursor: sqlite3.Cursor) -> None:
+    """Resume checkpoints and parked index definitions for historical bulk loads."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS load_checkpoints (
+            source TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            done BOOLEAN NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS deferred_indexes (
+            name TEXT PRIMARY KEY,
+            sql TEXT NOT NULL
+        )
+    """)
+
+
+# Items at or below their reorder level. Queries must repeat this exact
+# condition so SQLite answers them from the idx_items_low_stock partial index.
+# Services always keep reorder_level 0, so they never match.
+LOW_STOCK_CONDITION = "reorder_level > 0 AND quantity <= reorder_level"
+
+
+def _migrate_reorder_levels(cursor: sqlite3.Cursor) -> None:
+    """Per-item reorder thresholds plus a partial index that holds only low-stock items."""
+    try:
+        cursor.execute("ALTER TABLE items ADD COLUMN reorder_level INTEGER NOT NULL DEFAULT 0")
+    except sqlite3.OperationalError:
+        pass
+    # SQLite adds and removes entries as sales and adjustments move quantity
+    # across the threshold, so the watch list is maintained on every write
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_items_low_stock ON items(quantity, code) WHERE {LOW_STOCK_CONDITION}")
+
+
+def _migrate_cost_layers(cursor: sqlite3.Cursor) -> None:
+    """FIFO cost layers per product, plus cost of goods sold in the daily rollup."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cost_layers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_code TEXT NOT NULL,
+            unit_cost REAL NOT NULL,
+            quantity INTEGER NOT NULL,
+            remaining INTEGER NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Only layers with stock left are ever read; covering so valuation never touches the table
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cost_layers_open ON cost_layers(item_code, id, unit_cost, remaining) WHERE remaining > 0")
+    # Stock already on hand opens at the item's current buying price
+    cursor.execute("""
+        INSERT INTO cost_layers (item_code, unit_cost, quantity, remaining)
+        SELECT code, COALESCE(buying_price, 0), quantity, quantity FROM items
+        WHERE type = 'product' AND quantity > 0
+    """)
+    cursor.execute("ALTER TABLE daily_totals ADD COLUMN cogs REAL NOT NULL DEFAULT 0")
+    # Past lines carry the buying price captured at sale time
+    cursor.execute("""
+        UPDATE daily_totals SET cogs = COALESCE((
+            SELECT SUM(l.quantity * l.unit_cost)
+            FROM transactions t JOIN transaction_lines l ON l.transaction_id = t.transaction_id
+            WHERE t.date = daily_totals.day AND t.payment_method = daily_totals.payment_method
+        ), 0)
+    """)
+
+
+def _migrate_stock_checkpoints(cursor: sqlite3.Cursor) -> None:
+    """Business dates on stock_logs plus per-item end-of-day stock checkpoints."""
+    try:
+        cursor.execute("ALTER TABLE stock_logs ADD COLUMN business_date TEXT")
+    except sqlite3.OperationalError:
+        pass
+    cursor.execute("UPDATE stock_logs SET business_date = SUBSTR(created_at, 1, 10) WHERE business_date IS NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_logs_item_day ON stock_logs(item_code, business_date, action, quantity)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_checkpoints (
+            item_code TEXT NOT NULL,
+            day TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (item_code, day)
+        ) WITHOUT ROWID
+    """)
+
+
+def _migrate_stock_log_entries(cursor: sqlite3.Cursor) -> None:
+    """Count of movements folded into each stock_logs row by compaction."""
+    try:
+        cursor.execute("ALTER TABLE stock_logs ADD COLUMN entries INTEGER NOT NULL DEFAULT 1")
+    except sqlite3.OperationalError:
+        pass
+
+
+def _migrate_reopen_owing_credits(cursor: sqlite3.Cursor) -> None:
+    """Re-open credit accounts that read as cleared while money is still owed.
+
+    Files that went through migration 10 before it reset the cleared
+    fields, or that took a credit sale on a cleared account, can have them.
+    """
+    cursor.execute(
+        "UPDATE credits SET date_cleared = NULL, payment_method_cleared = NULL "
+        "WHERE amount > 0 AND (date_cleared IS NOT NULL OR payment_method_cleared IS NOT NULL)"
+    )
+
+
+def _migrate_restore_transactions_day_index(cursor: sqlite3.Cursor) -> None:
+    """Make sure idx_transactions_day exists and the planner has stats for it.
+
+    Its (date, rowid) order is what lets unfiltered keyset pages and exports
+    walk transactions without a sort; idx_transactions_date leads with date
+    too but orders payment_method before rowid. Migration 8 created it after
+    migration 1's ANALYZE, so older files could still prefer the wider index.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_day ON transactions(date)")
+    cursor.execute("ANALYZE transactions")
+    cursor.execute("ANALYZE expenses")
+
+
+# Accounts every new till starts with
+DEFAULT_USERS = (
+    ("admin", "admin123", "admin"),
+    ("cashier", "cash123", "cashier"),
+)
+
+
+def _seed_default_users(cursor: sqlite3.Cursor) -> None:
+    """Create the default admin and cashier accounts if they are missing."""
+    for username, password, role in DEFAULT_USERS:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE username = ?", (username,))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", (username, password, role))
+
+
+# Signed quantity of a stock_logs row: 'added' counts up, 'used' counts down
+_STOCK_DELTA_SQL = "CASE action WHEN 'added' THEN quantity WHEN 'used' THEN -quantity ELSE 0 END"
+
+
+# Ordered schema migrations: (version, description, function).
+# PRAGMA user_version records the last version applied to a database file;
+# a file at version 0 is new or predates this list and gets
+# _create_base_schema first. Append new steps, never renumber or edit old ones.
+MIGRATIONS = [
+    (1, "secondary indexes for hot query columns", _migrate_hot_query_indexes),
+    (2, "sequences table for TXN/ITEM codes", _migrate_sequences),
+    (3, "transaction_lines table", _migrate_transaction_lines),
+    (4, "credit_links table", _migrate_credit_links),
+    (5, "ledger_totals running totals", _migrate_ledger_totals),
+    (6, "daily_totals rollup and day closures", _migrate_daily_totals),
+    (7, "per-item stock counters", _migrate_stock_counters),
+    (8, "date indexes for keyset pagination", _migrate_listing_indexes),
+    (9, "idempotency keys", _migrate_idempotency_keys),
+    (10, "customers with normalized names", _migrate_customers),
+    (11, "item supplier codes", _migrate_supplier_codes),
+    (12, "historical load checkpoints", _migrate_history_loads),
+    (13, "item reorder levels", _migrate_reorder_levels),
+    (14, "FIFO cost layers and daily COGS", _migrate_cost_layers),
+    (15, "stock log business dates and checkpoints", _migrate_stock_checkpoints),
+    (16, "stock log compaction counts", _migrate_stock_log_entries),
+    (17, "default admin and cashier users", _seed_default_users),
+    (18, "re-open cleared credit accounts that still owe", _migrate_reopen_owing_credits),
+    (19, "transactions date index stats for keyset pages", _migrate_restore_transactions_day_index),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Sequence name -> (code prefix, zero-padded width)
+SEQUENCE_FORMATS = {
+    "transaction": ("TXN", 4),
+    "item": ("ITEM", 3),
+}
+
+# Representative hot queries checked by explain_hot_queries(); each one
+# should be answered from an index rather than a full table scan.
+HOT_QUERIES = [
+    ("ledger_totals", "SELECT total_sales, total_credits, total_expenses, total_transactions FROM ledger_totals WHERE id = 1", ()),
+    ("transactions_by_date", "SELECT COALESCE(SUM(total), 0) FROM transactions WHERE date BETWEEN ? AND ? AND paid = 1", ("2000-01-01", "2000-12-31")),
+    ("period_summary", "SELECT payment_method, SUM(sales_total), SUM(expense_total) FROM daily_totals WHERE day BETWEEN ? AND ? GROUP BY payment_method", ("2000-01-01", "2000-12-31")),
+    ("day_closed", "SELECT 1 FROM day_closures WHERE day = ?", ("",)),
+    ("credits_cleared_on_day", "SELECT payment_method_cleared, SUM(total) FROM transactions WHERE date_cleared = ? GROUP BY payment_method_cleared", ("",)),
+    ("expenses_by_date", "SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE date BETWEEN ? AND ?", ("2000-01-01", "2000-12-31")),
+    ("transactions_page_all", "SELECT id, transaction_id FROM transactions WHERE (date, id) < (?, ?) ORDER BY date DESC, id DESC LIMIT 50", ("2000-01-01", 0)),
+    ("transactions_page", "SELECT id, transaction_id FROM transactions WHERE (date, id) < (?, ?) AND payment_method = ? ORDER BY date DESC, id DESC LIMIT 50", ("2000-01-01", 0, "Cash")),
+    ("expenses_page", "SELECT id, description FROM expenses WHERE (date, id) < (?, ?) ORDER BY date DESC, id DESC LIMIT 50", ("2000-01-01", 0)),
+    ("idempotency_key", "SELECT operation, result FROM idempotency_keys WHERE key = ?", ("",)),
+    ("customer_by_name", "SELECT id, name, outstanding FROM customers WHERE normalized_name = ?", ("",)),
+    ("customer_prefix", "SELECT name, outstanding FROM customers WHERE normalized_name >= ? AND normalized_name < ? ORDER BY normalized_name LIMIT 10", ("a", "b")),
+    ("items_by_supplier_code", "SELECT code, supplier_code FROM items WHERE supplier_code IN (?, ?)", ("", "")),
+    ("items_by_name", "SELECT code, name FROM items WHERE name COLLATE NOCASE IN (?, ?)", ("", "")),
+    ("transactions_by_customer", "SELECT transaction_id, total FROM transactions WHERE customer_name = ?", ("",)),
+    ("item_by_code", "SELECT code, name, type, price, buying_price, selling_price, quantity, unit_type, reorder_level FROM items WHERE code = ?", ("",)),
+    ("low_stock", f"SELECT code, name, quantity, reorder_level FROM items WHERE {LOW_STOCK_CONDITION} ORDER BY quantity, code LIMIT 50", ()),
+    ("lines_by_transaction", "SELECT item_code, service_id, name, quantity, unit_price, unit_cost FROM transaction_lines WHERE transaction_id = ? ORDER BY line_no", ("",)),
+    ("item_sales", """
+        SELECT l.item_code, SUM(l.quantity), SUM(l.quantity * l.unit_price)
+        FROM transactions t
+        JOIN transaction_lines l ON l.transaction_id = t.transaction_id
+        WHERE t.date BETWEEN ? AND ?
+        GROUP BY l.item_code
+    """, ("2000-01-01", "2000-12-31")),
+    ("credit_transactions", """
+        SELECT t.transaction_id, t.total, t.paid
+        FROM credit_links c
+        JOIN transactions t ON t.transaction_id = c.transaction_id
+        WHERE c.customer_name = ?
+    """, ("",)),
+    ("stock_report", "SELECT code, name, received_qty, used_qty, quantity FROM items WHERE type = 'product' ORDER BY code", ()),
+    ("inventory_value", "SELECT item_code, SUM(remaining * unit_cost) FROM cost_layers WHERE remaining > 0 GROUP BY item_code", ()),
+    ("open_cost_layers", "SELECT item_code, id, unit_cost, remaining FROM cost_layers WHERE item_code IN (?, ?) AND remaining > 0 ORDER BY item_code, id", ("", "")),
+    ("stock_checkpoint", "SELECT MAX(day) FROM stock_checkpoints WHERE item_code = ? AND day <= ?", ("", "2000-01-01")),
+    ("stock_replay", f"SELECT SUM({_STOCK_DELTA_SQL}) FROM stock_logs WHERE item_code = ? AND business_date > ? AND business_date <= ?", ("", "2000-01-01", "2000-01-31")),
+    ("stock_log_rebuild", "SELECT SUM(quantity) FROM stock_logs WHERE item_code = ? AND action = 'added'", ("",)),
+]
+
+# Columns iter_transactions can project: name -> (sales expression, expenses expression).
+# "items" is not a column; it is filled from transaction_lines per batch.
+TRANSACTION_COLUMNS = {
+    "id": ("transaction_id", "'EXP' || printf('%04d', id)"),
+    "type": ("'sale'", "'expense'"),
+    "date": ("date", "date"),
+    "total": ("total", "amount"),
+    "payment_method": ("payment_method", "'-'"),
+    "customer_name": ("customer_name", "''"),
+    "paid": ("paid", "1"),
+    "credit_status": ("credit_status", "0"),
+    "date_cleared": ("date_cleared", "NULL"),
+    "payment_method_cleared": ("payment_method_cleared", "NULL"),
+    "description": ("NULL", "description"),
+}
+
+
+def _chunks(values: List, size: int = 500) -> Iterator[List]:
+    """Split ``values`` into IN-clause sized lists."""
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class ConnectionPool:
+    """Hands out one persistent SQLite connection per thread.
+
+    Connections are opened lazily, configured with CONNECTION_PRAGMAS and
+    health-checked with a cheap ``SELECT 1`` when they have been idle for
+    longer than ``health_check_interval`` seconds. A broken connection is
+    discarded and transparently reopened.
+    """
+
+    def __init__(self, path: str, read_only: bool = False, timeout: float = 15, health_check_interval: float = 30.0):
+        self.path = path
+        self.read_only = read_only
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: Dict[int, sqlite3.Connection] = {}
+
+    def _open(self) -> sqlite3.Connection:
+        if self.read_only:
+            uri = Path(os.path.abspath(self.path)).as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, timeout=self.timeout, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        if self.read_only:
+            conn.execute("PRAGMA query_only=ON")
+        with self._lock:
+            # Drop connections owned by threads that have since exited
+            alive = {t.ident for t in threading.enumerate()}
+            for ident in [i for i in self._connections if i not in alive]:
+                self._discard(self._connections.pop(ident))
+            self._connections[threading.get_ident()] = conn
+        return conn
+
+    @staticmethod
+    def _discard(conn: sqlite3.Connection) -> None:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    @staticmethod
+    def _healthy(conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def connection(self) -> sqlite3.Connection:
+        """Return this thread's connection, reopening it if it went bad."""
+        conn = getattr(self._local, "conn", None)
+        now = time.monotonic()
+        if conn is not None and now - self._local.checked_at > self.health_check_interval:
+            if not self._healthy(conn):
+                with self._lock:
+                    self._connections.pop(threading.get_ident(), None)
+                self._discard(conn)
+                conn = None
+            self._local.checked_at = now
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+            self._local.checked_at = now
+        return conn
+
+    def close(self) -> None:
+        """Close every connection handed out by this pool."""
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            self._discard(conn)
+        self._local = threading.local()
+
 
 class Database:
-    def __init__(self):
+    def __init__(self, path: Optional[str] = None):
+        # POS_DB_PATH is read here rather than at import so callers can set it late
+        self.path = path or os.environ.get("POS_DB_PATH", DATABASE_FILE)
+        self._pool = ConnectionPool(self.path)
+        self._read_pool = ConnectionPool(self.path, read_only=True)
+        self._units = threading.local()
         self.init_database()
     
     def _connect(self) -> sqlite3.Connection:
-        """Create a SQLite connection with a sensible timeout."""
-        conn = sqlite3.connect(DATABASE_FILE, timeout=15)
-        return conn
+        """Return this thread's pooled read/write connection."""
+        return self._pool.connection()
+
+    def _depth(self) -> int:
+        """How many units of work are open on this thread's write connection."""
+        return getattr(self._units, "depth", 0)
+
+    @contextmanager
+    def _cursor(self, begin: Optional[str] = None) -> Iterator[sqlite3.Cursor]:
+        """Cursor on the pooled write connection; commits on success, rolls back on error.
+
+        ``begin`` ("IMMEDIATE" or "DEFERRED") opens the transaction explicitly;
+        otherwise sqlite3 opens it at the first write. Inside an open unit of
+        work the block becomes a SAVEPOINT and commits with the outer one.
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        depth = self._depth()
+        savepoint = f"unit_{depth}"
+        if depth:
+            cursor.execute(f"SAVEPOINT {savepoint}")
+        elif begin:
+            cursor.execute(f"BEGIN {begin}")
+        self._units.depth = depth + 1
+        try:
+            yield cursor
+        except BaseException:
+            self._units.depth = depth
+            if not depth:
+                conn.rollback()
+            elif conn.in_transaction:
+                # Undo only this block; the outer unit decides what happens next
+                cursor.execute(f"ROLLBACK TO {savepoint}")
+                cursor.execute(f"RELEASE {savepoint}")
+            raise
+        else:
+            self._units.depth = depth
+            if depth:
+                cursor.execute(f"RELEASE {savepoint}")
+            else:
+                conn.commit()
+        finally:
+            cursor.close()
+
+    def transaction(self, immediate: bool = True):
+        """Unit of work: ``with db.transaction():`` commits once at the end or not at all.
+
+        Every Database method called inside joins it on the same connection,
+        so a multi-step write takes the lock once and commits once. Nested
+        blocks become savepoints. ``immediate`` takes the write lock up front,
+        which read-then-write blocks need to avoid racing other tills.
+        """
+        return self._cursor("IMMEDIATE" if immediate else "DEFERRED")
+
+    @contextmanager
+    def _read_cursor(self) -> Iterator[sqlite3.Cursor]:
+        """Cursor on the pooled read-only connection used by lookups and reports.
+
+        Inside a unit of work reads go to the write connection instead so
+        they see the unit's own uncommitted changes.
+        """
+        if self._depth():
+            cursor = self._connect().cursor()
+        else:
+            cursor = self._read_pool.connection().cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    def close(self) -> None:
+        """Close all pooled connections."""
+        self._pool.close()
+        self._read_pool.close()
     
     def init_database(self):
-        """Initialize the database with required tables."""
+        """Bring the file up to SCHEMA_VERSION.
+
+        A current file costs a PRAGMA read and a one-row probe of
+        deferred_indexes, and takes no lock, so opening it is cheap even on
+        a shared network drive.
+        """
+        self.migrations_applied = []
         conn = self._connect()
-        cursor = conn.cursor()
-        # Improve concurrency
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self.migrations_applied = self.migrate()
+        # A historical load killed mid-way leaves its indexes parked
+        if conn.execute("SELECT 1 FROM deferred_indexes LIMIT 1").fetchone():
+            self.restore_deferred_indexes()
+
+    def migrate(self) -> List[tuple]:
+        """Apply pending migrations; returns the (version, description) pairs applied."""
+        conn = self._connect()
+        # Neither pragma can run inside a transaction. auto_vacuum only takes
+        # effect on a brand-new file; it lets compaction hand pages back to
+        # the OS a little at a time (see compact_stock_logs)
+        if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
         try:
-            cursor.execute("PRAGMA journal_mode=WAL")
-            cursor.execute("PRAGMA busy_timeout=15000")
-        except Exception:
+            conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.OperationalError:
             pass
-        
-        # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                role TEXT NOT NULL DEFAULT 'cashier',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Items table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                code TEXT UNIQUE NOT NULL,
-                name TEXT NOT NULL,
-                type TEXT NOT NULL,
-                price REAL NOT NULL,
-                buying_price REAL DEFAULT 0,
-                selling_price REAL,
-                quantity INTEGER DEFAULT 0,
-                unit_type TEXT DEFAULT 'unit',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Transactions table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                transaction_id TEXT UNIQUE NOT NULL,
-                items TEXT NOT NULL,
-                total REAL NOT NULL,
-                payment_method TEXT NOT NULL,
-                customer_name TEXT DEFAULT '',
-                paid BOOLEAN DEFAULT 1,
-                credit_status BOOLEAN DEFAULT 0,
-                date TEXT,
-                date_cleared TEXT,
-                payment_method_cleared TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Expenses table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                description TEXT NOT NULL,
-                amount REAL NOT NULL,
-                date TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Stock logs table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS stock_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                item_code TEXT NOT NULL,
-                action TEXT NOT NULL,
-                quantity INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        # Take the write lock before reading the version so two
+        # processes starting together cannot apply a migration twice
+        with self._cursor("IMMEDIATE") as cursor:
+            return self._migrate(cursor)
+
+    def _migrate(self, cursor: sqlite3.Cursor) -> List[tuple]:
+        """Apply every migration newer than the file's PRAGMA user_version."""
+        cursor.execute("PRAGMA user_version")
+        current = cursor.fetchone()[0]
+        if current == 0:
+            _create_base_schema(cursor)
+        applied = []
+        for version, description, migrate in MIGRATIONS:
+            if version > current:
+                migrate(cursor)
+                cursor.execute(f"PRAGMA user_version = {int(version)}")
+                applied.append((version, description))
+        return applied
+
+    def _allocate_codes(self, cursor: sqlite3.Cursor, name: str, count: int = 1) -> List[str]:
+        """Reserve ``count`` consecutive codes inside the caller's write transaction.
+
+        The UPDATE takes the write lock, so concurrent tills serialize here
+        and never receive the same code; deleted rows never free a code.
+        """
+        prefix, width = SEQUENCE_FORMATS[name]
+        cursor.execute("UPDATE sequences SET value = value + ? WHERE name = ?", (count, name))
+        cursor.execute("SELECT value FROM sequences WHERE name = ?", (name,))
+        last = cursor.fetchone()[0]
+        return [f"{prefix}{n:0{width}d}" for n in range(last - count + 1, last + 1)]
+
+    def _bump_ledger(self, cursor: sqlite3.Cursor, sales: float = 0.0, credits: float = 0.0, expenses: float = 0.0, transactions: int = 0) -> None:
+        """Apply deltas to the running totals inside the caller's write transaction."""
+        cursor.execute(
+            """
+            UPDATE ledger_totals SET
+                total_sales = total_sales + ?,
+                total_credits = total_credits + ?,
+                total_expenses = total_expenses + ?,
+                total_transactions = total_transactions + ?
+            WHERE id = 1
+            """,
+            (sales, credits, expenses, transactions)
+        )
+
+    def _insert_stock_logs(self, cursor: sqlite3.Cursor, rows: List[tuple]) -> None:
+        """Write (code, action, quantity, business_date) stock_logs rows.
+
+        A movement dated on or before an existing checkpoint (a back-dated
+        sale, say) shifts that item's later checkpoints so they stay exact.
+        """
+        cursor.executemany(
+            "INSERT INTO stock_logs (item_code, action, quantity, business_date) VALUES (?, ?, ?, ?)",
+            rows
+        )
+        cursor.executemany(
+            "UPDATE stock_checkpoints SET quantity = quantity + ? WHERE item_code = ? AND day >= ?",
+            [(quantity if action == "added" else -quantity, code, day)
+             for code, action, quantity, day in rows if action in ("added", "used")]
+        )
+
+    def _log_stock(self, cursor: sqlite3.Cursor, code: str, action: str, quantity: int, business_date: Optional[str] = None) -> None:
+        """Write a stock_logs row and bump the item's matching counter."""
+        self._insert_stock_logs(cursor, [(code, action, quantity, business_date or datetime.now().strftime('%Y-%m-%d'))])
+        if action in ("added", "used"):
+            column = "received_qty" if action == "added" else "used_qty"
+            cursor.execute(f"UPDATE items SET {column} = {column} + ? WHERE code = ?", (quantity, code))
+
+    def _open_layers(self, cursor: sqlite3.Cursor, codes) -> Dict[str, List[list]]:
+        """Open FIFO cost layers per item, oldest first, as [id, unit_cost, remaining, remaining_as_read]."""
+        layers: Dict[str, List[list]] = {code: [] for code in codes}
+        for chunk in _chunks(sorted(layers)):
+            cursor.execute(
+                f"SELECT item_code, id, unit_cost, remaining FROM cost_layers WHERE item_code IN ({','.join('?' * len(chunk))}) AND remaining > 0 ORDER BY item_code, id",
+                chunk
             )
-        ''')
-        
-        # Credits table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS credits (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                customer_name TEXT UNIQUE NOT NULL,
-                amount REAL NOT NULL,
-                transaction_ids TEXT NOT NULL,
-                date_created TEXT,
-                date_cleared TEXT,
-                payment_method_cleared TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            for code, layer_id, unit_cost, remaining in cursor.fetchall():
+                layers[code].append([layer_id, unit_cost, remaining, remaining])
+        return layers
+
+    @staticmethod
+    def _consume_layers(layers: List[list], quantity: int, fallback_cost: float) -> float:
+        """Take ``quantity`` units oldest-first from ``layers`` in place and return their cost.
+
+        Units beyond the open layers (stock older than the layers) are
+        costed at ``fallback_cost``, the item's buying price.
+        """
+        cost = 0.0
+        for layer in layers:
+            if quantity <= 0:
+                break
+            take = min(quantity, layer[2])
+            layer[2] -= take
+            quantity -= take
+            cost += take * layer[1]
+        return cost + max(quantity, 0) * fallback_cost
+
+    def _save_layers(self, cursor: sqlite3.Cursor, layers: Dict[str, List[list]]) -> None:
+        """Write back every layer consumed since _open_layers()."""
+        cursor.executemany(
+            "UPDATE cost_layers SET remaining = ? WHERE id = ?",
+            [(layer[2], layer[0]) for item_layers in layers.values() for layer in item_layers if layer[2] != layer[3]]
+        )
+
+    def _receive_layers(self, cursor: sqlite3.Cursor, receipts: List[tuple]) -> None:
+        """Open a cost layer for each (code, quantity, unit_cost) receipt."""
+        cursor.executemany(
+            "INSERT INTO cost_layers (item_code, unit_cost, quantity, remaining) VALUES (?, ?, ?, ?)",
+            [(code, unit_cost, quantity, quantity) for code, quantity, unit_cost in receipts if quantity > 0]
+        )
+
+    def _restock_layers(self, cursor: sqlite3.Cursor, code: str, before: int, after: int, unit_cost: float) -> float:
+        """Move one item's layers from ``before`` to ``after`` units and return the value change.
+
+        Increases are received at ``unit_cost``; decreases leave oldest-first.
+        """
+        if after > before:
+            self._receive_layers(cursor, [(code, after - before, unit_cost)])
+            return (after - before) * unit_cost
+        if after < before:
+            layers = self._open_layers(cursor, [code])
+            cost = self._consume_layers(layers[code], before - after, unit_cost)
+            self._save_layers(cursor, layers)
+            return -cost
+        return 0.0
+
+    def get_inventory_value(self, code: Optional[str] = None) -> float:
+        """Stock on hand valued at FIFO cost, summed from the open cost layers."""
+        with self._read_cursor() as cursor:
+            if code is None:
+                cursor.execute("SELECT COALESCE(SUM(remaining * unit_cost), 0) FROM cost_layers WHERE remaining > 0")
+            else:
+                cursor.execute("SELECT COALESCE(SUM(remaining * unit_cost), 0) FROM cost_layers WHERE item_code = ? AND remaining > 0", (code,))
+            return cursor.fetchone()[0]
+
+    def adjust_stock_bulk(self, entries: List[tuple], counted: bool = False) -> List[Dict]:
+        """Apply many stock changes in one transaction and return the variance report.
+
+        ``entries`` are (code, quantity) pairs, or (code, quantity, unit_cost)
+        for a delivery at a known cost: a delta to add (negative to remove),
+        or with ``counted=True`` the quantity found at a stock-take. Nothing
+        is written unless every entry is valid. Each report row has the
+        quantity before and after, the variance and its value at cost:
+        receipts at their unit cost (the buying price if none is given),
+        removals at the FIFO cost of the layers they use up.
+        """
+        wanted: Dict[str, int] = {}
+        costs: Dict[str, float] = {}
+        for code, quantity, *cost in entries:
+            if counted:
+                wanted[code] = int(quantity)
+            else:
+                wanted[code] = wanted.get(code, 0) + int(quantity)
+            if cost and cost[0] is not None:
+                costs[code] = float(cost[0])
+        if not wanted:
+            return []
+        with self._cursor("IMMEDIATE") as cursor:
+            found: Dict[str, tuple] = {}
+            for chunk in _chunks(sorted(wanted)):
+                cursor.execute(
+                    f"SELECT code, name, type, quantity, COALESCE(buying_price, 0) FROM items WHERE code IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                found.update((row[0], row[1:]) for row in cursor.fetchall())
+
+            report, errors = [], []
+            for code, quantity in wanted.items():
+                if code not in found:
+                    errors.append(f"Item {code} not found")
+                    continue
+                name, item_type, before, unit_cost = found[code]
+                if item_type != "product":
+                    errors.append(f"Item {code} is not a stocked product")
+                    continue
+                after = quantity if counted else before + quantity
+                if after < 0:
+                    errors.append(f"Insufficient stock for {code}" if not counted else f"Counted quantity for {code} cannot be negative")
+                    continue
+                report.append({
+                    "code": code,
+                    "name": name,
+                    "before": before,
+                    "after": after,
+                    "variance": after - before,
+                    "variance_value": (after - before) * costs.get(code, unit_cost),
+                })
+            if errors:
+                raise ValueError("; ".join(errors))
+
+            changed = [r for r in report if r["variance"]]
+            self._receive_layers(cursor, [(r["code"], r["variance"], costs.get(r["code"], found[r["code"]][3])) for r in changed])
+            layers = self._open_layers(cursor, [r["code"] for r in changed if r["variance"] < 0])
+            for r in changed:
+                if r["variance"] < 0:
+                    r["variance_value"] = -self._consume_layers(layers[r["code"]], -r["variance"], found[r["code"]][3])
+            self._save_layers(cursor, layers)
+            cursor.executemany(
+                "UPDATE items SET quantity = quantity + ?, received_qty = received_qty + ?, used_qty = used_qty + ? WHERE code = ?",
+                [(r["variance"], max(r["variance"], 0), max(-r["variance"], 0), r["code"]) for r in changed]
             )
-        ''')
-        
-        # System settings table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                key TEXT UNIQUE NOT NULL,
-                value TEXT NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            today = datetime.now().strftime('%Y-%m-%d')
+            self._insert_stock_logs(
+                cursor,
+                [(r["code"], "added" if r["variance"] > 0 else "used", abs(r["variance"]), today) for r in changed]
             )
-        ''')
-
-        # Services table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS services (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                service_name TEXT UNIQUE NOT NULL,
-                price REAL NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        return report
+
+    def compact_stock_logs(self, before: str, items_per_batch: int = 50, vacuum_pages: int = 500) -> Dict[str, int]:
+        """Fold stock_logs rows dated before ``before`` into one row per item, day and action.
+
+        Quantities are summed, so received/used totals and stock_as_of()
+        stay exact; ``entries`` records how many movements a row stands for.
+        Work is done a batch of items per commit so sales are never blocked
+        for long. With auto_vacuum=INCREMENTAL the freed pages are then
+        returned to the file system ``vacuum_pages`` at a time, each step
+        its own short write.
+        """
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT DISTINCT item_code FROM stock_logs ORDER BY item_code")
+            codes = [row[0] for row in cursor.fetchall()]
+            cursor.execute("PRAGMA auto_vacuum")
+            incremental = cursor.fetchone()[0] == 2
+        totals = {"items": len(codes), "groups": 0, "rows_removed": 0, "pages_freed": 0}
+        for chunk in _chunks(codes, items_per_batch):
+            with self._cursor("IMMEDIATE") as cursor:
+                cursor.execute(
+                    f"""
+                    SELECT item_code, business_date, action, SUM(quantity), SUM(entries), COUNT(*), MIN(id), MIN(created_at)
+                    FROM stock_logs
+                    WHERE item_code IN ({','.join('?' * len(chunk))}) AND business_date < ?
+                    GROUP BY item_code, business_date, action
+                    HAVING COUNT(*) > 1
+                    """,
+                    (*chunk, before)
+                )
+                groups = cursor.fetchall()
+                cursor.executemany(
+                    "DELETE FROM stock_logs WHERE item_code = ? AND business_date = ? AND action = ?",
+                    [g[:3] for g in groups]
+                )
+                # The folded row keeps the id of the group's first movement so log order is stable
+                cursor.executemany(
+                    "INSERT INTO stock_logs (id, item_code, business_date, action, quantity, entries, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(g[6], g[0], g[1], g[2], g[3], g[4], g[7]) for g in groups]
+                )
+            totals["groups"] += len(groups)
+            totals["rows_removed"] += sum(g[5] - 1 for g in groups)
+            if incremental and groups:
+                totals["pages_freed"] += self._incremental_vacuum(vacuum_pages)
+        while incremental:
+            freed = self._incremental_vacuum(vacuum_pages)
+            if not freed:
+                break
+            totals["pages_freed"] += freed
+        return totals
+
+    def _incremental_vacuum(self, pages: int) -> int:
+        """Release up to ``pages`` free pages back to the file system; return how many went."""
+        conn = self._connect()
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # executescript steps the pragma to completion; execute() frees one page
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def storage_stats(self) -> Dict[str, int]:
+        """Page counts and vacuum mode of the database file."""
+        with self._read_cursor() as cursor:
+            stats = {}
+            for pragma in ("page_size", "page_count", "freelist_count", "auto_vacuum"):
+                cursor.execute(f"PRAGMA {pragma}")
+                stats[pragma] = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) FROM stock_logs")
+            stats["stock_log_rows"] = cursor.fetchone()[0]
+        return stats
+
+    def enable_incremental_vacuum(self) -> None:
+        """Switch an existing file to auto_vacuum=INCREMENTAL.
+
+        Needs a one-off full VACUUM, which rewrites the whole file and
+        must not run while other tills are connected.
+        """
+        conn = self._connect()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+    def rebuild_stock_counters(self) -> None:
+        """Recompute every item's received/used counters from the full log."""
+        with self._cursor("IMMEDIATE") as cursor:
+            _rebuild_stock_counters(cursor)
+
+    def _bump_daily(self, cursor: sqlite3.Cursor, day: str, payment_method: str, **deltas: float) -> None:
+        """Add deltas (keyed by DAILY_FIELDS) to one day's rollup row."""
+        values = [deltas.get(f, 0) for f in DAILY_FIELDS]
+        cursor.execute(
+            f"""
+            INSERT INTO daily_totals (day, payment_method, {", ".join(DAILY_FIELDS)}) VALUES (?, ?, {", ".join("?" * len(DAILY_FIELDS))})
+            ON CONFLICT(day, payment_method) DO UPDATE SET
+                {", ".join(f"{f} = {f} + excluded.{f}" for f in DAILY_FIELDS)}
+            """,
+            (day, payment_method, *values)
+        )
+
+    def _ensure_days_open(self, cursor: sqlite3.Cursor, days) -> None:
+        """Reject a write that would change a closed day."""
+        days = sorted({d for d in days if d})
+        if not days:
+            return
+        cursor.execute(f"SELECT day FROM day_closures WHERE day IN ({','.join(['?']*len(days))}) ORDER BY day", days)
+        closed = [row[0] for row in cursor.fetchall()]
+        if closed:
+            raise ValueError(f"Day {closed[0]} is closed; re-open it before making changes")
+
+    def _replay(self, cursor: sqlite3.Cursor, key: Optional[str], operation: str) -> Any:
+        """Stored result for an idempotency key, or None when the key is new."""
+        if not key:
+            return None
+        cursor.execute("SELECT operation, result FROM idempotency_keys WHERE key = ?", (key,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        if row[0] != operation:
+            raise ValueError(f"Idempotency key already used for {row[0]}")
+        return json.loads(row[1])
+
+    def _remember(self, cursor: sqlite3.Cursor, key: Optional[str], operation: str, result: Any) -> None:
+        """Store a result under its idempotency key, in the same transaction as the write."""
+        if key:
+            cursor.execute(
+                "INSERT INTO idempotency_keys (key, operation, result) VALUES (?, ?, ?)",
+                (key, operation, json.dumps(result))
             )
-        ''')
-        
-        # Backward-compatible migrations (ALTER TABLE safe attempts)
-        def try_alter(sql: str):
-            try:
-                cursor.execute(sql)
-            except Exception:
-                pass
-
-        try_alter("ALTER TABLE items ADD COLUMN unit_type TEXT DEFAULT 'unit'")
-        # New price fields (safe if already exist)
-        try_alter("ALTER TABLE items ADD COLUMN buying_price REAL DEFAULT 0")
-        try_alter("ALTER TABLE items ADD COLUMN selling_price REAL")
-        try_alter("ALTER TABLE transactions ADD COLUMN date TEXT")
-        try_alter("ALTER TABLE transactions ADD COLUMN date_cleared TEXT")
-        try_alter("ALTER TABLE transactions ADD COLUMN payment_method_cleared TEXT")
-        try_alter("ALTER TABLE expenses ADD COLUMN date TEXT")
-        try_alter("ALTER TABLE credits ADD COLUMN date_created TEXT")
-        try_alter("ALTER TABLE credits ADD COLUMN date_cleared TEXT")
-        try_alter("ALTER TABLE credits ADD COLUMN payment_method_cleared TEXT")
-        # Services table exists by creation above; no alters needed
-
-        conn.commit()
-        conn.close()
-        
-        # Insert default admin user if not exists
-        self.create_default_users()
-    
-    def create_default_users(self):
-        """Create default admin and cashier users."""
+
+    def close_day(self, day: str, closed_by: str = "") -> Dict:
+        """Freeze a day's rollup after recomputing it exactly from the base tables."""
+        with self._cursor("IMMEDIATE") as cursor:
+            cursor.execute("SELECT 1 FROM day_closures WHERE day = ?", (day,))
+            if cursor.fetchone():
+                raise ValueError(f"Day {day} is already closed")
+            _rebuild_daily_totals(cursor, day)
+            cursor.execute("INSERT INTO day_closures (day, closed_by) VALUES (?, ?)", (day, closed_by))
+            self._write_stock_checkpoint(cursor, day)
+        return self.get_period_summary(day, day)
+
+    def reopen_day(self, day: str) -> bool:
+        """Re-open a closed day, recomputing just that day's rollup."""
+        with self._cursor("IMMEDIATE") as cursor:
+            cursor.execute("DELETE FROM day_closures WHERE day = ?", (day,))
+            if cursor.rowcount == 0:
+                return False
+            _rebuild_daily_totals(cursor, day)
+        return True
+
+    def _write_stock_checkpoint(self, cursor: sqlite3.Cursor, day: str) -> int:
+        """Record every product's quantity at the end of ``day``.
+
+        Worked back from the live quantity by undoing movements dated after
+        ``day``, so a checkpoint can be taken late (or for a past day).
+        """
+        cursor.execute(f"""
+            INSERT OR REPLACE INTO stock_checkpoints (item_code, day, quantity)
+            SELECT code, ?, quantity - COALESCE((
+                SELECT SUM({_STOCK_DELTA_SQL}) FROM stock_logs l
+                WHERE l.item_code = items.code AND l.business_date > ?
+            ), 0)
+            FROM items WHERE type = 'product'
+        """, (day, day))
+        return cursor.rowcount
+
+    def checkpoint_stock(self, day: Optional[str] = None) -> int:
+        """Checkpoint all product quantities at the end of ``day`` (default today)."""
+        with self._cursor("IMMEDIATE") as cursor:
+            return self._write_stock_checkpoint(cursor, day or datetime.now().strftime('%Y-%m-%d'))
+
+    def stock_as_of(self, day: str, item_code: Optional[str] = None) -> List[Dict]:
+        """Each product's quantity at the end of ``day``.
+
+        Starts from the item's latest checkpoint on or before ``day`` and
+        replays only the movements logged after it, so the cost grows with
+        the time since that checkpoint, not with the whole history. With no
+        checkpoint that early it works back from the live quantity instead.
+        Items deleted since are not listed. A movement dated before the
+        stock it used was received (a back-dated sale, say) can drive the
+        replay below zero; the quantity is then reported as 0 and the
+        missing units as ``shortfall`` so callers can flag the log.
+        """
+        where, params = ["i.type = 'product'"], {"day": day, "code": item_code}
+        if item_code:
+            where.append("i.code = :code")
+        with self._read_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT code, name, CASE
+                    WHEN cp_day IS NULL THEN quantity - COALESCE((
+                        SELECT SUM({_STOCK_DELTA_SQL}) FROM stock_logs
+                        WHERE item_code = code AND business_date > :day
+                    ), 0)
+                    ELSE cp_quantity + COALESCE((
+                        SELECT SUM({_STOCK_DELTA_SQL}) FROM stock_logs
+                        WHERE item_code = code AND business_date > cp_day AND business_date <= :day
+                    ), 0)
+                END, cp_day
+                FROM (
+                    SELECT i.code AS code, i.name AS name, i.quantity AS quantity, c.day AS cp_day, c.quantity AS cp_quantity
+                    FROM items i
+                    LEFT JOIN stock_checkpoints c ON c.item_code = i.code AND c.day = (
+                        SELECT MAX(day) FROM stock_checkpoints WHERE item_code = i.code AND day <= :day
+                    )
+                    WHERE {" AND ".join(where)}
+                )
+                ORDER BY code
+            """, params)
+            rows = cursor.fetchall()
+        return [{"code": r[0], "name": r[1], "quantity": max(r[2], 0), "shortfall": max(-r[2], 0), "checkpoint": r[3]}
+                for r in rows]
+
+    def is_day_closed(self, day: str) -> bool:
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT 1 FROM day_closures WHERE day = ?", (day,))
+            return cursor.fetchone() is not None
+
+    def list_closed_days(self, limit: int = 30) -> List[Dict]:
+        """Most recently closed business days."""
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT day, closed_by, closed_at FROM day_closures ORDER BY day DESC LIMIT ?", (limit,))
+            rows = cursor.fetchall()
+        return [{"day": r[0], "closed_by": r[1], "closed_at": r[2]} for r in rows]
+
+    def get_period_summary(self, from_date: Optional[str] = None, to_date: Optional[str] = None) -> Dict:
+        """Sales summary for a date range, read from the daily rollup.
+
+        ``total_sales`` counts money received in the range: non-credit sales
+        plus credits cleared in it. ``total_credits`` is credit issued in
+        the range, not the outstanding balance.
+        """
+        where, params = [], []
+        if from_date:
+            where.append("day >= ?")
+            params.append(from_date)
+        if to_date:
+            where.append("day <= ?")
+            params.append(to_date)
+        with self._read_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT payment_method, {", ".join(f"SUM({f})" for f in DAILY_FIELDS)}
+                FROM daily_totals
+                {"WHERE " + " AND ".join(where) if where else ""}
+                GROUP BY payment_method
+                ORDER BY payment_method
+            """, params)
+            rows = cursor.fetchall()
+        by_method = {row[0]: dict(zip(DAILY_FIELDS, row[1:])) for row in rows}
+        totals = {f: sum(m[f] for m in by_method.values()) for f in DAILY_FIELDS}
+        total_sales = totals["sales_total"] + totals["cleared_total"]
+        return {
+            "from_date": from_date,
+            "to_date": to_date,
+            "total_sales": total_sales,
+            "total_credits": totals["credit_total"],
+            "total_expenses": totals["expense_total"],
+            "system_balance": total_sales - totals["expense_total"],
+            "total_transactions": totals["sale_count"],
+            "total_cogs": totals["cogs"],
+            "gross_profit": totals["sales_total"] + totals["credit_total"] - totals["cogs"],
+            "by_payment_method": by_method,
+        }
+
+    def verify_ledger(self, repair: bool = False) -> Dict:
+        """Recompute the ledger from scratch and report drift from the stored totals."""
+        # One transaction so stored and recomputed totals share a snapshot
+        with self._cursor("IMMEDIATE" if repair else "DEFERRED") as cursor:
+            cursor.execute("SELECT total_sales, total_credits, total_expenses, total_transactions FROM ledger_totals WHERE id = 1")
+            stored = dict(zip(LEDGER_FIELDS, cursor.fetchone() or (0, 0, 0, 0)))
+            actual = _compute_ledger(cursor)
+            drift = {f: actual[f] - stored[f] for f in LEDGER_FIELDS if abs(actual[f] - stored[f]) > 0.005}
+            if repair and drift:
+                _write_ledger(cursor, actual)
+        return {"stored": stored, "actual": actual, "drift": drift, "ok": not drift, "repaired": bool(repair and drift)}
+
+    def schema_version(self) -> int:
+        """Return the migration version recorded in the database file."""
+        with self._read_cursor() as cursor:
+            cursor.execute("PRAGMA user_version")
+            return cursor.fetchone()[0]
+
+    def explain_hot_queries(self) -> List[Dict]:
+        """Run EXPLAIN QUERY PLAN over HOT_QUERIES and flag any full table scan."""
+        results = []
+        with self._read_cursor() as cursor:
+            for name, sql, params in HOT_QUERIES:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+                plan = [row[3] for row in cursor.fetchall()]
+                # A bare "SCAN <table>" means no index is used for that table
+                full_scans = [d for d in plan if d.startswith("SCAN ") and " USING " not in d]
+                results.append({"name": name, "sql": " ".join(sql.split()), "plan": plan, "uses_index": not full_scans})
+        return results
+
+    @contextmanager
+    def bulk_load_mode(self, cache_kib: int = 256000) -> Iterator[None]:
+        """Relax durability on this thread's write connection for a bulk load.
+
+        synchronous=OFF skips the fsync per commit and a bigger page cache
+        keeps index pages in memory. WAL stays on: switching journal modes
+        needs exclusive access and a crash mid-load must not corrupt the
+        file. Only a power cut can lose the last few committed batches,
+        which the load checkpoint then replays.
+        """
         conn = self._connect()
-        cursor = conn.cursor()
-        
-        # Check if admin user exists
-        cursor.execute("SELECT COUNT(*) FROM users WHERE username = 'admin'")
-        if cursor.fetchone()[0] == 0:
+        synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+        cache_size = conn.execute("PRAGMA cache_size").fetchone()[0]
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute(f"PRAGMA cache_size=-{int(cache_kib)}")
+        try:
+            yield
+        finally:
+            conn.execute(f"PRAGMA synchronous={int(synchronous)}")
+            conn.execute(f"PRAGMA cache_size={int(cache_size)}")
+
+    def defer_indexes(self, tables: List[str]) -> List[str]:
+        """Drop the secondary indexes on ``tables``, parking their SQL in deferred_indexes.
+
+        Unique indexes stay, since they enforce constraints. Call
+        restore_deferred_indexes() to rebuild them in one sorted pass.
+        """
+        placeholders = ",".join("?" * len(tables))
+        with self._cursor("IMMEDIATE") as cursor:
             cursor.execute(
-                "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                ("admin", "admin123", "admin")
+                f"SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({placeholders})",
+                tables
             )
-        
-        # Check if cashier user exists
-        cursor.execute("SELECT COUNT(*) FROM users WHERE username = 'cashier'")
-        if cursor.fetchone()[0] == 0:
+            indexes = [(name, sql) for name, sql in cursor.fetchall() if not sql.upper().startswith("CREATE UNIQUE")]
+            for name, sql in indexes:
+                cursor.execute("INSERT OR REPLACE INTO deferred_indexes (name, sql) VALUES (?, ?)", (name, sql))
+                cursor.execute(f'DROP INDEX "{name}"')
+        return [name for name, _sql in indexes]
+
+    def restore_deferred_indexes(self) -> List[str]:
+        """Recreate every index parked by defer_indexes() and refresh planner stats."""
+        with self._cursor("IMMEDIATE") as cursor:
+            cursor.execute("SELECT name, sql FROM deferred_indexes ORDER BY name")
+            indexes = cursor.fetchall()
+            for name, sql in indexes:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,))
+                if not cursor.fetchone():
+                    cursor.execute(sql)
+            cursor.execute("DELETE FROM deferred_indexes")
+            if indexes:
+                cursor.execute("ANALYZE")
+        return [name for name, _sql in indexes]
+
+    def load_checkpoint(self, source: str) -> Optional[Dict]:
+        """Progress of a historical load, or None if ``source`` was never started."""
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT kind, rows_done, done, updated_at FROM load_checkpoints WHERE source = ?", (source,))
+            row = cursor.fetchone()
+        if not row:
+            return None
+        return {"source": source, "kind": row[0], "rows_done": row[1], "done": bool(row[2]), "updated_at": row[3]}
+
+    def load_history_batch(self, source: str, kind: str, rows: List[Dict], rows_done: int) -> None:
+        """Insert one batch of historical sales or expenses and advance the checkpoint.
+
+        Rows go straight into the base tables: no stock movement, ledger or
+        rollup bumps (finish_history_load() rebuilds those once). The batch
+        and its checkpoint commit together, so a resumed load never doubles up.
+        """
+        with self._cursor("IMMEDIATE") as cursor:
+            if kind == "sales":
+                missing = sum(1 for r in rows if not r.get("transaction_id"))
+                codes = iter(self._allocate_codes(cursor, "transaction", missing) if missing else ())
+                txn_rows = []
+                highest = 0
+                for r in rows:
+                    txn_id = r.get("transaction_id") or next(codes)
+                    if txn_id.startswith("TXN") and txn_id[3:].isdigit():
+                        highest = max(highest, int(txn_id[3:]))
+                    txn_rows.append((
+                        txn_id, r["total"], r["payment_method"], r.get("customer_name", ""),
+                        r["date_cleared"] or None, r["payment_method_cleared"] or None,
+                        r["date"], r["date"] + " 00:00:00",
+                    ))
+                cursor.executemany(
+                    "INSERT INTO transactions (transaction_id, items, total, payment_method, customer_name, paid, credit_status, "
+                    "date_cleared, payment_method_cleared, date, created_at) VALUES (?, '[]', ?, ?, ?, 1, 0, ?, ?, ?, ?)",
+                    txn_rows
+                )
+                # Imported TXN codes must never be handed out again by the sequence
+                cursor.execute("UPDATE sequences SET value = MAX(value, ?) WHERE name = 'transaction'", (highest,))
+            elif kind == "expenses":
+                cursor.executemany(
+                    "INSERT INTO expenses (description, amount, date, created_at) VALUES (?, ?, ?, ?)",
+                    [(r["description"], r["amount"], r["date"], r["date"] + " 00:00:00") for r in rows]
+                )
+            else:
+                raise ValueError(f"Unknown history kind: {kind}")
             cursor.execute(
-                "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                ("cashier", "cash123", "cashier")
+                """
+                INSERT INTO load_checkpoints (source, kind, rows_done) VALUES (?, ?, ?)
+                ON CONFLICT(source) DO UPDATE SET rows_done = excluded.rows_done, updated_at = CURRENT_TIMESTAMP
+                """,
+                (source, kind, rows_done)
             )
-        
-        conn.commit()
-        conn.close()
+
+    def finish_history_load(self, source: str) -> None:
+        """Rebuild parked indexes, the ledger and open days' rollups; mark the load done."""
+        self.restore_deferred_indexes()
+        with self._cursor("IMMEDIATE") as cursor:
+            _write_ledger(cursor, _compute_ledger(cursor))
+            _rebuild_daily_totals(cursor, open_only=True)
+            cursor.execute("UPDATE load_checkpoints SET done = 1, updated_at = CURRENT_TIMESTAMP WHERE source = ?", (source,))
+
+    def create_default_users(self):
+        """Create default admin and cashier users (new files get them from migration 17)."""
+        with self._cursor() as cursor:
+            _seed_default_users(cursor)
     
     def authenticate_user(self, username: str, password: str) -> Optional[Dict]:
         """Authenticate user and return user data if valid."""
-        conn = self._connect()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT username, role FROM users WHERE username = ? AND password = ?",
-            (username, password)
-        )
-        result = cursor.fetchone()
-        conn.close()
+        with self._read_cursor() as cursor:
+            cursor.execute(
+                "SELECT username, role FROM users WHERE username = ? AND password = ?",
+                (username, password)
+            )
+            result = cursor.fetchone()
         
         if result:
             return {"username": result[0], "role": result[1]}
         return None
     
-    def add_item(self, name: str, item_type: str, price: float, quantity: int = 0, unit_type: str = 'unit', buying_price: float = 0.0, selling_price: Optional[float] = None) -> Dict:
+    def add_item(self, name: str, item_type: str, price: float, quantity: int = 0, unit_type: str = 'unit', buying_price: float = 0.0, selling_price: Optional[float] = None,
+                 reorder_level: int = 0) -> Dict:
         """Add a new item to the database."""
-        conn = self._connect()
-        cursor = conn.cursor()
-        
-        # Generate item code
-        cursor.execute("SELECT COUNT(*) FROM items")
-        count = cursor.fetchone()[0]
-        code = f"ITEM{count + 1:03d}"
-        
-        eff_selling = selling_price if selling_price is not None else price
-        cursor.execute(
-            "INSERT INTO items (code, name, type, price, buying_price, selling_price, quantity, unit_type) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (code, name, item_type, price, buying_price, eff_selling, quantity, unit_type)
-        )
-        
-        if quantity > 0:
-            self.log_stock_action(code, "added", quantity)
-        
-        conn.commit()
-        conn.close()
+        with self._cursor() as cursor:
+            code = self._allocate_codes(cursor, "item")[0]
+            
+            eff_selling = selling_price if selling_price is not None else price
+            cursor.execute(
+                "INSERT INTO items (code, name, type, price, buying_price, selling_price, quantity, unit_type, reorder_level) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (code, name, item_type, price, buying_price, eff_selling, quantity, unit_type, reorder_level)
+            )
+            
+            # Log on the same connection so the insert and its log commit together
+            if quantity > 0:
+                self._log_stock(cursor, code, "added", quantity)
+                if item_type == "product":
+                    self._receive_layers(cursor, [(code, quantity, buying_price)])
         
-        return {"code": code, "name": name, "type": item_type, "price": price, "buying_price": buying_price, "selling_price": eff_selling, "quantity": quantity, "unit_type": unit_type}
+        return {"code": code, "name": name, "type": item_type, "price": price, "buying_price": buying_price, "selling_price": eff_selling, "quantity": quantity, "unit_type": unit_type,
+                "reorder_level": reorder_level}
+
+    def upsert_items(self, records: List[Dict]) -> Dict[str, int]:
+        """Insert or update a chunk of catalogue rows in one transaction.
+
+        A record matches an existing item by ``supplier_code`` first, then by
+        name (case-insensitive), and records in the same chunk match each
+        other the same way, the later one winning. Matches get their name,
+        type and prices updated; their stock is left alone. New items get
+        codes from one preallocated block and their ``quantity`` as opening
+        stock.
+        """
+        if not records:
+            return {"inserted": 0, "updated": 0}
+        with self._cursor("IMMEDIATE") as cursor:
+            by_supplier: Dict[str, str] = {}
+            supplier_codes = sorted({r["supplier_code"] for r in records if r.get("supplier_code")})
+            for chunk in _chunks(supplier_codes):
+                cursor.execute(
+                    f"SELECT supplier_code, code FROM items WHERE supplier_code IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                by_supplier.update(cursor.fetchall())
+            by_name: Dict[str, str] = {}
+            names = sorted({r["name"] for r in records})
+            for chunk in _chunks(names):
+                cursor.execute(
+                    f"SELECT name, code FROM items WHERE name COLLATE NOCASE IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                by_name.update((name.casefold(), code) for name, code in cursor.fetchall())
+
+            # Match keys -> existing item code, or index into ``new`` for an
+            # item first seen earlier in this chunk; a later row wins
+            matches: Dict[tuple, Any] = {("supplier", sc): code for sc, code in by_supplier.items()}
+            matches.update((("name", name), code) for name, code in by_name.items())
+            updates: Dict[str, Dict] = {}
+            new: List[Dict] = []
+            for r in records:
+                supplier_code, name = r.get("supplier_code"), r["name"].casefold()
+                target = matches.get(("supplier", supplier_code)) if supplier_code else None
+                if target is None:
+                    target = matches.get(("name", name))
+                if target is None:
+                    target = len(new)
+                    new.append(r)
+                elif isinstance(target, int):
+                    new[target] = r | {"supplier_code": supplier_code or new[target].get("supplier_code")}
+                else:
+                    earlier = updates.get(target, {})
+                    updates[target] = r | {"code": target, "supplier_code": supplier_code or earlier.get("supplier_code")}
+                if supplier_code:
+                    matches[("supplier", supplier_code)] = target
+                matches[("name", name)] = target
+            updates = list(updates.values())
+
+            cursor.executemany(
+                """
+                UPDATE items SET name = ?, type = ?, price = ?, buying_price = ?, selling_price = ?,
+                    supplier_code = COALESCE(?, supplier_code),
+                    reorder_level = CASE WHEN ? = 'product' THEN reorder_level ELSE 0 END
+                WHERE code = ?
+                """,
+                [(r["name"], r["type"], r["price"], r["buying_price"], r["selling_price"], r.get("supplier_code"), r["type"], r["code"])
+                 for r in updates]
+            )
+            codes = self._allocate_codes(cursor, "item", len(new)) if new else []
+            cursor.executemany(
+                """
+                INSERT INTO items (code, name, type, price, buying_price, selling_price, quantity, unit_type, supplier_code, received_qty)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 'unit', ?, ?)
+                """,
+                [(code, r["name"], r["type"], r["price"], r["buying_price"], r["selling_price"], r["quantity"],
+                  r.get("supplier_code"), r["quantity"])
+                 for code, r in zip(codes, new)]
+            )
+            today = datetime.now().strftime('%Y-%m-%d')
+            self._insert_stock_logs(
+                cursor,
+                [(code, "added", r["quantity"], today) for code, r in zip(codes, new) if r["quantity"] > 0]
+            )
+            self._receive_layers(cursor, [(code, r["quantity"], r["buying_price"]) for code, r in zip(codes, new) if r["type"] == "product"])
+        return {"inserted": len(new), "updated": len(updates)}
 
     # Services CRUD
     def add_service(self, service_name: str, price: float) -> Dict:
-        conn = self._connect()
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO services (service_name, price) VALUES (?, ?)", (service_name, price))
-        conn.commit()
-        service_id = cursor.lastrowid
-        conn.close()
+        with self._cursor() as cursor:
+            cursor.execute("INSERT INTO services (service_name, price) VALUES (?, ?)", (service_name, price))
+            service_id = cursor.lastrowid
         return {"id": service_id, "service_name": service_name, "price": price}
 
     def list_services(self) -> List[Dict]:
-        conn = self._connect()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, service_name, price FROM services ORDER BY service_name")
-        rows = cursor.fetchall()
-        conn.close()
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT id, service_name, price FROM services ORDER BY service_name")
+            rows = cursor.fetchall()
         return [{"id": r[0], "service_name": r[1], "price": r[2]} for r in rows]
 
     def update_service(self, service_id: int, service_name: str, price: float) -> None:
-        conn = self._connect()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE services SET service_name = ?, price = ? WHERE id = ?", (service_name, price, service_id))
-        conn.commit()
-        conn.close()
+        with self._cursor() as cursor:
+            cursor.execute("UPDATE services SET service_name = ?, price = ? WHERE id = ?", (service_name, price, service_id))
 
     def delete_service(self, service_id: int) -> None:
-        conn = self._connect()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM services WHERE id = ?", (service_id,))
-        conn.commit()
-        conn.close()
+        with self._cursor() as cursor:
+            cursor.execute("DELETE FROM services WHERE id = ?", (service_id,))
     
     def get_item(self, code: str) -> Optional[Dict]:
         """Get item by code."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT code, name, type, price, buying_price, selling_price, quantity, unit_type FROM items WHERE code = ?",
-            (code,)
-        )
-        result = cursor.fetchone()
-        conn.close()
+        with self._read_cursor() as cursor:
+            cursor.execute(
+                "SELECT code, name, type, price, buying_price, selling_price, quantity, unit_type, reorder_level FROM items WHERE code = ?",
+                (code,)
+            )
+            result = cursor.fetchone()
         
         if result:
             return {
@@ -275,18 +1677,16 @@ class Database:
                 "buying_price": result[4] if len(result) > 4 else 0.0,
                 "selling_price": result[5] if len(result) > 5 and result[5] is not None else result[3],
                 "quantity": result[6] if len(result) > 6 else 0,
-                "unit_type": result[7] if len(result) > 7 else 'unit'
+                "unit_type": result[7] if len(result) > 7 else 'unit',
+                "reorder_level": result[8]
             }
         return None
     
     def list_items(self) -> List[Dict]:
         """Get all items."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT code, name, type, price, buying_price, selling_price, quantity, unit_type FROM items ORDER BY code")
-        results = cursor.fetchall()
-        conn.close()
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT code, name, type, price, buying_price, selling_price, quantity, unit_type, reorder_level FROM items ORDER BY code")
+            results = cursor.fetchall()
         
         return [
             {
@@ -297,207 +1697,372 @@ class Database:
                 "buying_price": row[4] if len(row) > 4 else 0.0,
                 "selling_price": row[5] if len(row) > 5 and row[5] is not None else row[3],
                 "quantity": row[6] if len(row) > 6 else 0,
-                "unit_type": row[7] if len(row) > 7 else 'unit'
+                "unit_type": row[7] if len(row) > 7 else 'unit',
+                "reorder_level": row[8]
             }
             for row in results
         ]
+
+    def list_low_stock(self, limit: int = 50) -> List[Dict]:
+        """Products at or below their reorder level, lowest stock first.
+
+        Read from the idx_items_low_stock partial index, so the cost depends
+        on how many items are low, not on the size of the catalogue.
+        """
+        with self._read_cursor() as cursor:
+            cursor.execute(
+                f"SELECT code, name, quantity, reorder_level FROM items WHERE {LOW_STOCK_CONDITION} ORDER BY quantity, code LIMIT ?",
+                (limit,)
+            )
+            rows = cursor.fetchall()
+        return [{"code": r[0], "name": r[1], "quantity": r[2], "reorder_level": r[3]} for r in rows]
     
     def update_item_quantity(self, code: str, new_quantity: int):
-        """Update item quantity."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "UPDATE items SET quantity = ? WHERE code = ?",
-            (new_quantity, code)
-        )
-        
-        conn.commit()
-        conn.close()
+        """Update item quantity, receiving or releasing FIFO cost layers to match."""
+        with self._cursor("IMMEDIATE") as cursor:
+            cursor.execute("SELECT type, quantity, COALESCE(buying_price, 0) FROM items WHERE code = ?", (code,))
+            row = cursor.fetchone()
+            cursor.execute(
+                "UPDATE items SET quantity = ? WHERE code = ?",
+                (new_quantity, code)
+            )
+            if row and row[0] == "product":
+                self._restock_layers(cursor, code, row[1], new_quantity, row[2])
 
-    def update_item(self, code: str, name: str, quantity: int, buying_price: float, selling_price: float) -> None:
-        """Update core fields of an item."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE items SET name = ?, quantity = ?, buying_price = ?, selling_price = ?, price = ? WHERE code = ?",
-            (name, quantity, buying_price, selling_price, selling_price, code)
-        )
-        conn.commit()
-        conn.close()
+    def update_item(self, code: str, name: str, quantity: int, buying_price: float, selling_price: float,
+                    reorder_level: Optional[int] = None) -> None:
+        """Update core fields of an item; ``reorder_level`` is left alone when None.
+
+        The buying price applies to stock received from now on; existing
+        cost layers keep the cost they were received at.
+        """
+        with self._cursor("IMMEDIATE") as cursor:
+            cursor.execute("SELECT type, quantity FROM items WHERE code = ?", (code,))
+            row = cursor.fetchone()
+            if row and row[0] == "product":
+                self._restock_layers(cursor, code, row[1], quantity, buying_price)
+                # Log edits too, so stock_as_of() can replay them
+                if quantity != row[1]:
+                    self._log_stock(cursor, code, "added" if quantity > row[1] else "used", abs(quantity - row[1]))
+            cursor.execute(
+                "UPDATE items SET name = ?, quantity = ?, buying_price = ?, selling_price = ?, price = ?, "
+                "reorder_level = CASE WHEN type = 'product' THEN COALESCE(?, reorder_level) ELSE 0 END WHERE code = ?",
+                (name, quantity, buying_price, selling_price, selling_price, reorder_level, code)
+            )
 
     def delete_items(self, codes: List[str]) -> int:
         """Delete items by codes, return number deleted."""
         if not codes:
             return 0
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        q = f"DELETE FROM items WHERE code IN ({','.join(['?']*len(codes))})"
-        cursor.execute(q, codes)
-        deleted = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with self._cursor() as cursor:
+            q = f"DELETE FROM items WHERE code IN ({','.join(['?']*len(codes))})"
+            cursor.execute(q, codes)
+            deleted = cursor.rowcount
+            cursor.execute(f"DELETE FROM cost_layers WHERE item_code IN ({','.join(['?']*len(codes))})", codes)
         return deleted
     
     def log_stock_action(self, code: str, action: str, quantity: int):
         """Log stock action."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT INTO stock_logs (item_code, action, quantity) VALUES (?, ?, ?)",
-            (code, action, quantity)
-        )
-        
-        conn.commit()
-        conn.close()
+        with self._cursor() as cursor:
+            self._log_stock(cursor, code, action, quantity)
     
-    def create_transaction(self, items: List[Dict], payment_method: str, customer_name: str = "", date: Optional[str] = None) -> Dict:
-        """Create a new transaction."""
-        conn = self._connect()
-        cursor = conn.cursor()
-        
-        # Generate transaction ID
-        cursor.execute("SELECT COUNT(*) FROM transactions")
-        count = cursor.fetchone()[0]
-        transaction_id = f"TXN{count + 1:04d}"
-        
-        # Calculate total using this connection (avoid nested opens)
-        total = 0.0
-        code_to_item: Dict[str, Dict] = {}
-        for item in items:
-            # Support service sale structure: {service_id, quantity}
-            if "service_id" in item:
-                cursor.execute("SELECT price FROM services WHERE id = ?", (int(item["service_id"]),))
-                row = cursor.fetchone()
-                if not row:
-                    raise ValueError("Service not found")
-                price = float(row[0])
-                qty = int(item.get("quantity", 1))
-                total += price * qty
+    def create_transaction(self, items: List[Dict], payment_method: str, customer_name: str = "", date: Optional[str] = None,
+                           idempotency_key: Optional[str] = None) -> Dict:
+        """Create a new transaction.
+
+        The write lock is taken before stock is read, so the validation read
+        and the conditional decrement see the same quantities and two tills
+        cannot both sell the last unit. Retrying with the same
+        ``idempotency_key`` returns the original sale instead of a new one.
+        """
+        sale = {"items": items, "payment_method": payment_method, "customer_name": customer_name, "date": date,
+                "idempotency_key": idempotency_key}
+        with self._cursor("IMMEDIATE") as cursor:
+            result = self._write_sales(cursor, [sale])[0]
+        if not result["ok"]:
+            raise ValueError(result["error"])
+        return result["transaction"]
+
+    def create_transactions_bulk(self, sales: List[Dict]) -> List[Dict]:
+        """Record many sales in one write transaction with a single commit.
+
+        Each sale is a dict with ``items``, ``payment_method`` and optional
+        ``customer_name``, ``date`` and ``idempotency_key``. A sale that fails validation comes back
+        as ``{"ok": False, "error": ...}`` without stopping the others; written
+        sales come back as ``{"ok": True, "transaction": ...}``, in input order.
+        """
+        if not sales:
+            return []
+        with self._cursor("IMMEDIATE") as cursor:
+            return self._write_sales(cursor, sales)
+
+    def _write_sales(self, cursor: sqlite3.Cursor, sales: List[Dict]) -> List[Dict]:
+        """Validate and write sales inside the caller's BEGIN IMMEDIATE transaction.
+
+        Items, services and closed days are read once for the whole batch;
+        stock is then decremented conditionally so it can never go negative.
+        """
+        results: List[Optional[Dict]] = [None] * len(sales)
+        today = datetime.now().strftime('%Y-%m-%d')
+        codes, service_ids, days, keys, customer_keys = set(), set(), set(), set(), set()
+        for sale in sales:
+            days.add(sale.get("date") or today)
+            if sale.get("payment_method") == "Credit":
+                customer_keys.add(normalize_customer_name(sale.get("customer_name")))
+            if sale.get("idempotency_key"):
+                keys.add(sale["idempotency_key"])
+            for item in sale.get("items") or []:
+                if "service_id" in item:
+                    try:
+                        service_ids.add(int(item["service_id"]))
+                    except (TypeError, ValueError):
+                        pass  # reported against the sale below
+                elif "code" in item:
+                    codes.add(item["code"])
+
+        catalog: Dict[str, tuple] = {}
+        for chunk in _chunks(sorted(codes)):
+            cursor.execute(
+                f"SELECT code, type, COALESCE(selling_price, price), quantity, name, COALESCE(buying_price, 0) FROM items WHERE code IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            catalog.update((row[0], row[1:]) for row in cursor.fetchall())
+        services: Dict[int, tuple] = {}
+        for chunk in _chunks(sorted(service_ids)):
+            cursor.execute(
+                f"SELECT id, service_name, price FROM services WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            services.update((row[0], row[1:]) for row in cursor.fetchall())
+        closed = set()
+        for chunk in _chunks(sorted(days)):
+            cursor.execute(f"SELECT day FROM day_closures WHERE day IN ({','.join('?' * len(chunk))})", chunk)
+            closed.update(row[0] for row in cursor.fetchall())
+        replays: Dict[str, Any] = {}
+        for chunk in _chunks(sorted(keys)):
+            cursor.execute(
+                f"SELECT key, operation, result FROM idempotency_keys WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            replays.update((row[0], row[1:]) for row in cursor.fetchall())
+
+        # Credit sales are booked under the customer's existing account name
+        customers: Dict[str, str] = {}
+        for chunk in _chunks(sorted(customer_keys)):
+            cursor.execute(
+                f"SELECT normalized_name, name FROM customers WHERE normalized_name IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            customers.update(cursor.fetchall())
+
+        available = {code: row[2] for code, row in catalog.items()}
+        accepted = []
+        first_use: Dict[str, int] = {}
+        repeats: List[tuple] = []
+        for index, sale in enumerate(sales):
+            key = sale.get("idempotency_key")
+            if key in replays:
+                operation, stored = replays[key]
+                if operation == "sale":
+                    results[index] = {"ok": True, "transaction": json.loads(stored)}
+                else:
+                    results[index] = {"ok": False, "error": f"Idempotency key already used for {operation}"}
+                continue
+            if key in first_use:
+                repeats.append((index, first_use[key]))
+                continue
+            try:
+                date_value = sale.get("date") or today
+                if date_value in closed:
+                    raise ValueError(f"Day {date_value} is closed; re-open it before making changes")
+                customer_name = sale.get("customer_name") or ""
+                if sale["payment_method"] == "Credit":
+                    customer_key = normalize_customer_name(customer_name)
+                    if not customer_key:
+                        raise ValueError("Customer name required for credit sales")
+                    customer_name = customers.setdefault(customer_key, " ".join(customer_name.split()))
+                total, lines, usage = 0.0, [], {}
+                for line_no, item in enumerate(sale["items"], start=1):
+                    if "service_id" in item:
+                        service = services.get(int(item["service_id"]))
+                        if not service:
+                            raise ValueError("Service not found")
+                        qty = int(item.get("quantity", 1))
+                        total += float(service[1]) * qty
+                        lines.append((line_no, None, int(item["service_id"]), service[0], qty, float(service[1]), 0.0))
+                    else:
+                        row = catalog.get(item["code"])
+                        if not row:
+                            raise ValueError(f"Item {item['code']} not found")
+                        item_type, price, _, item_name, unit_cost = row
+                        qty = int(item["quantity"])
+                        if item_type == "product":
+                            usage[item["code"]] = usage.get(item["code"], 0) + qty
+                        total += float(price) * qty
+                        lines.append((line_no, item["code"], None, item_name, qty, float(price), float(unit_cost)))
+                for code, qty in usage.items():
+                    if available[code] < qty:
+                        raise ValueError(f"Insufficient stock for {code}")
+            except (KeyError, TypeError) as e:
+                results[index] = {"ok": False, "error": f"Invalid sale data: {e}"}
+                continue
+            except ValueError as e:
+                results[index] = {"ok": False, "error": str(e)}
+                continue
+            for code, qty in usage.items():
+                available[code] -= qty
+            if key:
+                first_use[key] = index
+            accepted.append((index, sale, date_value, total, lines, usage, customer_name))
+
+        if not accepted:
+            return self._fill_repeats(results, repeats)
+
+        transaction_ids = self._allocate_codes(cursor, "transaction", len(accepted))
+        txn_rows, line_rows, log_rows = [], [], []
+        used: Dict[str, int] = {}
+        credit_amounts: Dict[str, list] = {}
+        link_rows = []
+        daily: Dict[tuple, Dict[str, float]] = {}
+        ledger_sales = ledger_credits = 0.0
+        # FIFO: each sale takes the oldest layers left by the sales before it
+        layers = self._open_layers(cursor, {code for entry in accepted for code in entry[5]})
+        for transaction_id, (index, sale, date_value, total, lines, usage, customer_name) in zip(transaction_ids, accepted):
+            payment_method = sale["payment_method"]
+            is_credit = payment_method == "Credit"
+            txn_rows.append((
+                transaction_id, json.dumps(sale["items"]), total, payment_method, customer_name,
+                not is_credit, is_credit, date_value
+            ))
+            unit_costs = {
+                code: self._consume_layers(layers[code], qty, catalog[code][4]) / qty
+                for code, qty in usage.items() if qty > 0
+            }
+            lines = [line[:6] + (unit_costs[line[1]],) if line[1] in unit_costs else line for line in lines]
+            line_rows.extend((transaction_id, *line) for line in lines)
+            for code, qty in usage.items():
+                used[code] = used.get(code, 0) + qty
+                log_rows.append((code, "used", qty, date_value))
+            deltas = daily.setdefault((date_value, payment_method), {})
+            deltas["sale_count"] = deltas.get("sale_count", 0) + 1
+            deltas["cogs"] = deltas.get("cogs", 0) + sum(line[4] * line[6] for line in lines)
+            if is_credit:
+                ledger_credits += total
+                deltas["credit_total"] = deltas.get("credit_total", 0) + total
+                entry = credit_amounts.setdefault(customer_name, [0.0, date_value])
+                entry[0] += total
+                link_rows.append((customer_name, transaction_id))
             else:
-                cursor.execute("SELECT type, COALESCE(selling_price, price), quantity FROM items WHERE code = ?", (item["code"],))
-                row = cursor.fetchone()
-                if not row:
-                    raise ValueError(f"Item {item['code']} not found")
-                item_type, price, qty_available = row
-                code_to_item[item["code"]] = {"type": item_type, "price": price, "quantity": qty_available}
-                if item_type == "product" and qty_available < int(item["quantity"]):
-                    raise ValueError(f"Insufficient stock for {item['code']}")
-                total += float(price) * int(item["quantity"])
-        
-        # Default date (YYYY-MM-DD)
-        date_value = date or datetime.now().strftime('%Y-%m-%d')
+                ledger_sales += total
+                deltas["sales_total"] = deltas.get("sales_total", 0) + total
+            results[index] = {"ok": True, "transaction": {
+                "id": transaction_id,
+                "items": sale["items"],
+                "total": total,
+                "payment_method": payment_method,
+                "customer_name": customer_name,
+                "paid": not is_credit,
+                "credit_status": is_credit,
+                "date": date_value
+            }}
 
-        # Store transaction
-        cursor.execute(
+        cursor.executemany(
             "INSERT INTO transactions (transaction_id, items, total, payment_method, customer_name, paid, credit_status, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (
-                transaction_id,
-                json.dumps(items),
-                total,
-                payment_method,
-                customer_name,
-                payment_method != "Credit",
-                payment_method == "Credit",
-                date_value
+            txn_rows
+        )
+        cursor.executemany(
+            "INSERT INTO transaction_lines (transaction_id, line_no, item_code, service_id, name, quantity, unit_price, unit_cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            line_rows
+        )
+        # One conditional decrement per item for the whole batch; a short
+        # rowcount means stock moved under us and the whole write is undone
+        for code, qty in used.items():
+            cursor.execute(
+                "UPDATE items SET quantity = quantity - ?, used_qty = used_qty + ? WHERE code = ? AND quantity >= ?",
+                (qty, qty, code, qty)
             )
+            if cursor.rowcount != 1:
+                raise ValueError(f"Insufficient stock for {code}")
+        self._save_layers(cursor, layers)
+        self._insert_stock_logs(cursor, log_rows)
+        cursor.executemany(
+            """
+            INSERT INTO credits (customer_name, amount, transaction_ids, date_created) VALUES (?, ?, '[]', ?)
+            ON CONFLICT(customer_name) DO UPDATE SET
+                amount = amount + excluded.amount,
+                date_created = COALESCE(date_created, excluded.date_created),
+                date_cleared = NULL,
+                payment_method_cleared = NULL
+            """,
+            [(name, amount, first_date) for name, (amount, first_date) in credit_amounts.items()]
         )
-        
-        # Update stock for product items only (services do not affect stock)
-        for item in items:
-            if "service_id" in item:
-                continue
-            cached = code_to_item.get(item.get("code")) or {}
-            if cached.get("type") == "product":
-                new_quantity = int(cached["quantity"]) - int(item["quantity"])
-                cursor.execute("UPDATE items SET quantity = ? WHERE code = ?", (new_quantity, item["code"]))
-                cursor.execute("INSERT INTO stock_logs (item_code, action, quantity) VALUES (?, ?, ?)", (item["code"], "used", int(item["quantity"])) )
-        
-        # If credit, upsert into credits table
-        if payment_method == "Credit":
-            cursor.execute("SELECT amount, transaction_ids, date_created FROM credits WHERE customer_name = ?", (customer_name,))
-            existing = cursor.fetchone()
-            if existing:
-                prev_amount, txn_ids_json, prev_date_created = existing
-                txn_ids = json.loads(txn_ids_json)
-                txn_ids.append(transaction_id)
-                cursor.execute(
-                    "UPDATE credits SET amount = ?, transaction_ids = ?, date_created = COALESCE(date_created, ?) WHERE customer_name = ?",
-                    (prev_amount + total, json.dumps(txn_ids), date_value, customer_name)
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO credits (customer_name, amount, transaction_ids, date_created) VALUES (?, ?, ?, ?)",
-                    (customer_name, total, json.dumps([transaction_id]), date_value)
-                )
+        cursor.executemany("INSERT OR IGNORE INTO credit_links (customer_name, transaction_id) VALUES (?, ?)", link_rows)
+        cursor.executemany(
+            """
+            INSERT INTO customers (name, normalized_name, outstanding) VALUES (?, ?, ?)
+            ON CONFLICT(normalized_name) DO UPDATE SET outstanding = outstanding + excluded.outstanding
+            """,
+            [(name, normalize_customer_name(name), amount) for name, (amount, _) in credit_amounts.items()]
+        )
+        self._bump_ledger(cursor, sales=ledger_sales, credits=ledger_credits, transactions=len(accepted))
+        for (day, payment_method), deltas in daily.items():
+            self._bump_daily(cursor, day, payment_method, **deltas)
+        cursor.executemany(
+            "INSERT INTO idempotency_keys (key, operation, result) VALUES (?, 'sale', ?)",
+            [(sale["idempotency_key"], json.dumps(results[index]["transaction"]))
+             for index, sale, *_ in accepted if sale.get("idempotency_key")]
+        )
+        return self._fill_repeats(results, repeats)
 
-        conn.commit()
-        conn.close()
-        
-        return {
-            "id": transaction_id,
-            "items": items,
-            "total": total,
-            "payment_method": payment_method,
-            "customer_name": customer_name,
-            "paid": payment_method != "Credit",
-            "credit_status": payment_method == "Credit",
-            "date": date_value
-        }
-    
-    def add_expense(self, description: str, amount: float, date: Optional[str] = None) -> Dict:
-        """Add an expense."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
+    @staticmethod
+    def _fill_repeats(results: List[Optional[Dict]], repeats: List[tuple]) -> List[Dict]:
+        """A key repeated inside one batch gets the result of its first use."""
+        for index, first in repeats:
+            results[index] = results[first]
+        return results
+
+    def add_expense(self, description: str, amount: float, date: Optional[str] = None, idempotency_key: Optional[str] = None) -> Dict:
+        """Add an expense; a retry with the same ``idempotency_key`` returns the first result."""
         date_value = date or datetime.now().strftime('%Y-%m-%d')
+        with self._cursor("IMMEDIATE") as cursor:
+            replayed = self._replay(cursor, idempotency_key, "expense")
+            if replayed is not None:
+                return replayed
+            self._ensure_days_open(cursor, [date_value])
+            cursor.execute(
+                "INSERT INTO expenses (description, amount, date) VALUES (?, ?, ?)",
+                (description, amount, date_value)
+            )
+            self._bump_ledger(cursor, expenses=amount)
+            self._bump_daily(cursor, date_value, "-", expense_total=amount, expense_count=1)
+            result = {"description": description, "amount": amount, "date": date_value}
+            self._remember(cursor, idempotency_key, "expense", result)
         
-        cursor.execute(
-            "INSERT INTO expenses (description, amount, date) VALUES (?, ?, ?)",
-            (description, amount, date_value)
-        )
-        
-        conn.commit()
-        conn.close()
-        
-        return {"description": description, "amount": amount, "date": date_value}
+        return result
     
     def list_transactions(self) -> List[Dict]:
-        """Get all transactions (sales and expenses unified)."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
+        """Get all transactions (sales and expenses unified).
 
-        # Sales transactions
-        cursor.execute("SELECT transaction_id, items, total, payment_method, customer_name, paid, credit_status, date, date_cleared, payment_method_cleared, created_at FROM transactions")
-        sales_rows = cursor.fetchall()
+        Rows carry no sale lines; use get_transaction() for a single sale
+        with its lines.
+        """
+        with self._read_cursor() as cursor:
+            # Sales transactions
+            cursor.execute("SELECT transaction_id, total, payment_method, customer_name, paid, credit_status, date, date_cleared, payment_method_cleared, created_at FROM transactions")
+            sales_rows = cursor.fetchall()
 
-        # Expenses
-        cursor.execute("SELECT id, description, amount, date, created_at FROM expenses")
-        expense_rows = cursor.fetchall()
-
-        conn.close()
+            # Expenses
+            cursor.execute("SELECT id, description, amount, date, created_at FROM expenses")
+            expense_rows = cursor.fetchall()
 
         records: List[Dict] = []
 
         for row in sales_rows:
-            records.append({
-                "id": row[0],
-                "items": json.loads(row[1]),
-                "total": row[2],
-                "payment_method": row[3],
-                "customer_name": row[4],
-                "paid": bool(row[5]),
-                "credit_status": bool(row[6]),
-                "date": row[7] or row[10],
-                "date_cleared": row[8],
-                "payment_method_cleared": row[9],
-                "type": "sale"
-            })
+            records.append(self._sale_record(row))
 
         for row in expense_rows:
             records.append({
                 "id": f"EXP{row[0]:04d}",
-                "items": [],
                 "total": row[2],
                 "payment_method": "-",
                 "customer_name": "",
@@ -517,20 +2082,360 @@ class Database:
         records.sort(key=safe_date, reverse=True)
         return records
     
+    def query_transactions(self, txn_type: str = "all", payment_method: str = "all", from_date: Optional[str] = None,
+                           to_date: Optional[str] = None, text: Optional[str] = None, limit: int = 50,
+                           cursor: Optional[str] = None) -> Dict:
+        """One page of sales and expenses, newest first, filtered in SQL.
+
+        Rows are ordered by (date, sales before expenses, row id) descending.
+        Pass the returned ``next_cursor`` back as ``cursor`` to get the next
+        page; each page is an index range scan regardless of history size.
+        """
+        after = None
+        if cursor:
+            try:
+                day, kind, rid = cursor.rsplit("|", 2)
+                after = (day, int(kind), int(rid))
+            except ValueError:
+                raise ValueError("Invalid page cursor")
+        pattern = None
+        if text:
+            pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+        def branch(kind: int, table: str, select: str, extra: List[str], extra_params: list) -> tuple:
+            where, params = list(extra), list(extra_params)
+            if from_date:
+                where.append("date >= ?")
+                params.append(from_date)
+            if to_date:
+                where.append("date <= ?")
+                params.append(to_date)
+            if after:
+                day, after_kind, rid = after
+                # (date, kind, id) < cursor, with this branch's kind fixed
+                if after_kind == kind:
+                    where.append("(date, id) < (?, ?)")
+                    params.extend([day, rid])
+                elif after_kind > kind:
+                    where.append("date <= ?")
+                    params.append(day)
+                else:
+                    where.append("date < ?")
+                    params.append(day)
+            sql = f"SELECT * FROM (SELECT {select} FROM {table} {'WHERE ' + ' AND '.join(where) if where else ''} ORDER BY date DESC, id DESC LIMIT ?)"
+            return sql, params + [limit + 1]
+
+        branches = []
+        if txn_type in ("all", "sale"):
+            extra, extra_params = [], []
+            if payment_method != "all":
+                extra.append("payment_method = ?")
+                extra_params.append(payment_method)
+            if pattern:
+                extra.append("(transaction_id LIKE ? ESCAPE '\\' OR customer_name LIKE ? ESCAPE '\\' OR payment_method LIKE ? ESCAPE '\\')")
+                extra_params.extend([pattern, pattern, pattern])
+            branches.append(branch(
+                1, "transactions",
+                "1 AS kind, id AS rid, transaction_id, total, payment_method, customer_name, paid, credit_status, date, date_cleared, payment_method_cleared, NULL AS description",
+                extra, extra_params
+            ))
+        if txn_type in ("all", "expense") and payment_method in ("all", "-"):
+            extra, extra_params = [], []
+            if pattern:
+                extra.append("description LIKE ? ESCAPE '\\'")
+                extra_params.append(pattern)
+            branches.append(branch(
+                0, "expenses",
+                "0 AS kind, id AS rid, NULL, amount, '-', '', 1, 0, date, NULL, NULL, description",
+                extra, extra_params
+            ))
+        if not branches:
+            return {"rows": [], "next_cursor": None}
+
+        sql = " UNION ALL ".join(b[0] for b in branches) + " ORDER BY date DESC, kind DESC, rid DESC LIMIT ?"
+        params = [p for b in branches for p in b[1]] + [limit + 1]
+        with self._read_cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+
+        records = []
+        for row in rows[:limit]:
+            kind, rid = row[0], row[1]
+            if kind == 1:
+                record = self._sale_record(row[2:11] + (row[8],))
+            else:
+                record = {
+                    "id": f"EXP{rid:04d}",
+                    "total": row[3],
+                    "payment_method": "-",
+                    "customer_name": "",
+                    "paid": True,
+                    "credit_status": False,
+                    "date": row[8],
+                    "date_cleared": None,
+                    "payment_method_cleared": None,
+                    "type": "expense",
+                    "description": row[11]
+                }
+            records.append(record)
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = f"{last[8]}|{last[0]}|{last[1]}"
+        return {"rows": records, "next_cursor": next_cursor}
+
+    def iter_transactions(self, filters: Optional[Dict] = None, columns: Optional[List[str]] = None,
+                          batch_size: int = 500) -> Iterator[Dict]:
+        """Stream sales and expenses, newest first, in ``fetchmany`` batches.
+
+        ``filters`` takes the query_transactions keys (txn_type, payment_method,
+        from_date, to_date). ``columns`` projects the yielded dicts; sale lines
+        are only read when "items" is requested.
+        """
+        filters = filters or {}
+        columns = list(columns or TRANSACTION_COLUMNS)
+        unknown = [c for c in columns if c != "items" and c not in TRANSACTION_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown transaction columns: {', '.join(unknown)}")
+        with_items = "items" in columns
+        projected = [c for c in columns if c != "items"]
+        txn_type = filters.get("txn_type", "all")
+        payment_method = filters.get("payment_method", "all")
+
+        def branch(side: int, table: str, extra: List[str], extra_params: list) -> tuple:
+            exprs = [f"{TRANSACTION_COLUMNS[c][side]} AS {c}" for c in projected]
+            select = ", ".join([f"{1 - side} AS kind", "id AS rid", "date AS sort_date", "transaction_id" if side == 0 else "NULL"] + exprs)
+            where, params = list(extra), list(extra_params)
+            if filters.get("from_date"):
+                where.append("date >= ?")
+                params.append(filters["from_date"])
+            if filters.get("to_date"):
+                where.append("date <= ?")
+                params.append(filters["to_date"])
+            return f"SELECT {select} FROM {table} {'WHERE ' + ' AND '.join(where) if where else ''}", params
+
+        branches = []
+        if txn_type in ("all", "sale"):
+            if payment_method != "all":
+                branches.append(branch(0, "transactions", ["payment_method = ?"], [payment_method]))
+            else:
+                branches.append(branch(0, "transactions", [], []))
+        if txn_type in ("all", "expense") and payment_method in ("all", "-"):
+            branches.append(branch(1, "expenses", [], []))
+        if not branches:
+            return
+
+        def stream(cursor: sqlite3.Cursor, sql: str, params: list) -> Iterator[tuple]:
+            # Each arm walks its own (date, rowid) index backwards, so no sort is materialised
+            cursor.execute(sql + " ORDER BY sort_date DESC, rid DESC", params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+
+        with ExitStack() as stack:
+            arms = [stream(stack.enter_context(self._read_cursor()), sql, params) for sql, params in branches]
+            # Newest first; on the same day expenses (kind 0) follow sales (kind 1)
+            merged = heapq.merge(*arms, key=lambda row: (row[2] or "", row[0], row[1]), reverse=True)
+            while True:
+                batch = list(itertools.islice(merged, batch_size))
+                if not batch:
+                    break
+                lines: Dict[str, List[Dict]] = {}
+                if with_items:
+                    sale_ids = [row[3] for row in batch if row[0] == 1]
+                    if sale_ids:
+                        with self._read_cursor() as lines_cursor:
+                            lines_cursor.execute(
+                                f"SELECT transaction_id, item_code, service_id, name, quantity, unit_price, unit_cost FROM transaction_lines WHERE transaction_id IN ({','.join('?' * len(sale_ids))}) ORDER BY transaction_id, line_no",
+                                sale_ids
+                            )
+                            for r in lines_cursor.fetchall():
+                                lines.setdefault(r[0], []).append({
+                                    "code": r[1],
+                                    "service_id": r[2],
+                                    "name": r[3],
+                                    "quantity": r[4],
+                                    "unit_price": r[5],
+                                    "unit_cost": r[6],
+                                    "subtotal": r[4] * r[5],
+                                })
+                for row in batch:
+                    record = dict(zip(projected, row[4:]))
+                    for flag in ("paid", "credit_status"):
+                        if flag in record:
+                            record[flag] = bool(record[flag])
+                    if with_items:
+                        record["items"] = lines.get(row[3], [])
+                    yield record
+
+    def iter_stock_logs(self, item_code: Optional[str] = None, batch_size: int = 500) -> Iterator[Dict]:
+        """Stream stock log entries in insertion order, optionally for one item."""
+        sql = "SELECT id, item_code, action, quantity, created_at, business_date, entries FROM stock_logs"
+        params: tuple = ()
+        if item_code:
+            sql += " WHERE item_code = ?"
+            params = (item_code,)
+        with self._read_cursor() as cursor:
+            cursor.execute(sql + " ORDER BY id", params)
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                for row in batch:
+                    yield {
+                        "id": row[0],
+                        "item_code": row[1],
+                        "action": row[2],
+                        "quantity": row[3],
+                        "created_at": row[4],
+                        "business_date": row[5],
+                        "entries": row[6]
+                    }
+
+    @staticmethod
+    def _sale_record(row: tuple) -> Dict:
+        """Map a (transaction_id, total, ..., created_at) row to a sale record."""
+        return {
+            "id": row[0],
+            "total": row[1],
+            "payment_method": row[2],
+            "customer_name": row[3],
+            "paid": bool(row[4]),
+            "credit_status": bool(row[5]),
+            "date": row[6] or row[9],
+            "date_cleared": row[7],
+            "payment_method_cleared": row[8],
+            "type": "sale"
+        }
+
+    def get_transaction_lines(self, transaction_id: str) -> List[Dict]:
+        """Get the lines of one sale as captured at sale time."""
+        with self._read_cursor() as cursor:
+            cursor.execute(
+                "SELECT item_code, service_id, name, quantity, unit_price, unit_cost FROM transaction_lines WHERE transaction_id = ? ORDER BY line_no",
+                (transaction_id,)
+            )
+            rows = cursor.fetchall()
+        return [
+            {
+                "code": r[0],
+                "service_id": r[1],
+                "name": r[2],
+                "quantity": r[3],
+                "unit_price": r[4],
+                "unit_cost": r[5],
+                "subtotal": r[3] * r[4],
+            }
+            for r in rows
+        ]
+
+    def get_transaction(self, transaction_id: str) -> Optional[Dict]:
+        """Get one sale (with its lines) or expense (EXP####) by id."""
+        with self._read_cursor() as cursor:
+            if transaction_id.startswith("EXP") and transaction_id[3:].isdigit():
+                cursor.execute("SELECT id, description, amount, date, created_at FROM expenses WHERE id = ?", (int(transaction_id[3:]),))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                return {
+                    "id": f"EXP{row[0]:04d}",
+                    "items": [],
+                    "total": row[2],
+                    "payment_method": "-",
+                    "customer_name": "",
+                    "paid": True,
+                    "credit_status": False,
+                    "date": row[3] or row[4],
+                    "date_cleared": None,
+                    "payment_method_cleared": None,
+                    "type": "expense",
+                    "description": row[1]
+                }
+            cursor.execute(
+                "SELECT transaction_id, total, payment_method, customer_name, paid, credit_status, date, date_cleared, payment_method_cleared, created_at FROM transactions WHERE transaction_id = ?",
+                (transaction_id,)
+            )
+            row = cursor.fetchone()
+        if not row:
+            return None
+        record = self._sale_record(row)
+        record["items"] = self.get_transaction_lines(transaction_id)
+        return record
+
+    def get_item_sales(self, from_date: Optional[str] = None, to_date: Optional[str] = None) -> List[Dict]:
+        """Per-item/service quantity, revenue and cost over a date range."""
+        where, params = [], []
+        if from_date:
+            where.append("t.date >= ?")
+            params.append(from_date)
+        if to_date:
+            where.append("t.date <= ?")
+            params.append(to_date)
+        with self._read_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT l.item_code, l.service_id, MAX(l.name),
+                       SUM(l.quantity), SUM(l.quantity * l.unit_price), SUM(l.quantity * l.unit_cost)
+                FROM transactions t
+                JOIN transaction_lines l ON l.transaction_id = t.transaction_id
+                {"WHERE " + " AND ".join(where) if where else ""}
+                GROUP BY l.item_code, l.service_id
+                ORDER BY SUM(l.quantity * l.unit_price) DESC
+            """, params)
+            rows = cursor.fetchall()
+        return [
+            {
+                "code": r[0],
+                "service_id": r[1],
+                "name": r[2],
+                "quantity": r[3],
+                "revenue": r[4],
+                "cost": r[5],
+                "profit": r[4] - r[5],
+            }
+            for r in rows
+        ]
+
+    def get_customer(self, name: str) -> Optional[Dict]:
+        """Look up a credit customer by name, ignoring case and spacing."""
+        with self._read_cursor() as cursor:
+            cursor.execute(
+                "SELECT id, name, outstanding FROM customers WHERE normalized_name = ?",
+                (normalize_customer_name(name),)
+            )
+            row = cursor.fetchone()
+        return {"id": row[0], "name": row[1], "outstanding": row[2]} if row else None
+
+    def search_customers(self, prefix: str, limit: int = 10) -> List[Dict]:
+        """Customers whose normalized name starts with ``prefix`` (an index range scan)."""
+        key = normalize_customer_name(prefix)
+        if not key:
+            return []
+        with self._read_cursor() as cursor:
+            cursor.execute(
+                "SELECT name, outstanding FROM customers WHERE normalized_name >= ? AND normalized_name < ? ORDER BY normalized_name LIMIT ?",
+                (key, key + "\U0010ffff", limit)
+            )
+            rows = cursor.fetchall()
+        return [{"name": r[0], "outstanding": r[1]} for r in rows]
+
     def list_credits(self) -> Dict:
         """Get all credits with status and dates."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT customer_name, amount, transaction_ids, date_created, date_cleared, payment_method_cleared FROM credits")
-        results = cursor.fetchall()
-        conn.close()
+        with self._read_cursor() as cursor:
+            cursor.execute("""
+                SELECT c.customer_name, c.amount, GROUP_CONCAT(l.transaction_id), c.date_created, c.date_cleared, c.payment_method_cleared
+                FROM credits c
+                LEFT JOIN credit_links l ON l.customer_name = c.customer_name
+                GROUP BY c.id
+            """)
+            results = cursor.fetchall()
         
         credits = {}
         for row in results:
             customer = row[0]
             amount = row[1]
-            txn_ids = json.loads(row[2]) if row[2] else []
+            txn_ids = sorted(row[2].split(",")) if row[2] else []
             date_created = row[3]
             date_cleared = row[4]
             method_cleared = row[5]
@@ -548,75 +2453,94 @@ class Database:
                 "payment_method": method_cleared,
             }
         return credits
+
+    def list_credit_transactions(self, customer_name: str) -> List[Dict]:
+        """Get the sales linked to one customer's credit account."""
+        with self._read_cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT t.transaction_id, t.total, t.payment_method, t.customer_name, t.paid, t.credit_status, t.date, t.date_cleared, t.payment_method_cleared, t.created_at
+                FROM credit_links c
+                JOIN transactions t ON t.transaction_id = c.transaction_id
+                WHERE c.customer_name = ?
+                ORDER BY t.date, t.transaction_id
+                """,
+                (customer_name,)
+            )
+            rows = cursor.fetchall()
+        return [self._sale_record(row) for row in rows]
     
-    def clear_credit(self, customer_name: str, payment_method_cleared: str, date_cleared: Optional[str] = None) -> bool:
-        """Clear customer credit and mark related transactions paid with clearance details."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT amount, transaction_ids FROM credits WHERE customer_name = ?", (customer_name,))
-        result = cursor.fetchone()
-        
-        if not result:
-            conn.close()
-            return False
-        
-        amount, transaction_ids = result
-        transaction_ids = json.loads(transaction_ids)
-        
-        # Mark transactions as paid and record clearance details
-        date_value = date_cleared or datetime.now().strftime('%Y-%m-%d')
-        for txn_id in transaction_ids:
+    def clear_credit(self, customer_name: str, payment_method_cleared: str, date_cleared: Optional[str] = None,
+                     idempotency_key: Optional[str] = None) -> bool:
+        """Clear customer credit and mark related transactions paid with clearance details.
+
+        A retry with the same ``idempotency_key`` returns the first result
+        without clearing (or bumping the totals) a second time.
+        """
+        with self._cursor("IMMEDIATE") as cursor:
+            replayed = self._replay(cursor, idempotency_key, "clear_credit")
+            if replayed is not None:
+                return replayed["cleared"]
+            cursor.execute("SELECT name FROM customers WHERE normalized_name = ?", (normalize_customer_name(customer_name),))
+            account = cursor.fetchone()
+            if account:
+                customer_name = account[0]
+            cursor.execute("SELECT amount FROM credits WHERE customer_name = ?", (customer_name,))
+            result = cursor.fetchone()
+            
+            if not result:
+                return False
+            
             cursor.execute(
-                "UPDATE transactions SET paid = 1, credit_status = 0, payment_method_cleared = ?, date_cleared = ? WHERE transaction_id = ?",
-                (payment_method_cleared, date_value, txn_id)
+                """
+                SELECT COALESCE(SUM(total), 0) FROM transactions
+                WHERE transaction_id IN (SELECT transaction_id FROM credit_links WHERE customer_name = ?) AND paid = 0
+                """,
+                (customer_name,)
             )
-        
-        # Update credit record with clearance info and set amount to zero
-        cursor.execute(
-            "UPDATE credits SET amount = 0, date_cleared = ?, payment_method_cleared = ? WHERE customer_name = ?",
-            (date_value, payment_method_cleared, customer_name)
-        )
-        
-        conn.commit()
-        conn.close()
+            newly_paid = cursor.fetchone()[0]
+            
+            # Mark all still-unpaid linked transactions paid in one statement
+            date_value = date_cleared or datetime.now().strftime('%Y-%m-%d')
+            self._ensure_days_open(cursor, [date_value])
+            cursor.execute(
+                """
+                UPDATE transactions SET paid = 1, credit_status = 0, payment_method_cleared = ?, date_cleared = ?
+                WHERE transaction_id IN (SELECT transaction_id FROM credit_links WHERE customer_name = ?) AND paid = 0
+                """,
+                (payment_method_cleared, date_value, customer_name)
+            )
+            
+            # Update credit record with clearance info and set amount to zero
+            cursor.execute(
+                "UPDATE credits SET amount = 0, date_cleared = ?, payment_method_cleared = ? WHERE customer_name = ?",
+                (date_value, payment_method_cleared, customer_name)
+            )
+            cursor.execute("UPDATE customers SET outstanding = 0 WHERE name = ?", (customer_name,))
+            self._bump_ledger(cursor, sales=newly_paid, credits=-result[0])
+            if newly_paid:
+                self._bump_daily(cursor, date_value, payment_method_cleared, cleared_total=newly_paid)
+            self._remember(cursor, idempotency_key, "clear_credit", {"cleared": True})
         return True
     
+    def _ledger(self) -> Dict[str, float]:
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT total_sales, total_credits, total_expenses, total_transactions FROM ledger_totals WHERE id = 1")
+            row = cursor.fetchone() or (0, 0, 0, 0)
+        return dict(zip(LEDGER_FIELDS, row))
+
     def get_system_balance(self) -> float:
         """Calculate system balance."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        # Sum of paid transactions
-        cursor.execute("SELECT COALESCE(SUM(total), 0) FROM transactions WHERE paid = 1")
-        total_sales = cursor.fetchone()[0]
-        
-        # Sum of expenses
-        cursor.execute("SELECT COALESCE(SUM(amount), 0) FROM expenses")
-        total_expenses = cursor.fetchone()[0]
-        
-        conn.close()
-        return total_sales - total_expenses
+        ledger = self._ledger()
+        return ledger["total_sales"] - ledger["total_expenses"]
     
     def get_stock_report_data(self) -> List[Dict]:
-        """Get stock report data."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT i.code, i.name, 
-                   COALESCE(SUM(CASE WHEN sl.action = 'added' THEN sl.quantity ELSE 0 END), 0) as received,
-                   COALESCE(SUM(CASE WHEN sl.action = 'used' THEN sl.quantity ELSE 0 END), 0) as used,
-                   i.quantity as remaining
-            FROM items i
-            LEFT JOIN stock_logs sl ON i.code = sl.item_code
-            WHERE i.type = 'product'
-            GROUP BY i.code, i.name, i.quantity
-            ORDER BY i.code
-        """)
-        
-        results = cursor.fetchall()
-        conn.close()
+        """Get stock report data from the per-item counters."""
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT code, name, received_qty, used_qty, quantity FROM items WHERE type = 'product' ORDER BY code")
+            results = cursor.fetchall()
+            cursor.execute("SELECT item_code, SUM(remaining * unit_cost) FROM cost_layers WHERE remaining > 0 GROUP BY item_code")
+            values = dict(cursor.fetchall())
         
         return [
             {
@@ -624,63 +2548,36 @@ class Database:
                 "name": row[1],
                 "received": row[2],
                 "used": row[3],
-                "remaining": row[4]
+                "remaining": row[4],
+                "value": values.get(row[0], 0.0)
             }
             for row in results
         ]
     
     def get_sales_summary(self) -> Dict:
-        """Get sales summary data."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        # Total sales (paid)
-        cursor.execute("SELECT COALESCE(SUM(total), 0) FROM transactions WHERE paid = 1")
-        total_sales = cursor.fetchone()[0]
-        
-        # Outstanding credits
-        cursor.execute("SELECT COALESCE(SUM(amount), 0) FROM credits")
-        total_credits = cursor.fetchone()[0]
-        
-        # Total expenses
-        cursor.execute("SELECT COALESCE(SUM(amount), 0) FROM expenses")
-        total_expenses = cursor.fetchone()[0]
-        
-        # Total transactions
-        cursor.execute("SELECT COUNT(*) FROM transactions")
-        total_transactions = cursor.fetchone()[0]
-        
-        conn.close()
-        
+        """Get sales summary data from the running ledger totals."""
+        ledger = self._ledger()
         return {
-            "total_sales": total_sales,
-            "total_credits": total_credits,
-            "total_expenses": total_expenses,
-            "system_balance": total_sales - total_expenses,
-            "total_transactions": total_transactions
+            "total_sales": ledger["total_sales"],
+            "total_credits": ledger["total_credits"],
+            "total_expenses": ledger["total_expenses"],
+            "system_balance": ledger["total_sales"] - ledger["total_expenses"],
+            "total_transactions": ledger["total_transactions"]
         }
     
     def set_setting(self, key: str, value: str):
         """Set a system setting."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
-            (key, value)
-        )
-        
-        conn.commit()
-        conn.close()
+        with self._cursor() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                (key, value)
+            )
     
     def get_setting(self, key: str, default: str = "") -> str:
         """Get a system setting."""
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
-        result = cursor.fetchone()
-        conn.close()
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
+            result = cursor.fetchone()
         
         return result[0] if result else default
 
@@ -688,40 +2585,133 @@ class Database:
         """Delete transactions by transaction_id values."""
         if not txn_ids:
             return 0
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        q = f"DELETE FROM transactions WHERE transaction_id IN ({','.join(['?']*len(txn_ids))})"
-        cursor.execute(q, txn_ids)
-        deleted = cursor.rowcount
-        conn.commit()
-        conn.close()
+        placeholders = ','.join(['?']*len(txn_ids))
+        with self._cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT date, payment_method, total, paid, date_cleared, payment_method_cleared,
+                       (SELECT COALESCE(SUM(l.quantity * l.unit_cost), 0) FROM transaction_lines l WHERE l.transaction_id = transactions.transaction_id)
+                FROM transactions WHERE transaction_id IN ({placeholders})
+                """,
+                txn_ids
+            )
+            rows = cursor.fetchall()
+            self._ensure_days_open(cursor, [r[0] for r in rows] + [r[4] for r in rows if r[3] and r[1] == "Credit"])
+            paid_total = sum(r[2] for r in rows if r[3])
+            self._bump_ledger(cursor, sales=-paid_total, transactions=-len(rows))
+            for day, method, total, paid, day_cleared, method_cleared, cogs in rows:
+                if method == "Credit":
+                    self._bump_daily(cursor, day, method, credit_total=-total, sale_count=-1, cogs=-cogs)
+                    if paid and day_cleared:
+                        self._bump_daily(cursor, day_cleared, method_cleared, cleared_total=-total)
+                else:
+                    self._bump_daily(cursor, day, method, sales_total=-total, sale_count=-1, cogs=-cogs)
+            cursor.execute(f"DELETE FROM transactions WHERE transaction_id IN ({placeholders})", txn_ids)
+            deleted = cursor.rowcount
+            cursor.execute(f"DELETE FROM transaction_lines WHERE transaction_id IN ({placeholders})", txn_ids)
+            cursor.execute(f"DELETE FROM credit_links WHERE transaction_id IN ({placeholders})", txn_ids)
         return deleted
 
     def delete_credits(self, customers: List[str]) -> int:
         """Delete credits by customer names."""
         if not customers:
             return 0
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        q = f"DELETE FROM credits WHERE customer_name IN ({','.join(['?']*len(customers))})"
-        cursor.execute(q, customers)
-        deleted = cursor.rowcount
-        conn.commit()
-        conn.close()
+        placeholders = ','.join(['?']*len(customers))
+        with self._cursor() as cursor:
+            cursor.execute(f"SELECT COALESCE(SUM(amount), 0) FROM credits WHERE customer_name IN ({placeholders})", customers)
+            self._bump_ledger(cursor, credits=-cursor.fetchone()[0])
+            cursor.execute(f"DELETE FROM credits WHERE customer_name IN ({placeholders})", customers)
+            deleted = cursor.rowcount
+            cursor.execute(f"DELETE FROM credit_links WHERE customer_name IN ({placeholders})", customers)
+            cursor.execute(f"UPDATE customers SET outstanding = 0 WHERE name IN ({placeholders})", customers)
         return deleted
 
     def delete_expenses(self, expense_ids: List[int]) -> int:
         """Delete expenses by numeric ids."""
         if not expense_ids:
             return 0
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        q = f"DELETE FROM expenses WHERE id IN ({','.join(['?']*len(expense_ids))})"
-        cursor.execute(q, expense_ids)
-        deleted = cursor.rowcount
-        conn.commit()
-        conn.close()
+        placeholders = ','.join(['?']*len(expense_ids))
+        with self._cursor() as cursor:
+            cursor.execute(f"SELECT date, amount FROM expenses WHERE id IN ({placeholders})", expense_ids)
+            rows = cursor.fetchall()
+            self._ensure_days_open(cursor, [r[0] for r in rows])
+            self._bump_ledger(cursor, expenses=-sum(r[1] for r in rows))
+            for day, amount in rows:
+                self._bump_daily(cursor, day, "-", expense_total=-amount, expense_count=-1)
+            cursor.execute(f"DELETE FROM expenses WHERE id IN ({placeholders})", expense_ids)
+            deleted = cursor.rowcount
         return deleted
 
-# Global database instance
-db = Database()
+
+_db: Optional[Database] = None
+_db_lock = threading.Lock()
+# A Database bound to the current request/thread context, ahead of the global one
+_bound: contextvars.ContextVar[Optional[Database]] = contextvars.ContextVar("pos_bound_db", default=None)
+
+
+def init(path: Optional[str] = None) -> Database:
+    """Open (and migrate) the process-wide database.
+
+    Calling it again for the same file returns the open handle; a different
+    file needs close() first, so nothing already using the handle is
+    silently repointed. Apps serving their own file use bind() instead.
+    """
+    global _db
+    path = path or os.environ.get("POS_DB_PATH", DATABASE_FILE)
+    with _db_lock:
+        if _db is not None:
+            if os.path.abspath(_db.path) != os.path.abspath(path):
+                raise RuntimeError(f"Database {_db.path} is already open; close() it before opening {path}")
+            return _db
+        _db = Database(path)
+        return _db
+
+
+def get_db() -> Database:
+    """The database bound to this context, else the process-wide one (opened on first use)."""
+    global _db
+    bound = _bound.get()
+    if bound is not None:
+        return bound
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = Database()
+    return _db
+
+
+def bind(handle: Database) -> contextvars.Token:
+    """Route ``db`` to ``handle`` in the current context until unbind(token)."""
+    return _bound.set(handle)
+
+
+def unbind(token: contextvars.Token) -> None:
+    _bound.reset(token)
+
+
+def close() -> None:
+    """Close the process-wide database; the next use opens it again."""
+    global _db
+    with _db_lock:
+        if _db is not None:
+            _db.close()
+        _db = None
+
+
+class _LazyDatabase:
+    """Stands in for the global Database until something uses it.
+
+    Importing this module therefore touches no file; the first
+    ``db.<method>`` call opens whatever init() or POS_DB_PATH names.
+    """
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(get_db(), name)
+
+    def __repr__(self) -> str:
+        current = _bound.get() or _db
+        return "<Database (not opened yet)>" if current is None else f"<Database {current.path}>"
+
+
+# Global database handle
+db = _LazyDatabase()
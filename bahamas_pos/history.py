@@ -0,0 +1,188 @@
+"""
+Bulk loader for historical sales and expenses kept on paper or in spreadsheets.
+
+A CSV is streamed row by row and written in large batches, each batch one
+commit together with its checkpoint. Secondary indexes on transactions and
+expenses are dropped for the load and rebuilt once at the end, followed by
+a single ledger and daily-rollup rebuild, so a million rows take minutes
+instead of a million create_transaction calls. An interrupted load is
+resumed by running it again on the same file.
+
+Sales columns: date, total, payment_method, customer_name, date_cleared,
+payment_method_cleared and an optional transaction_id. Historical sales do
+not move stock, and credit sales must already be cleared. Expense columns:
+date, description, amount.
+"""
+import csv
+import os
+import time
+from datetime import date
+from typing import Optional
+
+import database
+
+# Accepted header spellings for each field, per kind
+COLUMN_ALIASES = {
+    "sales": {
+        "date": ("date", "sale date"),
+        "total": ("total", "amount"),
+        "payment_method": ("payment_method", "payment method", "payment"),
+        "customer_name": ("customer_name", "customer name", "customer"),
+        "date_cleared": ("date_cleared", "date cleared", "cleared on"),
+        "payment_method_cleared": ("payment_method_cleared", "payment method cleared", "cleared by"),
+        "transaction_id": ("transaction_id", "transaction id", "id"),
+    },
+    "expenses": {
+        "date": ("date", "expense date"),
+        "description": ("description", "details"),
+        "amount": ("amount", "total"),
+    },
+}
+REQUIRED_COLUMNS = {"sales": ("date", "total", "payment_method"), "expenses": ("date", "description", "amount")}
+
+MAX_ERRORS = 200
+
+
+def _header_map(headers: list, kind: str) -> dict:
+    """Map field name -> column index from a header row."""
+    cleaned = [h.strip().lower() for h in headers]
+    mapping = {}
+    for field, aliases in COLUMN_ALIASES[kind].items():
+        for alias in aliases:
+            if alias in cleaned:
+                mapping[field] = cleaned.index(alias)
+                break
+    missing = [f for f in REQUIRED_COLUMNS[kind] if f not in mapping]
+    if missing:
+        raise ValueError(f"The file needs column(s): {', '.join(missing)}")
+    return mapping
+
+
+def _day(value: str, field: str) -> str:
+    try:
+        if len(value) != 10:
+            raise ValueError
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise ValueError(f"{field} must be YYYY-MM-DD: {value}")
+
+
+def _amount(value: str, field: str) -> float:
+    try:
+        amount = float(value.replace(",", ""))
+    except ValueError:
+        raise ValueError(f"{field} is not a number: {value}")
+    if amount <= 0:
+        raise ValueError(f"{field} must be positive")
+    return amount
+
+
+def _record(row: list, columns: dict, kind: str) -> dict:
+    """Validate one row into a load_history_batch() record."""
+    values = {f: (row[i].strip() if i < len(row) else "") for f, i in columns.items()}
+    record = {"date": _day(values["date"], "date")}
+    if kind == "expenses":
+        if not values["description"]:
+            raise ValueError("description is required")
+        record.update(description=values["description"], amount=_amount(values["amount"], "amount"))
+        return record
+
+    payment_method = values["payment_method"].capitalize()
+    if payment_method not in ("Cash", "Mpesa", "Credit"):
+        raise ValueError(f"Invalid payment method: {values['payment_method']}")
+    record.update(
+        total=_amount(values["total"], "total"),
+        payment_method=payment_method,
+        customer_name=" ".join(values.get("customer_name", "").split()),
+        transaction_id=values.get("transaction_id") or None,
+        date_cleared=None,
+        payment_method_cleared=None,
+    )
+    if payment_method == "Credit":
+        # Open credit carries a customer balance; enter it through Credits instead
+        cleared_method = values.get("payment_method_cleared", "").capitalize()
+        if not values.get("date_cleared") or cleared_method not in ("Cash", "Mpesa"):
+            raise ValueError("Credit sales need date_cleared and a Cash/Mpesa payment_method_cleared")
+        if not record["customer_name"]:
+            raise ValueError("Credit sales need a customer name")
+        record.update(date_cleared=_day(values["date_cleared"], "date_cleared"), payment_method_cleared=cleared_method)
+    return record
+
+
+def load_history(path: str, kind: str, batch_size: int = 50000) -> dict:
+    """Load a historical sales or expenses CSV; returns counts, row errors and rows per second.
+
+    Rows on closed days and invalid rows are skipped and reported by line
+    number. Progress is checkpointed per batch under the file's absolute
+    path; a finished file is not loaded twice.
+    """
+    if kind not in COLUMN_ALIASES:
+        raise ValueError(f"Unknown history kind: {kind}")
+    db = database.db
+    source = os.path.abspath(path)
+    checkpoint = db.load_checkpoint(source)
+    if checkpoint and checkpoint["kind"] != kind:
+        raise ValueError(f"{path} was started as {checkpoint['kind']}, not {kind}")
+    if checkpoint and checkpoint["done"]:
+        raise ValueError(f"{path} was already loaded on {checkpoint['updated_at']}")
+    resume_from = checkpoint["rows_done"] if checkpoint else 0
+
+    started = time.perf_counter()
+    totals = {"rows": 0, "loaded": 0, "skipped": 0, "resumed_at": resume_from}
+    errors: list[tuple] = []
+    closed_days = {day["day"] for day in db.list_closed_days(limit=-1)}
+    batch: list[dict] = []
+    rows_done = 0
+
+    with open(path, newline="", encoding="utf-8-sig") as f, db.bulk_load_mode():
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            raise ValueError("The file is empty")
+        columns = _header_map(header, kind)
+        db.defer_indexes(["transactions", "expenses"])
+        try:
+            for line_no, row in enumerate(reader, start=2):
+                if not any(v.strip() for v in row):
+                    continue
+                rows_done += 1
+                if rows_done <= resume_from:
+                    continue
+                totals["rows"] += 1
+                try:
+                    record = _record(row, columns, kind)
+                    if record["date"] in closed_days or record.get("date_cleared") in closed_days:
+                        raise ValueError(f"Day {record['date']} is closed")
+                except ValueError as e:
+                    totals["skipped"] += 1
+                    if len(errors) < MAX_ERRORS:
+                        errors.append((line_no, str(e)))
+                    continue
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    db.load_history_batch(source, kind, batch, rows_done)
+                    totals["loaded"] += len(batch)
+                    batch.clear()
+            # Always write the final checkpoint, even when the tail was all skipped rows
+            db.load_history_batch(source, kind, batch, rows_done)
+            totals["loaded"] += len(batch)
+        finally:
+            # A failed load keeps its checkpoint but must not leave the tills unindexed
+            db.restore_deferred_indexes()
+
+    db.finish_history_load(source)
+    elapsed = time.perf_counter() - started
+    totals.update({
+        "errors": errors,
+        "seconds": elapsed,
+        "rows_per_sec": totals["rows"] / elapsed if elapsed > 0 else 0.0,
+    })
+    return totals
+
+
+def resume_note(path: str) -> Optional[str]:
+    """Describe an unfinished load of ``path`` for error messages, if there is one."""
+    checkpoint = database.db.load_checkpoint(os.path.abspath(path))
+    if not checkpoint or checkpoint["done"]:
+        return None
+    return f"{checkpoint['rows_done']} row(s) of {path} are loaded; run the same command again to resume"
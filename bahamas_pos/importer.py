@@ -0,0 +1,157 @@
+"""
+Streaming item catalogue import from CSV or Excel (.xlsx).
+
+Rows are read one at a time, validated and written in chunks through
+Database.upsert_items, so a large supplier catalogue never sits in memory
+and each chunk costs one commit instead of one per item.
+"""
+import csv
+import io
+import os
+import time
+from typing import IO, Iterator, Optional, Union
+
+import database
+
+# Accepted header spellings for each field
+COLUMN_ALIASES = {
+    "name": ("name", "item", "item name", "description"),
+    "supplier_code": ("supplier_code", "supplier code", "sku", "barcode"),
+    "type": ("type", "item type"),
+    "price": ("price", "base price"),
+    "buying_price": ("buying_price", "buying price", "cost", "cost price"),
+    "selling_price": ("selling_price", "selling price", "retail price"),
+    "quantity": ("quantity", "qty", "stock", "opening stock"),
+}
+
+MAX_ERRORS = 200
+
+
+def _header_map(headers: list) -> dict:
+    """Map field name -> column index from a header row."""
+    cleaned = [str(h or "").strip().lower() for h in headers]
+    mapping = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in cleaned:
+                mapping[field] = cleaned.index(alias)
+                break
+    if "name" not in mapping:
+        raise ValueError("The file needs a 'name' column")
+    return mapping
+
+
+def _read_rows(source: Union[str, IO[bytes]], filename: str) -> Iterator[list]:
+    """Yield raw rows (header first) from a CSV or xlsx path or binary file."""
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ValueError("Excel import needs openpyxl (pip install openpyxl)")
+        workbook = load_workbook(source, read_only=True, data_only=True)
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield list(row)
+        finally:
+            workbook.close()
+        return
+    if isinstance(source, str):
+        with open(source, newline="", encoding="utf-8-sig") as f:
+            yield from csv.reader(f)
+    else:
+        yield from csv.reader(io.TextIOWrapper(source, encoding="utf-8-sig", newline=""))
+
+
+def _number(value, field: str, default: Optional[float] = 0.0) -> Optional[float]:
+    if value is None or str(value).strip() == "":
+        return default
+    try:
+        number = float(str(value).replace(",", "").strip())
+    except ValueError:
+        raise ValueError(f"{field} is not a number: {value}")
+    if number < 0:
+        raise ValueError(f"{field} cannot be negative")
+    return number
+
+
+def _record(row: list, columns: dict) -> dict:
+    """Validate one row into an upsert record."""
+    def cell(field):
+        index = columns.get(field)
+        return row[index] if index is not None and index < len(row) else None
+
+    name = str(cell("name") or "").strip()
+    if not name:
+        raise ValueError("Item name is required")
+    item_type = str(cell("type") or "product").strip().lower()
+    if item_type not in ("product", "service"):
+        raise ValueError(f"Invalid item type: {item_type}")
+    selling = _number(cell("selling_price"), "selling_price", None)
+    price = _number(cell("price"), "price", None)
+    if price is None and selling is None:
+        raise ValueError("A price or selling_price is required")
+    quantity = _number(cell("quantity"), "quantity")
+    if quantity != int(quantity):
+        raise ValueError(f"quantity must be a whole number: {quantity}")
+    supplier_code = str(cell("supplier_code") or "").strip() or None
+    return {
+        "name": name,
+        "supplier_code": supplier_code,
+        "type": item_type,
+        "price": price if price is not None else selling,
+        "buying_price": _number(cell("buying_price"), "buying_price"),
+        "selling_price": selling if selling is not None else price,
+        "quantity": int(quantity) if item_type == "product" else 0,
+    }
+
+
+def import_items(source: Union[str, IO[bytes]], filename: Optional[str] = None, chunk_size: int = 1000) -> dict:
+    """Import an item catalogue; returns counts, row errors and rows per second.
+
+    ``source`` is a path or a binary file object (``filename`` then picks the
+    format). Invalid rows are skipped and reported by line number; every
+    valid chunk is committed as it is reached.
+    """
+    filename = filename or (source if isinstance(source, str) else "")
+    started = time.perf_counter()
+    rows = _read_rows(source, os.path.basename(filename))
+    header = next(rows, None)
+    if header is None:
+        raise ValueError("The file is empty")
+    columns = _header_map(header)
+
+    totals = {"rows": 0, "inserted": 0, "updated": 0, "skipped": 0}
+    errors: list[tuple] = []
+    chunk: dict = {}
+
+    def flush():
+        result = database.db.upsert_items(list(chunk.values()))
+        totals["inserted"] += result["inserted"]
+        totals["updated"] += result["updated"]
+        chunk.clear()
+
+    for line_no, row in enumerate(rows, start=2):
+        if not any(str(v or "").strip() for v in row):
+            continue
+        totals["rows"] += 1
+        try:
+            record = _record(row, columns)
+        except ValueError as e:
+            totals["skipped"] += 1
+            if len(errors) < MAX_ERRORS:
+                errors.append((line_no, str(e)))
+            continue
+        # A repeated item within a chunk: the later row wins
+        chunk[record["supplier_code"] or record["name"].casefold()] = record
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+
+    elapsed = time.perf_counter() - started
+    totals.update({
+        "errors": errors,
+        "seconds": elapsed,
+        "rows_per_sec": totals["rows"] / elapsed if elapsed > 0 else 0.0,
+    })
+    return totals
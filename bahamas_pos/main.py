@@ -175,6 +175,10 @@ class MainApplication:
                                       font=("Arial", 9, "bold"), foreground="green")
         self.balance_label.pack(side=tk.RIGHT)
         
+        self.low_stock_label = ttk.Label(self.status_frame, text="", 
+                                        font=("Arial", 9, "bold"), foreground="red")
+        self.low_stock_label.pack(side=tk.RIGHT, padx=(0, 20))
+        
     def show_login(self):
         """Show login window and wait for authentication."""
         login_window = LoginWindow(self.root)
@@ -249,9 +253,16 @@ class MainApplication:
                 print(f"Error loading logo: {e}")
                 
     def update_status(self):
-        """Update status bar with current balance."""
+        """Update status bar with current balance and low-stock items."""
         balance = transactions.get_system_balance()
         self.balance_label.config(text=f"System Balance: KES {balance:.2f}")
+        low = stock.low_stock_items(limit=6)
+        if low:
+            names = ", ".join(f"{it['name']} ({it['quantity']})" for it in low[:5])
+            more = " ..." if len(low) > 5 else ""
+            self.low_stock_label.config(text=f"Low stock: {names}{more}")
+        else:
+            self.low_stock_label.config(text="")
         
     def set_logo(self):
         """Set logo path (admin only)."""
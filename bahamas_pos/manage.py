@@ -0,0 +1,320 @@
+"""
+Command-line maintenance tasks for the POS database.
+
+Usage: python manage.py <command> [options]
+"""
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+
+import database
+import history
+import importer
+import stock
+import transactions
+
+
+def cmd_check_indexes(args: argparse.Namespace) -> int:
+    """Print the query plan of each hot query; fail if any does a full scan."""
+    failures = 0
+    for result in database.db.explain_hot_queries():
+        status = "OK" if result["uses_index"] else "SCAN"
+        print(f"[{status:>4}] {result['name']}")
+        for detail in result["plan"]:
+            print(f"         {detail}")
+        if not result["uses_index"]:
+            failures += 1
+    print(f"Schema version: {database.db.schema_version()}")
+    return 1 if failures else 0
+
+
+def cmd_migrate(args: argparse.Namespace) -> int:
+    """Apply pending schema migrations and list them."""
+    try:
+        # Opening the database already migrates; report those steps too
+        applied = database.db.migrations_applied + database.db.migrate()
+    except sqlite3.Error as e:
+        print(f"Migration failed: {e}")
+        return 1
+    for version, description in applied:
+        print(f"Applied {version:>3}: {description}")
+    if not applied:
+        print("Schema is up to date")
+    print(f"Schema version: {database.db.schema_version()} (code expects {database.SCHEMA_VERSION})")
+    return 0
+
+
+def cmd_verify_ledger(args: argparse.Namespace) -> int:
+    """Recompute ledger totals from scratch and report any drift."""
+    result = database.db.verify_ledger(repair=args.repair)
+    for field in database.LEDGER_FIELDS:
+        stored, actual = result["stored"][field], result["actual"][field]
+        flag = "  DRIFT" if field in result["drift"] else ""
+        print(f"{field:<20} stored={stored:>14.2f} actual={actual:>14.2f}{flag}")
+    if result["ok"]:
+        print("Ledger OK")
+        return 0
+    print("Ledger repaired" if result["repaired"] else "Ledger drift found (re-run with --repair to fix)")
+    return 0 if result["repaired"] else 1
+
+
+def cmd_close_day(args: argparse.Namespace) -> int:
+    """Freeze one business day's rollup."""
+    try:
+        summary = database.db.close_day(args.day, args.by)
+    except ValueError as e:
+        print(e)
+        return 1
+    print(f"Closed {args.day}: sales KES {summary['total_sales']:.2f}, credit KES {summary['total_credits']:.2f}, "
+          f"expenses KES {summary['total_expenses']:.2f}, {summary['total_transactions']} sale(s)")
+    return 0
+
+
+def cmd_reopen_day(args: argparse.Namespace) -> int:
+    """Re-open a closed day so back-dated edits are accepted again."""
+    if not database.db.reopen_day(args.day):
+        print(f"Day {args.day} is not closed")
+        return 1
+    print(f"Re-opened {args.day}")
+    return 0
+
+
+def cmd_rebuild_stock_counters(args: argparse.Namespace) -> int:
+    """Recompute per-item received/used counters from stock_logs."""
+    database.db.rebuild_stock_counters()
+    print(f"Rebuilt stock counters for {len(database.db.get_stock_report_data())} product(s)")
+    return 0
+
+
+def _write_csv(path: str, fields: list[str], rows) -> int:
+    """Stream dict rows to a CSV file ("-" for stdout); return the row count."""
+    out = sys.stdout if path == "-" else open(path, "w", newline="", encoding="utf-8")
+    try:
+        writer = csv.DictWriter(out, fieldnames=fields)
+        writer.writeheader()
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        return count
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def cmd_export_transactions(args: argparse.Namespace) -> int:
+    """Stream sales and expenses in a date range to CSV."""
+    fields = list(database.TRANSACTION_COLUMNS)
+    rows = database.db.iter_transactions({"from_date": args.from_date, "to_date": args.to_date}, columns=fields)
+    count = _write_csv(args.output, fields, rows)
+    print(f"Exported {count} transaction(s)", file=sys.stderr)
+    return 0
+
+
+def cmd_export_stock_logs(args: argparse.Namespace) -> int:
+    """Stream the stock log to CSV."""
+    fields = ["id", "item_code", "action", "quantity", "created_at", "business_date", "entries"]
+    count = _write_csv(args.output, fields, database.db.iter_stock_logs(args.item))
+    print(f"Exported {count} stock log entr{'y' if count == 1 else 'ies'}", file=sys.stderr)
+    return 0
+
+
+def cmd_stock_checkpoint(args: argparse.Namespace) -> int:
+    """Record every product's quantity at the end of a day."""
+    count = database.db.checkpoint_stock(args.day)
+    print(f"Checkpointed {count} product(s) for {args.day or 'today'}")
+    return 0
+
+
+def cmd_stock_as_of(args: argparse.Namespace) -> int:
+    """Print product quantities at the end of a past day."""
+    try:
+        rows = stock.stock_as_of(args.day, args.item)
+    except ValueError as e:
+        print(e)
+        return 1
+    for row in rows:
+        note = f"  (log short by {row['shortfall']}: movements dated before their stock arrived)" if row["shortfall"] else ""
+        print(f"{row['code']:<10} {row['name'][:30]:<30} {row['quantity']:>8}{note}")
+    return 0
+
+
+def cmd_compact_stock_logs(args: argparse.Namespace) -> int:
+    """Fold old stock log rows into per-item daily totals and reclaim the space."""
+    db = database.db
+    if args.enable_incremental_vacuum:
+        print("Rewriting the database file with auto_vacuum=INCREMENTAL (close all tills first)...")
+        db.enable_incremental_vacuum()
+    days = args.older_than
+    if days is None:
+        days = int(db.get_setting("stock_log_retention_days", "90"))
+    before = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+    stats = db.storage_stats()
+    result = db.compact_stock_logs(before, items_per_batch=args.batch)
+    after = db.storage_stats()
+    print(f"Compacted movements before {before}: {result['rows_removed']} row(s) folded into {result['groups']} daily row(s) "
+          f"across {result['items']} item(s)")
+    print(f"stock_logs rows: {stats['stock_log_rows']} -> {after['stock_log_rows']}; "
+          f"pages: {stats['page_count']} -> {after['page_count']} ({after['freelist_count']} free)")
+    if after["auto_vacuum"] != 2:
+        print("Freed pages are reused but the file will not shrink; run once with --enable-incremental-vacuum to change that")
+    return 0
+
+
+def cmd_replay_sales(args: argparse.Namespace) -> int:
+    """Record a file of sales (JSON list or one JSON object per line) in one commit."""
+    with open(args.path, encoding="utf-8") as f:
+        text = f.read()
+    stripped = text.lstrip()
+    if stripped.startswith("["):
+        sales = json.loads(stripped)
+    else:
+        sales = [json.loads(line) for line in text.splitlines() if line.strip()]
+    results = transactions.create_transactions_bulk(sales)
+    failed = 0
+    for number, result in enumerate(results, start=1):
+        if not result["ok"]:
+            failed += 1
+            print(f"Sale {number}: {result['error']}")
+    print(f"Recorded {len(results) - failed} sale(s), {failed} rejected")
+    return 1 if failed else 0
+
+
+def cmd_stock_adjust(args: argparse.Namespace) -> int:
+    """Apply a CSV of code,quantity lines in one transaction and print the variances."""
+    with open(args.path, encoding="utf-8-sig") as f:
+        entries = stock.parse_adjustments(f.read())
+    try:
+        report = stock.adjust_stock_bulk(entries, counted=args.counted)
+    except ValueError as e:
+        print(f"Nothing applied: {e}")
+        return 1
+    print(f"{'Code':<10} {'Name':<24} {'Before':>8} {'After':>8} {'Var':>6} {'Value':>12}")
+    for r in report:
+        print(f"{r['code']:<10} {r['name'][:24]:<24} {r['before']:>8} {r['after']:>8} {r['variance']:>+6} {r['variance_value']:>12.2f}")
+    print(f"Adjusted {sum(1 for r in report if r['variance'])} of {len(report)} item(s); "
+          f"net value {sum(r['variance_value'] for r in report):.2f}")
+    return 0
+
+
+def cmd_import_items(args: argparse.Namespace) -> int:
+    """Stream a CSV/xlsx item catalogue into the items table."""
+    try:
+        result = importer.import_items(args.path, chunk_size=args.chunk_size)
+    except (ValueError, sqlite3.IntegrityError) as e:
+        print(f"Import failed: {e}")
+        return 1
+    for line, message in result["errors"]:
+        print(f"Line {line}: {message}")
+    print(f"{result['rows']} row(s): {result['inserted']} added, {result['updated']} updated, "
+          f"{result['skipped']} skipped in {result['seconds']:.2f}s ({result['rows_per_sec']:.0f} rows/s)")
+    return 1 if result["skipped"] else 0
+
+
+def cmd_load_history(args: argparse.Namespace) -> int:
+    """Bulk-load historical sales or expenses from CSV, resumably."""
+    try:
+        result = history.load_history(args.path, args.kind, batch_size=args.batch_size)
+    except (ValueError, OSError, sqlite3.Error) as e:
+        print(f"Load failed: {e}")
+        note = history.resume_note(args.path)
+        if note:
+            print(note)
+        return 1
+    for line, message in result["errors"]:
+        print(f"Line {line}: {message}")
+    if result["resumed_at"]:
+        print(f"Resumed after {result['resumed_at']} row(s)")
+    print(f"{result['rows']} row(s): {result['loaded']} loaded, {result['skipped']} skipped "
+          f"in {result['seconds']:.2f}s ({result['rows_per_sec']:.0f} rows/s)")
+    return 1 if result["skipped"] else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="BAHAMAS POS maintenance commands")
+    parser.add_argument("--db", help="Database file (default: POS_DB_PATH or pos_database.db)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("check-indexes", help="EXPLAIN QUERY PLAN the hot queries and report full scans")
+    p.set_defaults(func=cmd_check_indexes)
+
+    p = sub.add_parser("migrate", help="Apply pending schema migrations (tills also do this on start)")
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser("verify-ledger", help="Recompute running totals and report drift")
+    p.add_argument("--repair", action="store_true", help="Overwrite the stored totals with the recomputed ones")
+    p.set_defaults(func=cmd_verify_ledger)
+
+    p = sub.add_parser("close-day", help="Close a business day (YYYY-MM-DD); later edits to it are rejected")
+    p.add_argument("day")
+    p.add_argument("--by", default="manage.py", help="Name recorded as the closer")
+    p.set_defaults(func=cmd_close_day)
+
+    p = sub.add_parser("reopen-day", help="Re-open a closed day and recompute its rollup")
+    p.add_argument("day")
+    p.set_defaults(func=cmd_reopen_day)
+
+    p = sub.add_parser("stock-checkpoint", help="Checkpoint product quantities at the end of a day (close-day does this too)")
+    p.add_argument("day", nargs="?", help="Business day (YYYY-MM-DD), default today")
+    p.set_defaults(func=cmd_stock_checkpoint)
+
+    p = sub.add_parser("stock-as-of", help="Show product quantities at the end of a past day")
+    p.add_argument("day", help="Business day (YYYY-MM-DD)")
+    p.add_argument("--item", help="Only this item code")
+    p.set_defaults(func=cmd_stock_as_of)
+
+    p = sub.add_parser("compact-stock-logs", help="Fold old stock log rows into per-item daily rows and reclaim space")
+    p.add_argument("--older-than", type=int, help="Age in days (default: stock_log_retention_days setting, else 90)")
+    p.add_argument("--batch", type=int, default=50, help="Items compacted per commit")
+    p.add_argument("--enable-incremental-vacuum", action="store_true", help="One-off VACUUM so freed pages can be returned to disk")
+    p.set_defaults(func=cmd_compact_stock_logs)
+
+    p = sub.add_parser("rebuild-stock-counters", help="Recompute per-item received/used counters from the stock log")
+    p.set_defaults(func=cmd_rebuild_stock_counters)
+
+    p = sub.add_parser("import-items", help="Import an item catalogue from CSV or xlsx")
+    p.add_argument("path", help="CSV or .xlsx file with a header row")
+    p.add_argument("--chunk-size", type=int, default=1000, help="Rows validated and committed per batch")
+    p.set_defaults(func=cmd_import_items)
+
+    p = sub.add_parser("stock-adjust", help="Apply a CSV of code,quantity stock changes in one transaction")
+    p.add_argument("path", help="CSV file of code,quantity[,unit_cost] lines (header optional)")
+    p.add_argument("--counted", action="store_true", help="Quantities are stock-take counts, not deltas")
+    p.set_defaults(func=cmd_stock_adjust)
+
+    p = sub.add_parser("replay-sales", help="Record queued or catch-up sales from a JSON file in one commit")
+    p.add_argument("path", help="JSON list of sales, or one sale object per line")
+    p.set_defaults(func=cmd_replay_sales)
+
+    p = sub.add_parser("export-transactions", help="Stream sales and expenses to CSV")
+    p.add_argument("output", help="CSV file to write, or - for stdout")
+    p.add_argument("--from", dest="from_date", help="First day (YYYY-MM-DD)")
+    p.add_argument("--to", dest="to_date", help="Last day (YYYY-MM-DD)")
+    p.set_defaults(func=cmd_export_transactions)
+
+    p = sub.add_parser("export-stock-logs", help="Stream the stock log to CSV")
+    p.add_argument("output", help="CSV file to write, or - for stdout")
+    p.add_argument("--item", help="Only this item code")
+    p.set_defaults(func=cmd_export_stock_logs)
+
+    p = sub.add_parser("load-history", help="Bulk-load historical sales or expenses from CSV (resumable)")
+    p.add_argument("path", help="CSV file with a header row")
+    p.add_argument("--kind", choices=["sales", "expenses"], required=True)
+    p.add_argument("--batch-size", type=int, default=50000, help="Rows per commit and checkpoint")
+    p.set_defaults(func=cmd_load_history)
+
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.db:
+        database.init(args.db)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
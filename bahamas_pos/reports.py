@@ -23,17 +23,10 @@ def generate_receipt(transaction: dict) -> str:
     lines.append(f"Date: {transaction.get('date', 'N/A')}")
     lines.append("-" * 50)
     
-    # Items
+    # Items, with names and prices as captured at sale time
     lines.append("ITEMS:")
-    for item in transaction["items"]:
-        code = item["code"]
-        qty = item["quantity"]
-        store_item = database.db.get_item(code)
-        if store_item:
-            name = store_item["name"]
-            price = store_item["price"]
-            subtotal = price * qty
-            lines.append(f"{name} x{qty} @ KES {price:.2f} = KES {subtotal:.2f}")
+    for line in database.db.get_transaction_lines(transaction["id"]):
+        lines.append(f"{line['name']} x{line['quantity']} @ KES {line['unit_price']:.2f} = KES {line['subtotal']:.2f}")
     
     lines.append("-" * 50)
     lines.append(f"TOTAL: KES {transaction['total']:.2f}")
@@ -75,26 +68,69 @@ def generate_stock_report() -> str:
     
     lines.append("-" * 60)
     lines.append(f"Total Items: {len(rows)}")
+    lines.append(f"Inventory Value (FIFO): KES {database.db.get_inventory_value():.2f}")
     lines.append("=" * 60)
     
     return "\n".join(lines)
 
 
-def generate_sales_summary() -> str:
-    """Generate a simple sales summary."""
+def generate_item_sales_report(from_date: str = "", to_date: str = "") -> str:
+    """Generate per-item quantity and revenue for a date range."""
+    lines = []
+    lines.append("=" * 60)
+    lines.append("ITEM SALES REPORT".center(60))
+    lines.append("BAHAMAS CYBER CAFE AND PHONE REPAIR".center(60))
+    lines.append(f"Range: {from_date or '-'} to {to_date or '-'}".center(60))
+    lines.append("=" * 60)
+    
+    rows = database.db.get_item_sales(from_date or None, to_date or None)
+    if not rows:
+        lines.append("No sales in range.")
+        return "\n".join(lines)
+    
+    lines.append(f"{'Code':<10} {'Item Name':<25} {'Qty':<8} {'Revenue':<14}")
+    lines.append("-" * 60)
+    for row in rows:
+        code = row["code"] or f"SVC{row['service_id']}"
+        lines.append(f"{code:<10} {row['name'][:25]:<25} {row['quantity']:<8} {row['revenue']:<14.2f}")
+    lines.append("-" * 60)
+    lines.append(f"Total Revenue: KES {sum(r['revenue'] for r in rows):.2f}")
+    lines.append("=" * 60)
+    
+    return "\n".join(lines)
+
+
+def generate_sales_summary(from_date: str = "", to_date: str = "") -> str:
+    """Generate a simple sales summary, optionally for a date range."""
     lines = []
     lines.append("=" * 50)
     lines.append("SALES SUMMARY".center(50))
     lines.append("BAHAMAS CYBER CAFE AND PHONE REPAIR".center(50))
     lines.append("=" * 50)
     
-    summary = database.db.get_sales_summary()
-    
-    lines.append(f"Total Sales (Paid): KES {summary['total_sales']:.2f}")
-    lines.append(f"Outstanding Credits: KES {summary['total_credits']:.2f}")
+    if from_date or to_date:
+        summary = database.db.get_period_summary(from_date or None, to_date or None)
+        lines.append(f"Range: {from_date or '-'} to {to_date or '-'}")
+        lines.append(f"Total Sales (Paid): KES {summary['total_sales']:.2f}")
+        lines.append(f"Credit Sales: KES {summary['total_credits']:.2f}")
+    else:
+        summary = database.db.get_sales_summary()
+        lines.append(f"Total Sales (Paid): KES {summary['total_sales']:.2f}")
+        lines.append(f"Outstanding Credits: KES {summary['total_credits']:.2f}")
     lines.append(f"Total Expenses: KES {summary['total_expenses']:.2f}")
     lines.append(f"System Balance: KES {summary['system_balance']:.2f}")
     lines.append(f"Total Transactions: {summary['total_transactions']}")
+    if "total_cogs" in summary:
+        lines.append(f"Cost of Goods Sold: KES {summary['total_cogs']:.2f}")
+        lines.append(f"Gross Profit: KES {summary['gross_profit']:.2f}")
+    
+    if from_date or to_date:
+        lines.append("-" * 50)
+        for method, row in summary["by_payment_method"].items():
+            if method == "-":
+                continue
+            received = row["sales_total"] + row["cleared_total"]
+            lines.append(f"{method:<10} Received: KES {received:.2f}  Sales: {row['sale_count']}")
     lines.append("=" * 50)
     
     return "\n".join(lines)
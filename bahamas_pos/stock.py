@@ -1,11 +1,15 @@
 """
 Stock management: item entry, inventory tracking, and logs.
 """
+import csv
+import io
+from datetime import datetime
 from typing import Optional
 import database
 
 
-def add_item(name: str, item_type: str, price: float, quantity: int = 0, buying_price: float = 0.0, selling_price: Optional[float] = None) -> dict:
+def add_item(name: str, item_type: str, price: float, quantity: int = 0, buying_price: float = 0.0, selling_price: Optional[float] = None,
+             reorder_level: int = 0) -> dict:
     """Create an item with an auto code and store it."""
     if not name:
         raise ValueError("Item name is required")
@@ -13,10 +17,13 @@ def add_item(name: str, item_type: str, price: float, quantity: int = 0, buying_
         raise ValueError("Invalid item type")
     if price < 0:
         raise ValueError("Price cannot be negative")
+    if reorder_level < 0:
+        raise ValueError("Reorder level cannot be negative")
     if item_type != "product":
         quantity = 0
+        reorder_level = 0
 
-    return database.db.add_item(name, item_type, price, quantity, 'unit', buying_price, selling_price)
+    return database.db.add_item(name, item_type, price, quantity, 'unit', buying_price, selling_price, reorder_level)
 
 
 def get_item(code: str) -> Optional[dict]:
@@ -31,27 +38,92 @@ def list_items() -> list[dict]:
 
 def adjust_stock(code: str, delta_quantity: int) -> None:
     """Adjust stock quantity."""
-    item = get_item(code)
-    if not item:
-        raise ValueError("Item code not found")
-    if item["type"] != "product":
-        return  # no stock tracking for non-products
-    
-    new_qty = item["quantity"] + int(delta_quantity)
-    if new_qty < 0:
-        raise ValueError("Insufficient stock")
-    
-    database.db.update_item_quantity(code, new_qty)
-    database.db.log_stock_action(code, "added" if delta_quantity > 0 else "used", abs(int(delta_quantity)))
-
-
-def update_item(code: str, name: str, quantity: int, buying_price: float, selling_price: float) -> None:
+    # Read, update and log under one write lock and one commit
+    with database.db.transaction():
+        item = get_item(code)
+        if not item:
+            raise ValueError("Item code not found")
+        if item["type"] != "product":
+            return  # no stock tracking for non-products
+
+        new_qty = item["quantity"] + int(delta_quantity)
+        if new_qty < 0:
+            raise ValueError("Insufficient stock")
+
+        database.db.update_item_quantity(code, new_qty)
+        database.db.log_stock_action(code, "added" if delta_quantity > 0 else "used", abs(int(delta_quantity)))
+
+
+def adjust_stock_bulk(entries: list[tuple], counted: bool = False) -> list[dict]:
+    """Apply a delivery (deltas) or a stock-take (counted quantities) in one commit.
+
+    Entries are (code, quantity) or (code, quantity, unit_cost); the cost
+    of received units defaults to the item's buying price. Returns the
+    variance report; raises ValueError without changing anything if any
+    line is invalid.
+    """
+    cleaned = []
+    for code, quantity, *rest in entries:
+        code = str(code).strip()
+        if not code:
+            raise ValueError("Item code is required")
+        try:
+            quantity = int(quantity)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid quantity for {code}: {quantity}")
+        if counted and quantity < 0:
+            raise ValueError(f"Counted quantity for {code} cannot be negative")
+        unit_cost = None
+        if rest and str(rest[0]).strip() != "":
+            try:
+                unit_cost = float(rest[0])
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid unit cost for {code}: {rest[0]}")
+            if unit_cost < 0:
+                raise ValueError(f"Unit cost for {code} cannot be negative")
+        cleaned.append((code, quantity, unit_cost))
+    return database.db.adjust_stock_bulk(cleaned, counted)
+
+
+def parse_adjustments(text: str) -> list[tuple]:
+    """Parse "code,quantity[,unit_cost]" lines (CSV, optional header row) into entries."""
+    entries = []
+    for row in csv.reader(io.StringIO(text)):
+        if not row or not "".join(row).strip():
+            continue
+        if len(row) < 2:
+            raise ValueError(f"Expected code,quantity but got: {','.join(row)}")
+        code, quantity = row[0].strip(), row[1].strip()
+        if not entries and not quantity.lstrip("-").isdigit():
+            continue  # header row
+        entries.append((code, quantity, row[2].strip() if len(row) > 2 else ""))
+    return entries
+
+
+def update_item(code: str, name: str, quantity: int, buying_price: float, selling_price: float,
+                reorder_level: Optional[int] = None) -> None:
     """Update an existing stock item."""
     if quantity < 0:
         raise ValueError("Quantity cannot be negative")
     if buying_price < 0 or selling_price < 0:
         raise ValueError("Prices cannot be negative")
-    database.db.update_item(code, name, quantity, buying_price, selling_price)
+    if reorder_level is not None and reorder_level < 0:
+        raise ValueError("Reorder level cannot be negative")
+    database.db.update_item(code, name, quantity, buying_price, selling_price, reorder_level)
+
+
+def stock_as_of(day: str, code: Optional[str] = None) -> list[dict]:
+    """Product quantities at the end of a past business day (YYYY-MM-DD)."""
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"Invalid date: {day} (expected YYYY-MM-DD)")
+    return database.db.stock_as_of(day, code)
+
+
+def low_stock_items(limit: int = 50) -> list[dict]:
+    """Products at or below their reorder level, lowest stock first."""
+    return database.db.list_low_stock(limit)
 
 
 def delete_items(codes: list[str]) -> int:
@@ -0,0 +1,101 @@
+"""
+Concurrent checkout stress run against a throwaway database.
+
+Starts N cashier threads that keep selling one unit of the same product
+until it runs out, then checks that exactly the opening stock was sold
+(no oversell), that stock never went negative and that the ledger still
+matches the base tables. Prints the committed sales per second.
+
+Usage: python stress_sales.py [--cashiers 8] [--stock 2000] [--write-queue]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import database
+import stock
+import transactions
+import writer
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Concurrent sale stress run")
+    parser.add_argument("--cashiers", type=int, default=8, help="Number of concurrent selling threads")
+    parser.add_argument("--stock", type=int, default=2000, help="Opening stock of the contested product")
+    parser.add_argument("--write-queue", action="store_true", help="Sell through the single-writer queue (writer.py)")
+    args = parser.parse_args(argv)
+
+    # A scratch file of our own; the process-wide database is left alone
+    workdir = tempfile.mkdtemp(prefix="pos-stress-")
+    db = database.Database(os.path.join(workdir, "stress.db"))
+    token = database.bind(db)
+    try:
+        item = stock.add_item("Stress Widget", "product", 1.0, args.stock, 0.5, 1.0)
+    finally:
+        database.unbind(token)
+    sold = [0] * args.cashiers
+    errors: list[str] = []
+    start_line = threading.Barrier(args.cashiers)
+    writes = writer.WriteQueue(db=db).start() if args.write_queue else None
+
+    def sell() -> dict:
+        line = [{"code": item["code"], "quantity": 1}]
+        if writes:
+            return writes.call(transactions.create_transaction, line, "Cash")
+        return transactions.create_transaction(line, "Cash")
+
+    def cashier(n: int) -> None:
+        # Bindings do not follow new threads, so each cashier binds its own
+        token = database.bind(db)
+        start_line.wait()
+        try:
+            while True:
+                try:
+                    sell()
+                    sold[n] += 1
+                except ValueError as e:
+                    if "Insufficient stock" not in str(e):
+                        errors.append(str(e))
+                    return
+                except Exception as e:  # lock timeouts and the like count as failures
+                    errors.append(repr(e))
+                    return
+        finally:
+            database.unbind(token)
+
+    threads = [threading.Thread(target=cashier, args=(n,)) for n in range(args.cashiers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    if writes:
+        writes.stop()
+
+    remaining = db.get_item(item["code"])["quantity"]
+    total_sold = sum(sold)
+    ledger = db.verify_ledger()
+    db.close()
+
+    print(f"Cashiers:      {args.cashiers}")
+    print(f"Opening stock: {args.stock}")
+    print(f"Sold:          {total_sold} ({', '.join(str(n) for n in sold)})")
+    print(f"Remaining:     {remaining}")
+    print(f"Elapsed:       {elapsed:.2f}s ({total_sold / elapsed:.0f} sales/s)")
+    if writes:
+        stats = writes.stats()
+        print(f"Write queue:   {stats['jobs']} job(s) in {stats['batches']} commit(s)")
+    for error in errors:
+        print(f"Error: {error}")
+
+    ok = total_sold == args.stock and remaining == 0 and not errors and ledger["ok"]
+    print("PASS" if ok else "FAIL")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
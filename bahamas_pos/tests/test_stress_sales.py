@@ -0,0 +1,9 @@
+"""Concurrent checkouts must never sell more than the opening stock."""
+import pytest
+
+import stress_sales
+
+
+@pytest.mark.parametrize("extra", [[], ["--write-queue"]], ids=["direct", "write-queue"])
+def test_concurrent_sales_do_not_oversell(extra, capsys):
+    assert stress_sales.main(["--cashiers", "4", "--stock", "60", *extra]) == 0, capsys.readouterr().out
@@ -5,50 +5,71 @@ from typing import Optional
 import database
 
 
-def create_transaction(items: list[dict], payment_method: str, customer_name: str = "", date: Optional[str] = None) -> dict:
-    """Create a new transaction with items and payment details."""
+def _check_sale(items: list[dict], payment_method: str) -> None:
+    """Reject sales that are malformed before touching the database."""
     if not items:
         raise ValueError("Transaction must have at least one item")
     if payment_method not in ("Mpesa", "Cash", "Credit"):
         raise ValueError("Invalid payment method")
-    
-    # Validate stock items only (services don't touch stock)
-    for item in items:
-        if "service_id" in item:
+
+
+def create_transaction(items: list[dict], payment_method: str, customer_name: str = "", date: Optional[str] = None,
+                       idempotency_key: Optional[str] = None) -> dict:
+    """Create a new transaction with items and payment details.
+
+    Pass a client-generated ``idempotency_key`` so a resubmitted sale returns
+    the original transaction instead of recording it twice.
+    """
+    _check_sale(items, payment_method)
+    # Stock is validated by the database under the write lock
+    return database.db.create_transaction(items, payment_method, customer_name, date, idempotency_key)
+
+
+def create_transactions_bulk(sales: list[dict]) -> list[dict]:
+    """Record many sales with a single commit (catch-up entry, replaying queued sales).
+
+    Returns one result per sale, in order: ``{"ok": True, "transaction": ...}``
+    or ``{"ok": False, "error": ...}``. A bad sale does not stop the others.
+    """
+    results: list[Optional[dict]] = [None] * len(sales)
+    valid, positions = [], []
+    for index, sale in enumerate(sales):
+        try:
+            _check_sale(sale.get("items"), sale.get("payment_method"))
+        except ValueError as e:
+            results[index] = {"ok": False, "error": str(e)}
             continue
-        code = item["code"]
-        qty = item["quantity"]
-        store_item = database.db.get_item(code)
-        if not store_item:
-            raise ValueError(f"Item {code} not found")
-        if store_item["type"] == "product" and store_item["quantity"] < qty:
-            raise ValueError(f"Insufficient stock for {code}")
-    
-    return database.db.create_transaction(items, payment_method, customer_name, date)
+        valid.append(sale)
+        positions.append(index)
+    for index, result in zip(positions, database.db.create_transactions_bulk(valid)):
+        results[index] = result
+    return results
 
 
-def add_expense(description: str, amount: float, date: Optional[str] = None) -> dict:
+def add_expense(description: str, amount: float, date: Optional[str] = None, idempotency_key: Optional[str] = None) -> dict:
     """Add an expense and deduct from system balance."""
     if amount <= 0:
         raise ValueError("Expense amount must be positive")
     
-    return database.db.add_expense(description, amount, date)
+    return database.db.add_expense(description, amount, date, idempotency_key)
 
 
-def clear_credit(customer_name: str, payment_method_cleared: str, date_cleared: Optional[str] = None) -> bool:
+def clear_credit(customer_name: str, payment_method_cleared: str, date_cleared: Optional[str] = None,
+                 idempotency_key: Optional[str] = None) -> bool:
     """Clear customer credit by marking transactions as paid with details."""
     if payment_method_cleared not in ("Mpesa", "Cash"):
         raise ValueError("Invalid clearance payment method")
-    return database.db.clear_credit(customer_name, payment_method_cleared, date_cleared)
+    return database.db.clear_credit(customer_name, payment_method_cleared, date_cleared, idempotency_key)
+
+
+def search_customers(prefix: str, limit: int = 10) -> list[dict]:
+    """Credit customers whose name starts with ``prefix`` (for autocomplete)."""
+    return database.db.search_customers(prefix, limit)
 
 
 def get_transaction(txn_id: str) -> Optional[dict]:
-    """Get transaction by ID."""
-    transactions = database.db.list_transactions()
-    for txn in transactions:
-        if txn["id"] == txn_id:
-            return txn
-    return None
+    """Get transaction by ID, including its sale lines."""
+    return database.db.get_transaction(str(txn_id))
 
 
 def list_transactions() -> list[dict]:
@@ -56,6 +77,18 @@ def list_transactions() -> list[dict]:
     return database.db.list_transactions()
 
 
+def query_transactions(txn_type: str = "all", payment_method: str = "all", from_date: str = "", to_date: str = "",
+                       text: str = "", limit: int = 50, cursor: str = None) -> dict:
+    """Get one filtered page of transactions; pass ``next_cursor`` back for the next page."""
+    return database.db.query_transactions(txn_type, payment_method, from_date or None, to_date or None,
+                                          text or None, limit, cursor or None)
+
+
+def iter_transactions(from_date: str = "", to_date: str = "", columns: list[str] = None):
+    """Stream transactions in a date range without loading them all at once."""
+    return database.db.iter_transactions({"from_date": from_date or None, "to_date": to_date or None}, columns=columns)
+
+
 def list_credits() -> dict:
     """Get all outstanding credits."""
     return database.db.list_credits()
@@ -1,7 +1,9 @@
 """
 Window classes for the POS system GUI.
 """
+import sqlite3
 import tkinter as tk
+import uuid
 from tkinter import ttk, messagebox, filedialog
 from datetime import datetime
 from typing import List, Dict
@@ -125,6 +127,8 @@ class SalesWindow:
         self.window.grab_set()
         
         self.cart_items = []
+        # One key per sale so a retry after a lock timeout cannot double-record it
+        self.sale_key = uuid.uuid4().hex
         self.setup_ui()
         self.load_items()
         
@@ -195,8 +199,9 @@ class SalesWindow:
         # Customer name (for credit)
         ttk.Label(right_frame, text="Customer Name:").pack(anchor=tk.W)
         self.customer_var = tk.StringVar()
-        customer_entry = ttk.Entry(right_frame, textvariable=self.customer_var)
-        customer_entry.pack(fill=tk.X, pady=(0, 10))
+        self.customer_combo = ttk.Combobox(right_frame, textvariable=self.customer_var)
+        self.customer_combo.pack(fill=tk.X, pady=(0, 10))
+        self.customer_combo.bind("<KeyRelease>", self.suggest_customers)
         
         # Total display
         self.total_label = ttk.Label(right_frame, text="Total: KES 0.00", 
@@ -312,6 +317,13 @@ class SalesWindow:
             
         self.total_label.config(text=f"Total: KES {total:.2f}")
         
+    def suggest_customers(self, event=None):
+        """Offer existing credit customers matching what has been typed."""
+        if event is not None and event.keysym in ("Up", "Down", "Return", "Escape", "Tab"):
+            return
+        matches = transactions.search_customers(self.customer_var.get())
+        self.customer_combo["values"] = [c["name"] for c in matches]
+
     def on_payment_change(self, event=None):
         """Handle payment method change."""
         if self.payment_var.get() == "Credit":
@@ -338,7 +350,7 @@ class SalesWindow:
             
             # Create transaction
             date_value = self.sale_date_field.get_date_str() or None
-            txn = transactions.create_transaction(txn_items, payment_method, customer_name, date_value)
+            txn = transactions.create_transaction(txn_items, payment_method, customer_name, date_value, self.sale_key)
             
             # Show success message
             messagebox.showinfo("Success", f"Sale processed successfully!\nTransaction ID: {txn['id']}\nTotal: KES {txn['total']:.2f}")
@@ -355,6 +367,9 @@ class SalesWindow:
             
         except ValueError as e:
             messagebox.showerror("Error", str(e))
+        except sqlite3.OperationalError as e:
+            # Safe to press Process Sale again: the same key is reused
+            messagebox.showerror("Database Busy", f"The sale was not confirmed ({e}). Please try again.")
             
     def show_receipt(self, transaction):
         """Show receipt window."""
@@ -557,41 +572,38 @@ class TransactionsWindow:
         button_frame.pack(fill=tk.X, pady=10)
         
         ttk.Button(button_frame, text="Refresh", command=self.load_transactions).pack(side=tk.LEFT, padx=(0, 10))
+        self.more_button = ttk.Button(button_frame, text="Load More", command=self.load_more)
+        self.more_button.pack(side=tk.LEFT, padx=(0, 10))
         ttk.Button(button_frame, text="Export", command=self.export_transactions).pack(side=tk.LEFT, padx=(0, 10))
         ttk.Button(button_frame, text="View Receipt", command=self.view_receipt).pack(side=tk.LEFT, padx=(0, 10))
         ttk.Button(button_frame, text="Close", command=self.window.destroy).pack(side=tk.LEFT)
         
     def load_transactions(self):
-        """Load transactions into the treeview."""
+        """Load the first page of transactions into the treeview."""
         # Clear existing items
         for item in self.txn_tree.get_children():
             self.txn_tree.delete(item)
-            
-        # Load transactions
-        txns = transactions.list_transactions()
-        # Apply filters
-        f_from = (self.from_date.get() or "").strip()
-        f_to = (self.to_date.get() or "").strip()
-        f_type = self.type_filter.get()
-        f_pay = self.payment_filter.get()
-
-        def in_range(d: str) -> bool:
-            if not d:
-                return True
-            if f_from and d < f_from:
-                return False
-            if f_to and d > f_to:
-                return False
-            return True
+        self.next_cursor = None
+        self.load_more()
 
-        for txn in txns:
-            if f_type != "all" and txn.get("type", "sale") != f_type:
-                continue
-            if f_pay != "all" and txn.get("payment_method", "-") != f_pay:
-                continue
-            if not in_range(txn.get("date", "")):
-                continue
+    def load_more(self):
+        """Append the next page of filtered transactions to the treeview."""
+        try:
+            page = transactions.query_transactions(
+                self.type_filter.get(),
+                self.payment_filter.get(),
+                (self.from_date.get() or "").strip(),
+                (self.to_date.get() or "").strip(),
+                limit=200,
+                cursor=self.next_cursor
+            )
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        self.next_cursor = page["next_cursor"]
+        self.more_button.configure(state=tk.NORMAL if self.next_cursor else tk.DISABLED)
 
+        for txn in page["rows"]:
             paid_status = "Yes" if txn.get("paid", True) else "No"
             customer = txn.get("customer_name") or (txn.get("description") if txn.get("type") == "expense" else "-")
             self.txn_tree.insert("", tk.END, values=(
@@ -786,6 +798,12 @@ class AddStockWindow:
         qty_entry = ttk.Entry(form_frame, textvariable=self.qty_var, width=30)
         qty_entry.grid(row=3, column=1, pady=5, padx=(10, 0), sticky=tk.W)
         
+        # Reorder level
+        ttk.Label(form_frame, text="Reorder Level:").grid(row=4, column=0, sticky=tk.W, pady=5)
+        self.reorder_var = tk.StringVar(value="0")
+        reorder_entry = ttk.Entry(form_frame, textvariable=self.reorder_var, width=30)
+        reorder_entry.grid(row=4, column=1, pady=5, padx=(10, 0), sticky=tk.W)
+        
         # Bind type change
         type_combo.bind("<<ComboboxSelected>>", self.on_type_change)
         
@@ -803,6 +821,7 @@ class AddStockWindow:
         """Handle item type change."""
         if self.type_var.get() != "product":
             self.qty_var.set("0")
+            self.reorder_var.set("0")
             
     def add_item(self):
         """Add the new item."""
@@ -832,8 +851,15 @@ class AddStockWindow:
             return
             
         try:
-            item = stock.add_item(name, item_type, price, qty)
+            reorder_level = int(self.reorder_var.get() or 0)
+        except ValueError:
+            messagebox.showerror("Error", "Invalid reorder level")
+            return
+            
+        try:
+            item = stock.add_item(name, item_type, price, qty, reorder_level=reorder_level)
             messagebox.showinfo("Success", f"Item added successfully!\nCode: {item['code']}\nName: {item['name']}")
+            self.parent.update_status()
             self.window.destroy()
             
         except ValueError as e:
@@ -0,0 +1,135 @@
+"""
+Optional single-writer thread for the web app.
+
+Web requests hand their writes to one thread through a priority queue
+instead of each taking SQLite's write lock themselves. The thread takes
+whatever cashier writes are waiting (up to ``max_batch``), runs each in
+its own savepoint inside one IMMEDIATE transaction and commits once, so
+a burst of sales costs one lock and one fsync. Results and exceptions
+come back through futures, which are only resolved after the commit.
+A job that raises is rolled back alone; the rest of its batch commits.
+
+Admin jobs queue behind every waiting cashier job and run in a batch of
+their own, so a stock take never holds up the tills for longer than it
+takes itself. Reads do not go through here; they stay on the pool.
+
+Jobs must be ordinary units of work. Anything that commits on its own
+terms (bulk_load_mode, compact_stock_logs, enable_incremental_vacuum,
+the history loader) must not be queued.
+"""
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional
+
+import database
+
+# Job priorities; lower runs first
+CASHIER = 0
+ADMIN = 10
+_STOP = 100
+
+
+class WriteQueue:
+    """A writer thread that group-commits queued database writes."""
+
+    def __init__(self, max_batch: int = 32, db: Optional[database.Database] = None):
+        self.max_batch = max_batch
+        # Jobs run against ``db`` when given, else the process-wide database
+        self.db = db
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"jobs": 0, "batches": 0, "failed": 0}
+
+    def start(self) -> "WriteQueue":
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="pos-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Finish every job queued so far, then stop the thread."""
+        if self._thread is None:
+            return
+        self._queue.put((_STOP, next(self._seq), None))
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, fn: Callable, *args: Any, priority: int = CASHIER, **kwargs: Any) -> Future:
+        """Queue ``fn(*args, **kwargs)``; the future resolves once its batch commits."""
+        future: Future = Future()
+        if threading.current_thread() is self._thread:
+            # A job queueing more work would wait on itself; it is already in a unit
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self.start()
+        self._queue.put((priority, next(self._seq), (fn, args, kwargs, future)))
+        return future
+
+    def call(self, fn: Callable, *args: Any, priority: int = CASHIER, **kwargs: Any) -> Any:
+        """Queue ``fn`` and wait for it; raises whatever ``fn`` raised."""
+        return self.submit(fn, *args, priority=priority, **kwargs).result()
+
+    def stats(self) -> Dict[str, int]:
+        """Jobs run, batches committed and jobs that raised, since start."""
+        return dict(self._stats, pending=self._queue.qsize())
+
+    def _next_batch(self) -> tuple:
+        """Block for one job, then take the cashier jobs already waiting behind it."""
+        priority, _, job = self._queue.get()
+        if priority == _STOP:
+            return [], True
+        batch = [job]
+        if priority != CASHIER:
+            return batch, False
+        while len(batch) < self.max_batch:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry[0] != CASHIER:
+                self._queue.put(entry)
+                break
+            batch.append(entry[2])
+        return batch, False
+
+    def _run(self) -> None:
+        while True:
+            batch, stopping = self._next_batch()
+            if stopping:
+                return
+            jobs = [job for job in batch if job[3].set_running_or_notify_cancel()]
+            if jobs:
+                self._commit(jobs)
+
+    def _commit(self, jobs: list) -> None:
+        db = self.db or database.get_db()
+        outcomes = []
+        token = database.bind(db)
+        try:
+            with db.transaction():
+                for fn, args, kwargs, _future in jobs:
+                    try:
+                        # Nested unit: a failing job rolls back to its own savepoint
+                        with db.transaction():
+                            outcomes.append((True, fn(*args, **kwargs)))
+                    except Exception as e:
+                        outcomes.append((False, e))
+        except Exception as e:
+            # BEGIN or COMMIT failed: nothing in the batch was written
+            outcomes = [(False, e)] * len(jobs)
+        finally:
+            database.unbind(token)
+        self._stats["batches"] += 1
+        self._stats["jobs"] += len(jobs)
+        for (ok, value), (_fn, _args, _kwargs, future) in zip(outcomes, jobs):
+            if ok:
+                future.set_result(value)
+            else:
+                self._stats["failed"] += 1
+                future.set_exception(value)